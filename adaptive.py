@@ -0,0 +1,77 @@
+'''
+Adaptive per pixel sampling
+Each pixel starts with a minimum number of samples, then keeps sampling in batches
+only while the estimated error of its mean is above a threshold, up to a maximum budget.
+The error is the standard error of the pixel's luminance relative to its brightness
+'''
+
+import os
+import numpy as np
+from PIL import Image
+from util import *
+
+#relative luminance of a color
+def luminance(c):
+    return 0.2126*c[0] + 0.7152*c[1] + 0.0722*c[2]
+
+class AdaptiveSampler():
+    def __init__(self, min_samples, max_samples, threshold, batch):
+        #at least two samples are needed for a variance estimate
+        self.min_samples = max(2, min_samples)
+        self.max_samples = max_samples
+        self.threshold = threshold
+        self.batch = batch
+
+    #has a pixel with n samples, luminance sum s and sum of squares sq converged?
+    #works on python floats or on numpy arrays of pixels
+    def converged(self, n, s, sq):
+        mean = s / n
+        var = np.maximum((sq - s*mean) / (n - 1), 0)
+        error = np.sqrt(var / n)
+        return error <= self.threshold*np.maximum(mean, 0.05)
+
+    #samples one pixel, sample_fn returns the color of one new sample
+    #returns the summed color and the number of samples taken
+    def sample_pixel(self, sample_fn):
+        color = Vec3(0,0,0)
+        s = 0.0
+        sq = 0.0
+        n = 0
+        target = min(self.min_samples, self.max_samples)
+        while True:
+            while n < target:
+                c = sample_fn()
+                lum = luminance(c)
+                color += c
+                s += lum
+                sq += lum*lum
+                n += 1
+            if n >= self.max_samples or self.converged(n, s, sq):
+                return color, n
+            target = min(n + self.batch, self.max_samples)
+
+#saves a false color image of the samples taken per pixel, blue is few samples and red is many
+def write_heatmap(counts, max_samples, fname):
+    x = np.clip(counts / max(max_samples, 1), 0.0, 1.0)[..., None]
+    low = np.array([20, 30, 120], dtype=np.float64)
+    mid = np.array([240, 220, 40], dtype=np.float64)
+    high = np.array([200, 20, 20], dtype=np.float64)
+    rgb = np.where(x < 0.5, low + (mid - low)*(2*x), mid + (high - mid)*(2*x - 1))
+    Image.fromarray(rgb.astype(np.uint8), 'RGB').save(fname)
+
+#file name of the heatmap written next to an image, scene.png -> scene_samples.png
+def heatmap_name(fname):
+    root, ext = os.path.splitext(fname)
+    #the heatmap is an 8 bit image, raw float outputs get a png next to them
+    if ext.lower() in ("", ".npy", ".pfm"):
+        ext = ".png"
+    return f"{root}_samples{ext}"
+
+#prints how many samples were taken compared to a fixed budget run
+def report_savings(counts, max_samples):
+    taken = int(counts.sum())
+    budget = counts.size*max_samples
+    saved = budget - taken
+    print(f"Adaptive sampling: {taken} samples taken, {budget} with a fixed budget, "
+        f"{saved} saved ({100*saved/max(budget, 1):.1f}%), "
+        f"{taken/max(counts.size, 1):.1f} samples per pixel on average")
@@ -0,0 +1,312 @@
+'''
+Animation: renders a numbered image sequence from keyframed camera and object transforms
+The scene, its textures and one pool of worker processes are set up once for the whole sequence.
+Every tile queued is tagged with its frame, and a worker that picks up a tile of a new frame moves
+the camera and the animated objects into place itself, so only frame numbers cross the queue.
+    refit       when objects move, the BVH keeps its tree and its boxes are fitted around the objects'
+                new positions bottom up (a grid is built again). The parent refits its own copy ahead of
+                the workers and rebuilds the BVH once its SAH cost grows past rebuild_threshold times the
+                cost of the last build, the tiles it queues then tell the workers to rebuild as well
+    pipelining  the tiles of the next lookahead frames are queued while a frame is still rendering,
+                so workers move on to the next frame instead of waiting for the last tiles of this one
+Keys are (frame, value) pairs and values are interpolated linearly between keys, before the first and
+after the last key the value of that key is held:
+    Animation(frames=48,
+        camera={"lookfrom": [(0, (0, 4, -4)), (47, (6, 3, -2))], "lookat": [(0, (0, 0, 0))]},
+        objects={3: {"translate": [(0, (0, 0, 0)), (24, (0, 2, 0)), (47, (0, 0, 0))]}})
+Objects are numbered as in world.hittables, each can have translate, rotate (degrees about x, y, z)
+and scale keys relative to where it was placed. Spheres use translate and scale, flat rectangles only
+translate and mesh instances all three
+    python3 animation.py --frames 24 --width 320 --spp 16 --out frames
+'''
+
+import argparse
+import json
+import multiprocessing as mp
+import os
+import random
+import time
+import gc
+import numpy as np
+from PIL import Image
+from util import *
+from objects import Sphere, RectFlat
+from boundingbox import BB
+from mesh import Instance, Transform
+from packed import PackedScene
+from scheduler import make_tiles, estimate_cost, get_result
+import film
+import metrics
+
+#keyframed value, a number or a tuple of numbers
+class Track():
+    def __init__(self, keys):
+        if not keys:
+            raise ValueError("A track needs at least one key")
+        self.keys = sorted((float(f), tuple(float(x) for x in np.atleast_1d(v))) for f, v in keys)
+
+    def at(self, frame):
+        keys = self.keys
+        if frame <= keys[0][0]:
+            return keys[0][1]
+        for (f0, v0), (f1, v1) in zip(keys, keys[1:]):
+            if frame <= f1:
+                a = (frame - f0) / (f1 - f0) if f1 > f0 else 1.0
+                return tuple(x0 + a*(x1 - x0) for x0, x1 in zip(v0, v1))
+        return keys[-1][1]
+
+class Animation():
+    #camera maps "lookfrom" and "lookat" to keys, objects maps object numbers to
+    #{"translate": keys, "rotate": keys, "scale": keys}, missing tracks keep the scene's values
+    def __init__(self, frames, camera=None, objects=None):
+        self.frames = frames
+        self.camera = {name: Track(keys) for name, keys in (camera or {}).items()}
+        for name in self.camera:
+            if name not in ("lookfrom", "lookat"):
+                raise ValueError(f"Unknown camera track: {name}")
+        self.objects = {}
+        for index, tracks in (objects or {}).items():
+            for name in tracks:
+                if name not in ("translate", "rotate", "scale"):
+                    raise ValueError(f"Unknown object track: {name}")
+            self.objects[int(index)] = {name: Track(keys) for name, keys in tracks.items()}
+
+    #(translate, rotate, scale) of an object at a frame
+    def object_transform(self, index, frame):
+        tracks = self.objects[index]
+        translate = tracks["translate"].at(frame) if "translate" in tracks else (0.0, 0.0, 0.0)
+        rotate = tracks["rotate"].at(frame) if "rotate" in tracks else (0.0, 0.0, 0.0)
+        scale = tracks["scale"].at(frame)[0] if "scale" in tracks else 1.0
+        return translate, rotate, scale
+
+#where an object was placed in the scene, the transforms of the animation are relative to it
+def rest_pose(obj):
+    if isinstance(obj, Sphere):
+        return (obj.center, obj.radius)
+    if isinstance(obj, RectFlat):
+        return (obj.x0, obj.x1, obj.z0, obj.z1, obj.k)
+    if isinstance(obj, Instance):
+        return matrix4(obj.transform)
+    raise TypeError(f"Cannot animate {type(obj).__name__}")
+
+#moves an object to its rest pose transformed by translate, rotate and scale, and updates its box
+def place(obj, rest, translate, rotate, scale):
+    tx, ty, tz = translate
+    if isinstance(obj, Sphere):
+        center, radius = rest
+        r = radius*scale
+        obj.center = Vec3(center.x + tx, center.y + ty, center.z + tz)
+        obj.radius = r
+        obj.bb = BB(Vec3(obj.center.x - r, obj.center.y - r, obj.center.z - r),
+            Vec3(obj.center.x + r, obj.center.y + r, obj.center.z + r))
+    elif isinstance(obj, RectFlat):
+        x0, x1, z0, z1, k = rest
+        obj.x0, obj.x1, obj.z0, obj.z1, obj.k = x0 + tx, x1 + tx, z0 + tz, z1 + tz, k + ty
+        obj.bb = BB(Vec3(obj.x0, obj.k-0.001, obj.z0), Vec3(obj.x1, obj.k+0.001, obj.z1))
+    else:
+        obj.set_transform(Transform(matrix4(Transform.from_trs(translate, rotate, scale)) @ rest))
+
+#4x4 matrix of a Transform
+def matrix4(transform):
+    return np.vstack([np.reshape(transform.matrix, (3, 4)), [0.0, 0.0, 0.0, 1.0]])
+
+#worker loop: renders (frame, build, tile) tasks until the None sentinel is received
+#returns the 8 bit pixels of every tile with its timing and counters
+def animation_worker(rt, render, task_queue, result_queue):
+    #forked workers inherit the parent's random state, reseed so they do not repeat each other's samples
+    random.seed()
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+        frame, build, tile = task
+        update = 0.0
+        if frame != render.frame:
+            start = time.perf_counter()
+            render.set_frame(rt, frame, build)
+            update = time.perf_counter() - start
+
+        started = time.time()
+        start = time.perf_counter()
+        before = rt.counters()
+        color_sum, n = rt.render_tile(tile.j0, tile.j1, tile.i0, tile.i1)
+        pixels = film.tonemap(color_sum, n)
+        stats = metrics.diff_counters(rt.counters(), before)
+        result_queue.put((frame, tile.index, started, time.perf_counter() - start, update, pixels, stats))
+
+class AnimationRender():
+    #frames queued ahead of the oldest frame that is still rendering
+    lookahead = 2
+
+    def __init__(self, rt, animation:Animation, rebuild_threshold=1.5):
+        if rt.denoise:
+            raise ValueError("Animations are rendered without the denoiser")
+        self.rt = rt
+        self.animation = animation
+        self.rebuild_threshold = rebuild_threshold
+        #a world loaded from a packed scene only has a FlatBVH over read only arrays, its tree is built with
+        #the RayTracer's builder at the rest pose, which gives it a FlatBVH of its own to refit
+        if rt.world.use_bb and rt.world.grid is None:
+            rt.world.builder = rt.bvh_builder
+            rt.world.tree()
+        self.rest = {index: rest_pose(rt.world.hittables[index]) for index in animation.objects}
+        self.tiles = make_tiles(rt.image_height, rt.image_width, rt.tile_size)
+        #frame the scene of this process is posed for, and the BVH build it uses
+        self.frame = None
+        self.build = 0
+        #SAH cost of the BVH right after its last build, in the parent
+        self.build_cost = None
+        self.rebuilds = 0
+
+    #poses the camera and the animated objects for a frame, and refits or rebuilds the BVH
+    #build numbers the BVH builds, a worker rebuilds when the parent did
+    def set_frame(self, rt, frame, build):
+        animation = self.animation
+        world = rt.world
+        if "lookfrom" in animation.camera or "lookat" in animation.camera:
+            lookfrom = animation.camera["lookfrom"].at(frame) if "lookfrom" in animation.camera else rt.lookfrom.unwrap()
+            lookat = animation.camera["lookat"].at(frame) if "lookat" in animation.camera else rt.lookat.unwrap()
+            rt.set_camera(Vec3(*lookfrom), Vec3(*lookat))
+        for index, rest in self.rest.items():
+            place(world.hittables[index], rest, *animation.object_transform(index, frame))
+
+        cost = None
+        if self.rest:
+            if build != self.build and world.use_bb and world.grid is None:
+                world.create_BoundingHierarchy(report=False)
+            else:
+                cost = world.refit()
+            if rt.use_wavefront:
+                rt.wavefront.scene = PackedScene.from_world(world)
+        self.frame = frame
+        self.build = build
+        return cost
+
+    #runs in the parent before a frame is queued: poses its copy of the scene and decides between
+    #refitting and rebuilding the BVH, returns the build number for the frame's tasks
+    def prepare(self, frame):
+        rt = self.rt
+        world = rt.world
+        cost = self.set_frame(rt, frame, self.build)
+        if cost is not None and (self.build_cost is None or cost > self.rebuild_threshold*self.build_cost):
+            if self.build_cost is not None:
+                print(f"Frame {frame}: SAH cost {cost:.2f} after refit, {cost/self.build_cost:.2f}x the last build, rebuilding the BVH")
+                self.rebuilds += 1
+            world.create_BoundingHierarchy(report=False)
+            self.build += 1
+            self.build_cost = world.bvh_stats()["sah_cost"]
+        return self.build
+
+    #renders every frame into fname.format(frame), returns the per frame timings
+    def run(self, fname="frame_{:04d}.png", timings_fname=None):
+        rt = self.rt
+        frames = self.animation.frames
+        workers = rt.num_workers or mp.cpu_count()
+        start = time.perf_counter()
+
+        #the cost of a tile is probed once, in the first frame
+        self.prepare(0)
+        for tile in self.tiles:
+            tile.cost = estimate_cost(rt, tile)
+        queue_order = sorted(self.tiles, key=lambda t: t.cost, reverse=True)
+
+        task_queue = mp.Queue()
+        result_queue = mp.Queue()
+        procs = [mp.Process(target=animation_worker, args=(rt, self, task_queue, result_queue)) for _ in range(workers)]
+        gc.freeze()
+        for p in procs:
+            p.start()
+        gc.unfreeze()
+        print(f"Rendering {frames} frames of {rt.image_width}x{rt.image_height} in {len(self.tiles)} tiles on {workers} workers")
+
+        frame_state = {}
+        def queue_frame(frame):
+            prepare_start = time.perf_counter()
+            build = self.prepare(frame) if frame > 0 else self.build
+            frame_state[frame] = {"image": np.zeros((rt.image_height, rt.image_width, 3), dtype=np.uint8),
+                "left": len(self.tiles), "first": None, "last": None, "busy": 0.0, "update": 0.0, "counters": {},
+                "prepare": time.perf_counter() - prepare_start}
+            for tile in queue_order:
+                task_queue.put((frame, build, tile))
+
+        next_frame = 0
+        while next_frame < min(frames, self.lookahead + 1):
+            queue_frame(next_frame)
+            next_frame += 1
+
+        timings = []
+        done = 0
+        while done < frames:
+            frame, index, started, seconds, update, pixels, stats = get_result(result_queue, procs)
+            state = frame_state[frame]
+            tile = self.tiles[index]
+            film.write_tile(state["image"], tile.j0, tile.i0, pixels)
+            state["first"] = started if state["first"] is None else min(state["first"], started)
+            state["last"] = max(state["last"] or 0.0, started + seconds)
+            state["busy"] += seconds
+            state["update"] = max(state["update"], update)
+            metrics.add_counters(state["counters"], stats)
+            state["left"] -= 1
+            if state["left"] > 0:
+                continue
+
+            done += 1
+            del frame_state[frame]
+            out = fname.format(frame)
+            Image.fromarray(state["image"], 'RGB').save(out)
+            timing = {"frame": frame,
+                "seconds": state["last"] - state["first"],
+                "busy_seconds": state["busy"],
+                "update_seconds": state["update"],
+                "prepare_seconds": state["prepare"],
+                "rays_per_second": state["counters"].get("segments", 0) / max(state["last"] - state["first"], 1e-9),
+                "finished": time.perf_counter() - start}
+            timings.append(timing)
+            print(f"Frame {frame} saved to {out}: {timing['seconds']:.2f}s from its first tile to its last, "
+                f"{timing['busy_seconds']:.2f}s of tiles, {1000*timing['update_seconds']:.1f}ms to pose, "
+                f"{timing['rays_per_second']:.0f} rays/sec")
+            if next_frame < frames:
+                queue_frame(next_frame)
+                next_frame += 1
+
+        for _ in procs:
+            task_queue.put(None)
+        for p in procs:
+            p.join()
+
+        wall = time.perf_counter() - start
+        busy = sum(t["busy_seconds"] for t in timings)
+        print(f"Rendered {frames} frames in {wall:.2f}s, {frames/wall:.2f} frames/sec, "
+            f"worker utilization {100*busy/(wall*workers):.1f}%, {self.rebuilds} BVH rebuilds")
+        if timings_fname:
+            with open(timings_fname, "w") as f:
+                json.dump({"frames": frames, "seconds": wall, "workers": workers, "rebuilds": self.rebuilds,
+                    "timings": sorted(timings, key=lambda t: t["frame"])}, f, indent=2)
+            print(f"Frame timings written to {timings_fname}")
+        return timings
+
+#a camera fly around the bench scene with a few spheres bouncing
+def main():
+    parser = argparse.ArgumentParser(description="Render an animated fly around of the sphere scene")
+    parser.add_argument("--frames", type=int, default=24)
+    parser.add_argument("--width", type=int, default=320)
+    parser.add_argument("--spp", type=int, default=16)
+    parser.add_argument("--spheres", type=int, default=40)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--out", default="frames")
+    args = parser.parse_args()
+
+    from bench import bench_scene
+    rt = bench_scene(args.spheres, image_width=args.width, samples_per_pixel=args.spp, num_workers=args.workers)
+    last = args.frames - 1
+    bouncing = {k: {"translate": [(0, (0, 0, 0)), (last/2, (0, 1.5, 0)), (last, (0, 0, 0))]}
+        for k in range(2, min(len(rt.world.hittables), 8))}
+    animation = Animation(args.frames,
+        camera={"lookfrom": [(0, (0, 4, -4)), (last/2, (5, 5, -3)), (last, (8, 4, 2))], "lookat": [(0, (0, 0, 0))]},
+        objects=bouncing)
+
+    os.makedirs(args.out, exist_ok=True)
+    rt.run_animation(animation, os.path.join(args.out, "frame_{:04d}.png"), os.path.join(args.out, "timings.json"))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,364 @@
+'''
+Reproducible benchmark suite
+Every scene is built from a fixed seed, so runs on different commits time the same work:
+    micro benchmarks of the scalar hot path (Vec3/Ray math, Camera.get_ray, BB.hit, Sphere.hit,
+    RectFlat.hit and every Material.scatter) and of batched shading per hit
+    BVH and uniform grid build and traversal times for scenes of increasing size, with the boxes
+    and cells each ray visits
+    end to end renders at a small resolution with the scalar and wavefront engines, in samples/sec
+    the wavefront engine's BVH packet traversal with rays in pixel order and reordered, with the
+    packet node visits and ray box tests per ray
+Results can be saved as a JSON baseline and later runs compared against it. A golden image check
+renders a fixed scene and compares it with a reference image using a noise tolerant metric
+(the error of 8x8 block averages), so a change that breaks shading fails even though every run is noisy.
+An animation check renders a few frames of scene.json loaded from its compiled form and built from its
+description, with a fixed sample pattern the frames must be identical.
+
+    python3 bench.py                            run everything and print the results
+    python3 bench.py --quick                    only the smaller scenes
+    python3 bench.py --save baseline.json       also store the results
+    python3 bench.py --compare baseline.json    report the change against a stored run
+    python3 bench.py --update-golden            re-render the reference image
+'''
+
+import argparse
+import contextlib
+import io
+import json
+import math
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import numpy as np
+from PIL import Image
+from util import *
+from camera import *
+from objects import *
+
+SCENE_SIZES = [40, 200, 1000, 4000]
+QUICK_SIZES = [40, 200]
+GOLDEN = "bench_golden.png"
+#largest allowed block error against the golden image, in 8 bit levels
+GOLDEN_TOLERANCE = 4.0
+#slowdown against the baseline that counts as a regression
+REGRESSION = 0.15
+
+#best time per call in microseconds over a few repeats
+def timeit(fn, number=20000, repeat=5):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None or elapsed < best else best
+    return 1e6*best/number
+
+#a RayTracer with the benchmark camera and num_spheres spheres placed from a fixed seed
+#up to 40 spheres use the layout of main.build_scene, larger scenes put one sphere in every
+#cell of a grid over the same floor, so the image keeps covering the same area as spheres are added
+def bench_scene(num_spheres, seed=1, **settings):
+    from main import RayTracer, build_scene
+    random.seed(seed)
+    rt = RayTracer(Vec3(0,0,0), Vec3(0,4,-4), headless=True, **settings)
+    with contextlib.redirect_stdout(io.StringIO()):
+        add_bench_objects(rt, num_spheres, build_scene)
+        rt.finalize()
+    return rt
+
+def add_bench_objects(rt, num_spheres, build_scene):
+    if num_spheres <= 40:
+        build_scene(rt, num_spheres)
+    else:
+        rt.add_object(RectFlat(-10, 10, -4, 10, 0, Lambertian(Texture("wood.jpg"))))
+        cols = math.ceil(math.sqrt(num_spheres*20/14))
+        rows = math.ceil(num_spheres/cols)
+        cell = min(20/cols, 14/rows)
+        for k in range(num_spheres):
+            radius = cell*random.uniform(0.2, 0.45)
+            x = -10 + cell*(k % cols + 0.5) + random.uniform(-1, 1)*(cell/2 - radius)
+            z = -4 + cell*(k // cols + 0.5) + random.uniform(-1, 1)*(cell/2 - radius)
+            material = random.choice([Metal, Dielectric, Lambertian])()
+            rt.add_object(Sphere(Vec3(x, radius, z), radius, material))
+
+def micro_benchmarks():
+    random.seed(1)
+    camera = Camera(Vec3(0,4,-4), Vec3(0,0,0), Vec3(0,1,0), 80, 16.0/9.0)
+    ray = Ray(Vec3(0,4,-4), Vec3(0.01,-0.5,1))
+    a = Vec3(0.3, -0.2, 0.9)
+    b = Vec3(-0.1, 0.7, 0.4)
+    sphere = Sphere(Vec3(0, 2, 0), 2, Lambertian())
+    rect = RectFlat(-10, 10, -4, 10, 0, Lambertian())
+    floor_ray = camera.get_ray(0.47, 0.1)
+
+    collision = CollisionPacket()
+    assert sphere.hit(ray, 0.001, 99999, collision)
+    lambertian = Lambertian()
+    metal = Metal()
+    dielectric = Dielectric()
+
+    return {
+        "Vec3 a + b*t": timeit(lambda: a + b*0.5),
+        "Vec3 dot": timeit(lambda: Vec3.dot(a, b)),
+        "Vec3 unit_length": timeit(lambda: a.unit_length()),
+        "Ray()": timeit(lambda: Ray(a, b)),
+        "Ray.at": timeit(lambda: ray.at(1.5)),
+        "Camera.get_ray": timeit(lambda: camera.get_ray(0.3, 0.6)),
+        "BB.hit": timeit(lambda: sphere.bb.hit(ray, 0.001, 99999)),
+        "Sphere.hit": timeit(lambda: sphere.hit(ray, 0.001, 99999, CollisionPacket())),
+        "RectFlat.hit": timeit(lambda: rect.hit(floor_ray, 0.001, 99999, CollisionPacket())),
+        "Lambertian.scatter": timeit(lambda: lambertian.scatter(ray, collision)),
+        "Metal.scatter": timeit(lambda: metal.scatter(ray, collision)),
+        "Dielectric.scatter": timeit(lambda: dielectric.scatter(ray, collision)),
+    }
+
+#time per hit of shading.shade on a batch of hits spread over the materials of the default scene
+def shading_benchmark(hits=4096):
+    import shading
+    from packed import PackedScene
+    rt = bench_scene(40)
+    scene = PackedScene.from_world(rt.world)
+    rng = np.random.default_rng(1)
+    normal = rng.standard_normal((hits, 3))
+    normal /= np.linalg.norm(normal, axis=1)[:, None]
+    records = shading.HitRecords(rng.random((hits, 3)), normal, rng.random(hits) < 0.5, rng.random(hits),
+        rng.random(hits), rng.integers(0, len(scene.mat_type), hits).astype(np.int32))
+    directions = rng.standard_normal((hits, 3))
+    samples = lambda idx: rng.random((2, len(idx)))
+    return timeit(lambda: shading.shade(scene, records, directions, samples), 20)/hits
+
+#time per full jittered sample through the default 40 sphere scene
+def sample_benchmark(samples=3000):
+    rt = bench_scene(40, image_width=160)
+    random.seed(2)
+    start = time.perf_counter()
+    for k in range(samples):
+        rt.sample_color(k % rt.image_width, (k // rt.image_width) % rt.image_height)
+    return 1e6*(time.perf_counter() - start)/samples
+
+#BVH build time with each builder and the grid build time (ms), closest hit time per camera ray
+#with each BVH traversal and the grid (us), and the boxes or cells visited per ray
+#times are the best of a few repeats, like timeit, results are name -> (value, unit)
+def bvh_benchmarks(num_spheres, rays=2000, repeat=3):
+    rt = bench_scene(num_spheres, use_BVH=False)
+    random.seed(3)
+    camera_rays = [rt.camera.get_ray(random.random(), random.random()) for _ in range(rays)]
+    results = {}
+    def traverse_with(world):
+        def traverse():
+            for ray in camera_rays:
+                world.hit(ray, 0.001, CollisionPacket())
+        return traverse
+
+    for builder in ("bottom_up", "sah"):
+        world = World(True, builder)
+        world.hittables = rt.world.hittables
+        def build():
+            with contextlib.redirect_stdout(io.StringIO()):
+                world.create_BoundingHierarchy()
+        results[f"BVH build {builder} {num_spheres}"] = (timeit(build, 1, repeat)/1e3, "ms")
+
+        for traversal in ("flat", "tree"):
+            world.traversal = traversal
+            results[f"BVH {traversal} {builder} {num_spheres}"] = (timeit(traverse_with(world), 1, repeat)/rays, "us")
+        world.traversal = "flat"
+        visits = world.flat_bvh.node_visits
+        before = attribute_counts(world)
+        traverse_with(world)()
+        results[f"BVH box tests {builder} {num_spheres}"] = ((world.flat_bvh.node_visits - visits)/rays, "per ray")
+        results.update(attribute_results(f"BVH {builder} {num_spheres}", world, before, rays))
+
+    world = World(False)
+    world.hittables = rt.world.hittables
+    def build_grid():
+        with contextlib.redirect_stdout(io.StringIO()):
+            world.create_grid()
+    results[f"grid build {num_spheres}"] = (timeit(build_grid, 1, repeat)/1e3, "ms")
+    results[f"grid {num_spheres}"] = (timeit(traverse_with(world), 1, repeat)/rays, "us")
+    visits = world.grid.cell_visits
+    before = attribute_counts(world)
+    traverse_with(world)()
+    results[f"grid cell visits {num_spheres}"] = ((world.grid.cell_visits - visits)/rays, "per ray")
+    results.update(attribute_results(f"grid {num_spheres}", world, before, rays))
+    return results
+
+#primitive tests, hits closer than the ones before them and attribute fills of a World so far
+def attribute_counts(world):
+    return (world.count, world.closer_hits, world.fills)
+
+#primitive tests per ray against the attribute computations of the two phase intersection, and the ones
+#a single phase intersection would have done (one for every closer hit)
+def attribute_results(name, world, before, rays):
+    tests, closer, fills = (after - b for after, b in zip(attribute_counts(world), before))
+    return {f"{name} prim tests": (tests/rays, "per ray"),
+        f"{name} attribute computations": (fills/rays, "per ray"),
+        f"{name} single phase attribute computations": (closer/rays, "per ray")}
+
+#samples per second of a small single process render with the scalar and wavefront engines
+#both render the same strip through the middle of the image, to keep large scenes quick
+def render_benchmarks(num_spheres, width=160, samples=4):
+    results = {}
+    for engine in ("scalar", "wavefront"):
+        rt = bench_scene(num_spheres, image_width=width, use_wavefront=engine == "wavefront")
+        random.seed(4)
+        if engine == "wavefront":
+            rt.wavefront.seed = 4
+        j0 = rt.image_height*3 // 8
+        j1 = rt.image_height*4 // 8
+        start = time.perf_counter()
+        rt.color_sum_tile(j0, j1, 0, rt.image_width, samples)
+        results[f"render {engine} {num_spheres}"] = (j1-j0)*rt.image_width*samples / (time.perf_counter() - start)
+    return results
+
+#the wavefront engine walking an SAH BVH with packets of packet_size rays, with the rays of every bounce
+#in pixel order and sorted by coherence.ray_order, on the same strip as render_benchmarks
+def packet_benchmarks(num_spheres, width=160, samples=4, packet_size=8):
+    results = {}
+    for reorder in (False, True):
+        rt = bench_scene(num_spheres, image_width=width, use_wavefront=True, bvh_builder="sah",
+            packet_size=packet_size, reorder_rays=reorder)
+        rt.wavefront.seed = 4
+        #time the packets even below the size the engine would switch to them at
+        rt.wavefront.packet_min_primitives = 0
+        j0 = rt.image_height*3 // 8
+        j1 = rt.image_height*4 // 8
+        start = time.perf_counter()
+        rt.color_sum_tile(j0, j1, 0, rt.image_width, samples)
+        seconds = time.perf_counter() - start
+        counters = rt.counters()
+        order = "reordered" if reorder else "pixel order"
+        results[f"render packets {order} {num_spheres}"] = ((j1-j0)*rt.image_width*samples / seconds, "samples/s")
+        results[f"packet node visits {order} {num_spheres}"] = (counters["node_visits"] / counters["segments"], "per ray")
+        results[f"packet box tests {order} {num_spheres}"] = (counters["box_tests"] / counters["segments"], "per ray")
+    return results
+
+#the golden scene: 40 spheres rendered with the wavefront engine from fixed seeds
+def render_golden(width=160, samples=64):
+    rt = bench_scene(40, image_width=width, samples_per_pixel=samples, use_wavefront=True)
+    rt.wavefront.seed = 5
+    arr = np.zeros((rt.image_height, rt.image_width, 3), dtype=np.uint8)
+    rt.color_tile(0, rt.image_height, 0, rt.image_width, arr)
+    return arr
+
+#root mean square difference of the block x block averages of two 8 bit images
+#averaging blocks removes most of the per pixel sampling noise but keeps any real change in shading
+def image_error(a, b, block=8):
+    if a.shape != b.shape:
+        raise ValueError(f"Image sizes differ: {a.shape} and {b.shape}")
+    h = a.shape[0] // block * block
+    w = a.shape[1] // block * block
+    def blocks(img):
+        img = img[:h, :w].astype(np.float64)
+        return img.reshape((h//block, block, w//block, block, 3)).mean(axis=(1, 3))
+    return float(np.sqrt(np.mean((blocks(a) - blocks(b))**2)))
+
+#renders the golden scene and compares it with the reference, returns (error, passed)
+def golden_check(fname=GOLDEN, tolerance=GOLDEN_TOLERANCE):
+    reference = np.asarray(Image.open(fname).convert("RGB"))
+    error = image_error(render_golden(), reference)
+    return error, error <= tolerance
+
+#animates a scene loaded from its compiled scene file and the same scene built from its description,
+#every frame has to come out the same, returns the largest pixel difference and whether it is zero
+def animation_check(fname="scene.json", frames=3, width=48, samples=2):
+    from scenefile import load_scene
+    from animation import Animation
+    animation = Animation(frames, camera={"lookfrom": [(0, (0, 4, -4)), (frames - 1, (1, 4, -4))]},
+        objects={3: {"translate": [(0, (0, 0, 0)), (frames - 1, (0, 1, 0))]}})
+    images = []
+    with tempfile.TemporaryDirectory() as directory:
+        for compiled in (True, False):
+            with contextlib.redirect_stdout(io.StringIO()):
+                #the first load compiles the scene file, the second reads it back as a PackedScene
+                load_scene(fname, compiled, image_width=width, samples_per_pixel=samples)
+                rt = load_scene(fname, compiled, image_width=width, samples_per_pixel=samples,
+                    sample_pattern="sobol", headless=True, num_workers=2)
+                out = os.path.join(directory, f"{compiled}_{{:04d}}.png")
+                rt.run_animation(animation, out)
+            images.append([np.asarray(Image.open(out.format(frame)), dtype=np.int32) for frame in range(frames)])
+    error = max(int(np.abs(a - b).max()) for a, b in zip(*images))
+    return error, error == 0
+
+#results are name -> (value, unit), "us" and "ms" are times and "per ray" counts of work (lower is better),
+#"samples/s" is a rate
+def run_all(sizes):
+    results = {}
+    for name, us in micro_benchmarks().items():
+        results[name] = (us, "us")
+    results["shade batch per hit"] = (shading_benchmark(), "us")
+    results["full sample"] = (sample_benchmark(), "us")
+    for n in sizes:
+        results.update(bvh_benchmarks(n))
+        for name, value in render_benchmarks(n).items():
+            results[name] = (value, "samples/s")
+        results.update(packet_benchmarks(n))
+    return results
+
+#relative change of every result against a baseline, positive is faster
+def compare(results, baseline):
+    changes = {}
+    for name, (value, unit) in results.items():
+        if name not in baseline:
+            continue
+        old = baseline[name][0]
+        if unit == "samples/s":
+            changes[name] = value/old - 1
+        else:
+            changes[name] = old/value - 1
+    return changes
+
+def save(fname, results):
+    with open(fname, "w") as f:
+        json.dump({
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "results": {name: [value, unit] for name, (value, unit) in results.items()},
+        }, f, indent=2)
+    print(f"Results saved to {fname}")
+
+def load(fname):
+    with open(fname) as f:
+        return json.load(f)["results"]
+
+def main():
+    parser = argparse.ArgumentParser(description="Raytracer benchmarks")
+    parser.add_argument("--quick", action="store_true", help="only the smaller scenes")
+    parser.add_argument("--save", metavar="FILE", help="store the results as a JSON baseline")
+    parser.add_argument("--compare", metavar="FILE", help="compare against a stored baseline")
+    parser.add_argument("--golden", metavar="FILE", default=GOLDEN, help="reference image for the golden check")
+    parser.add_argument("--update-golden", action="store_true", help="re-render the reference image")
+    args = parser.parse_args()
+
+    if args.update_golden:
+        Image.fromarray(render_golden(), 'RGB').save(args.golden)
+        print(f"Golden image written to {args.golden}")
+        return 0
+
+    results = run_all(QUICK_SIZES if args.quick else SCENE_SIZES)
+    changes = compare(results, load(args.compare)) if args.compare else {}
+    regressions = []
+    for name, (value, unit) in results.items():
+        line = f"{name:32s} {value:12.3f} {unit}"
+        if name in changes:
+            line += f"  {100*changes[name]:+6.1f}%"
+            if changes[name] < -REGRESSION:
+                line += "  REGRESSION"
+                regressions.append(name)
+        print(line)
+
+    error, passed = golden_check(args.golden)
+    print(f"golden image error {error:.2f} (tolerance {GOLDEN_TOLERANCE}): {'ok' if passed else 'FAILED'}")
+    animation_error, animation_passed = animation_check()
+    print(f"animation of a loaded scene, largest difference {animation_error}: {'ok' if animation_passed else 'FAILED'}")
+
+    if args.save:
+        save(args.save, results)
+    if regressions:
+        print(f"{len(regressions)} results are more than {100*REGRESSION:.0f}% slower than {args.compare}")
+    return 0 if passed and animation_passed and not regressions else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,34 +1,52 @@
 
 from util import *
-import objects
+from array import array
 
 #Bounding box classes
 #BVH_node: a node within bounding hierachy tree
 class BVH_node():
+    visits = 0
+
     def __init__(self, bb, left, right):
         self.left = left
         self.right = right
         self.bb = bb
+        #split children into subtrees and objects once, so hit does not have to check types per ray
+        children = [c for c in (left, right) if c is not None]
+        self.child_nodes = [c for c in children if isinstance(c, BVH_node)]
+        self.child_objs = [c for c in children if not isinstance(c, BVH_node)]
+
     #does the ray hit this BVH node's box? If yes search its children
     def hit(self, ray, t_min, t_max, obj_list):
+        BVH_node.visits += 1
         if self.bb.hit(ray, t_min, t_max):
-            if self.left is not None:
-                if isinstance(self.left, BVH_node):
-                    self.left.hit(ray, t_min, t_max, obj_list)
-                elif isinstance(self.left, objects.Object):
-                    if self.left.bb.hit(ray, t_min, t_max):
-                        obj_list.append(self.left)
-
-            if self.right is not None:
-                if isinstance(self.right, BVH_node):
-                    self.right.hit(ray, t_min, t_max, obj_list)
-                elif isinstance(self.right, objects.Object):
-                    if self.right.bb.hit(ray, t_min, t_max):
-                        obj_list.append(self.right)
+            for node in self.child_nodes:
+                node.hit(ray, t_min, t_max, obj_list)
+            BVH_node.visits += len(self.child_objs)
+            for obj in self.child_objs:
+                if obj.bb.hit(ray, t_min, t_max):
+                    obj_list.append(obj)
 
     def __str__(self):
         return f"BVH_node: {self.bb} , \n \tleft {self.left} \n\tright {self.right}"
 
+#BVH_leaf: a node holding more than two objects, created by builders with a leaf size above 2
+class BVH_leaf(BVH_node):
+    def __init__(self, bb, objs):
+        BVH_node.__init__(self, bb, None, None)
+        self.objs = objs
+
+    def hit(self, ray, t_min, t_max, obj_list):
+        BVH_node.visits += 1
+        if self.bb.hit(ray, t_min, t_max):
+            BVH_node.visits += len(self.objs)
+            for obj in self.objs:
+                if obj.bb.hit(ray, t_min, t_max):
+                    obj_list.append(obj)
+
+    def __str__(self):
+        return f"BVH_leaf: {self.bb} , {len(self.objs)} objects"
+
 #the acutal bounding box, always an attribute to an object or BVH node
 class BB():
     def __init__(self, minv, maxv):
@@ -36,19 +54,346 @@ class BB():
         self.maxv = maxv
 
     def hit(self, ray, t_min, t_max):
-        for a in range(0,3):
-            x = (self.minv[a] - ray.origin[a]) / ray.direction[a]
-            y = (self.maxv[a] - ray.origin[a]) / ray.direction[a]
+        o = ray.origin
+        d = ray.direction
+        minv = self.minv
+        maxv = self.maxv
 
-            t0 = min(x,y)
-            t1 = max(x,y)
+        x = (minv.x - o.x) / d.x
+        y = (maxv.x - o.x) / d.x
+        if x > y: x, y = y, x
+        if x > t_min: t_min = x
+        if y < t_max: t_max = y
+        if t_max <= t_min:
+            return False
 
-            t_min = max(t0, t_min)
-            t_max = min(t1, t_max)
+        x = (minv.y - o.y) / d.y
+        y = (maxv.y - o.y) / d.y
+        if x > y: x, y = y, x
+        if x > t_min: t_min = x
+        if y < t_max: t_max = y
+        if t_max <= t_min:
+            return False
 
-            if t_max <= t_min:
-                return False
+        x = (minv.z - o.z) / d.z
+        y = (maxv.z - o.z) / d.z
+        if x > y: x, y = y, x
+        if x > t_min: t_min = x
+        if y < t_max: t_max = y
+        if t_max <= t_min:
+            return False
         return True
 
+    def surface_area(self):
+        d = self.maxv - self.minv
+        return 2*(d.x*d.y + d.y*d.z + d.z*d.x)
+
+    def centroid(self):
+        return (self.minv + self.maxv)*0.5
+
     def __str__(self):
-        return f"BB: {self.minv} , {self.maxv}"
\ No newline at end of file
+        return f"BB: {self.minv} , {self.maxv}"
+
+#smallest box containing both boxes
+def surrounding_box(b0, b1):
+    small = Vec3(
+        min(b0.minv.x, b1.minv.x),
+        min(b0.minv.y, b1.minv.y),
+        min(b0.minv.z, b1.minv.z))
+    big = Vec3(
+        max(b0.maxv.x, b1.maxv.x),
+        max(b0.maxv.y, b1.maxv.y),
+        max(b0.maxv.z, b1.maxv.z))
+    return BB(small, big)
+
+#smallest box containing every object in objs
+def bounds_of(objs):
+    box = objs[0].bb
+    for o in objs[1:]:
+        box = surrounding_box(box, o.bb)
+    return box
+
+#recomputes the boxes of a tree of BVH_nodes bottom up from the current boxes of its objects,
+#after objects moved, keeping the tree's shape. Returns the root's box
+def refit_tree(node):
+    if not isinstance(node, BVH_node):
+        return node.bb
+    if isinstance(node, BVH_leaf):
+        node.bb = bounds_of(node.objs)
+        return node.bb
+    boxes = [refit_tree(c) for c in (node.left, node.right) if c is not None]
+    if boxes:
+        node.bb = boxes[0] if len(boxes) == 1 else surrounding_box(boxes[0], boxes[1])
+    return node.bb
+
+#top down BVH using the binned surface area heuristic
+#objects are split on the axis where their centroids spread the most,
+#at the bucket boundary with the lowest estimated traversal cost
+#returns a single object if objs has one element, otherwise a BVH_node
+def build_sah(objs, leaf_size=2, buckets=12, c_trav=1.0, c_isect=1.0):
+    if len(objs) == 1:
+        return objs[0]
+
+    box = bounds_of(objs)
+    if len(objs) <= leaf_size:
+        if len(objs) == 2:
+            return BVH_node(box, objs[0], objs[1])
+        return BVH_leaf(box, objs)
+
+    centroids = [o.bb.centroid() for o in objs]
+    cmin = [min(c[a] for c in centroids) for a in range(3)]
+    cmax = [max(c[a] for c in centroids) for a in range(3)]
+    extent = [cmax[a] - cmin[a] for a in range(3)]
+    axis = extent.index(max(extent))
+
+    split = None
+    if extent[axis] > 0:
+        #drop each object into a bucket along the split axis
+        bucket_of = [min(buckets-1, int(buckets*(c[axis] - cmin[axis]) / extent[axis])) for c in centroids]
+        counts = [0]*buckets
+        boxes = [None]*buckets
+        for o, b in zip(objs, bucket_of):
+            counts[b] += 1
+            boxes[b] = o.bb if boxes[b] is None else surrounding_box(boxes[b], o.bb)
+
+        #sweep the bucket boundaries, costing each candidate split
+        area = box.surface_area()
+        best_cost = None
+        for i in range(1, buckets):
+            left = [b for b in boxes[:i] if b is not None]
+            right = [b for b in boxes[i:] if b is not None]
+            if not left or not right:
+                continue
+            left_box = left[0]
+            for b in left[1:]:
+                left_box = surrounding_box(left_box, b)
+            right_box = right[0]
+            for b in right[1:]:
+                right_box = surrounding_box(right_box, b)
+            cost = c_trav + c_isect*(sum(counts[:i])*left_box.surface_area()
+                + sum(counts[i:])*right_box.surface_area()) / max(area, 1e-12)
+            if best_cost is None or cost < best_cost:
+                best_cost = cost
+                split = i
+
+    if split is None:
+        #all centroids coincide, fall back to an even split
+        ordered = sorted(objs, key=lambda o: o.bb.centroid()[axis])
+        mid = len(ordered)//2
+        left_objs, right_objs = ordered[:mid], ordered[mid:]
+    else:
+        left_objs = [o for o, b in zip(objs, bucket_of) if b < split]
+        right_objs = [o for o, b in zip(objs, bucket_of) if b >= split]
+
+    left = build_sah(left_objs, leaf_size, buckets, c_trav, c_isect)
+    right = build_sah(right_objs, leaf_size, buckets, c_trav, c_isect)
+    return BVH_node(box, left, right)
+
+#depth, node count and SAH cost of a tree built from BVH_nodes
+#the SAH cost is the expected cost of a random ray hitting the root box:
+#every node is weighted by the ratio of its surface area to the root's
+def bvh_stats(root, c_trav=1.0, c_isect=1.0):
+    stats = {"nodes": 0, "leaves": 0, "depth": 0, "sah_cost": 0.0}
+    root_area = max(root.bb.surface_area(), 1e-12)
+
+    def visit(node, depth):
+        stats["nodes"] += 1
+        stats["depth"] = max(stats["depth"], depth)
+        weight = node.bb.surface_area() / root_area
+        stats["sah_cost"] += c_trav*weight
+        if isinstance(node, BVH_leaf):
+            stats["leaves"] += 1
+            stats["sah_cost"] += c_isect*weight*len(node.objs)
+            return
+        children = [c for c in (node.left, node.right) if c is not None]
+        if any(not isinstance(c, BVH_node) for c in children):
+            stats["leaves"] += 1
+        for c in children:
+            if isinstance(c, BVH_node):
+                visit(c, depth+1)
+            else:
+                stats["sah_cost"] += c_isect*weight
+
+    visit(root, 1)
+    return stats
+
+#BVH compiled into flat arrays, in depth first order
+#node i stores its box in bounds[6*i:6*i+6] as (min x, min y, min z, max x, max y, max z)
+#interior nodes: count is 0, the first child is node i+1 and offset is the second child,
+#                the first child is the one lower along axis
+#leaf nodes: the objects are prims[offset:offset+count]
+class FlatBVH():
+    def __init__(self, bounds, offset, count, axis, prims):
+        self.bounds = bounds
+        self.offset = offset
+        self.count = count
+        self.axis = axis
+        self.prims = prims
+        #node_visits counts box tests, nodes_entered the boxes the ray actually passed through
+        self.node_visits = 0
+        self.nodes_entered = 0
+        self.prim_tests = 0
+        #hits closer than every object tested before them: the attributes a single phase
+        #intersection would have computed
+        self.closer_hits = 0
+
+    def __len__(self):
+        return len(self.count)
+
+    #compiles a tree of BVH_nodes (from either builder) into flat arrays
+    @classmethod
+    def from_tree(cls, root):
+        bounds = array('d')
+        offset = array('i')
+        count = array('i')
+        axis = array('b')
+        prims = []
+
+        def add_node(bb):
+            bounds.extend((bb.minv.x, bb.minv.y, bb.minv.z, bb.maxv.x, bb.maxv.y, bb.maxv.z))
+            offset.append(0)
+            count.append(0)
+            axis.append(0)
+            return len(count) - 1
+
+        def add_leaf(bb, objs):
+            i = add_node(bb)
+            offset[i] = len(prims)
+            count[i] = len(objs)
+            prims.extend(objs)
+
+        def emit(node):
+            if not isinstance(node, BVH_node):
+                add_leaf(node.bb, [node])
+                return
+            if isinstance(node, BVH_leaf):
+                add_leaf(node.bb, node.objs)
+                return
+            children = [c for c in (node.left, node.right) if c is not None]
+            #objects keep their own leaf, so their box is tested before the object itself
+            if len(children) < 2:
+                emit(children[0])
+                return
+
+            first, second = children
+            c0 = first.bb.centroid()
+            c1 = second.bb.centroid()
+            split = max(range(3), key=lambda a: abs(c1[a] - c0[a]))
+            if c1[split] < c0[split]:
+                first, second = second, first
+
+            i = add_node(node.bb)
+            axis[i] = split
+            emit(first)
+            offset[i] = len(count)
+            emit(second)
+
+        if root.left is None and root.right is None and not isinstance(root, BVH_leaf):
+            add_leaf(root.bb, [])
+        else:
+            emit(root)
+        return cls(bounds, offset, count, axis, prims)
+
+    #recomputes every box from the current boxes of the objects, keeping the order of the nodes
+    #children are stored after their parent, so one backwards pass sees them before the parent
+    #(the axis of each interior node is kept, so near child first order may be off until a rebuild)
+    def refit(self):
+        bounds = self.bounds
+        offset = self.offset
+        count = self.count
+        prims = self.prims
+        if not prims:
+            return
+        for i in range(len(count) - 1, -1, -1):
+            if count[i]:
+                objs = prims[offset[i]:offset[i]+count[i]]
+                box = (min(o.bb.minv.x for o in objs), min(o.bb.minv.y for o in objs), min(o.bb.minv.z for o in objs),
+                    max(o.bb.maxv.x for o in objs), max(o.bb.maxv.y for o in objs), max(o.bb.maxv.z for o in objs))
+            else:
+                a = 6*(i + 1)
+                b = 6*offset[i]
+                box = (min(bounds[a], bounds[b]), min(bounds[a+1], bounds[b+1]), min(bounds[a+2], bounds[b+2]),
+                    max(bounds[a+3], bounds[b+3]), max(bounds[a+4], bounds[b+4]), max(bounds[a+5], bounds[b+5]))
+            bounds[6*i:6*i+6] = array('d', box)
+
+    #closest hit along the ray, or False
+    def hit(self, ray, t_min, t_max, collision_packet):
+        obj, t, payload = self.closest(ray, t_min, t_max)
+        if obj:
+            obj.fill(ray, t, payload, collision_packet)
+        return obj
+
+    #closest object along the ray, its distance and the payload its hit_t returned, (False, t_max, None)
+    #for a miss. Only distances are computed (see Object.hit_t), the caller fills in the winner's attributes
+    #visits the nearer child first and shrinks t_max as soon as an object is hit,
+    #so subtrees behind the closest hit are skipped
+    def closest(self, ray, t_min, t_max):
+        bounds = self.bounds
+        offset = self.offset
+        count = self.count
+        axis = self.axis
+        prims = self.prims
+
+        o = ray.origin
+        d = ray.direction
+        ox, oy, oz = o.x, o.y, o.z
+        dx, dy, dz = d.x, d.y, d.z
+        ix = 1.0/dx if dx != 0.0 else 1e300
+        iy = 1.0/dy if dy != 0.0 else 1e300
+        iz = 1.0/dz if dz != 0.0 else 1e300
+        dir_neg = (dx < 0.0, dy < 0.0, dz < 0.0)
+
+        hit_obj = False
+        payload = None
+        visits = 0
+        entered = 0
+        tests = 0
+        closer = 0
+        stack = [0]
+        while stack:
+            i = stack.pop()
+            visits += 1
+            b = 6*i
+
+            t0 = (bounds[b] - ox)*ix
+            t1 = (bounds[b+3] - ox)*ix
+            if t0 > t1: t0, t1 = t1, t0
+            lo = t0 if t0 > t_min else t_min
+            hi = t1 if t1 < t_max else t_max
+            if hi <= lo: continue
+            t0 = (bounds[b+1] - oy)*iy
+            t1 = (bounds[b+4] - oy)*iy
+            if t0 > t1: t0, t1 = t1, t0
+            if t0 > lo: lo = t0
+            if t1 < hi: hi = t1
+            if hi <= lo: continue
+            t0 = (bounds[b+2] - oz)*iz
+            t1 = (bounds[b+5] - oz)*iz
+            if t0 > t1: t0, t1 = t1, t0
+            if t0 > lo: lo = t0
+            if t1 < hi: hi = t1
+            if hi <= lo: continue
+            entered += 1
+
+            n = count[i]
+            if n:
+                start = offset[i]
+                for obj in prims[start:start+n]:
+                    tests += 1
+                    hit = obj.hit_t(ray, t_min, t_max)
+                    if hit is not None:
+                        hit_obj = obj
+                        t_max, payload = hit
+                        closer += 1
+            elif dir_neg[axis[i]]:
+                stack.append(i+1)
+                stack.append(offset[i])
+            else:
+                stack.append(offset[i])
+                stack.append(i+1)
+
+        self.node_visits += visits
+        self.nodes_entered += entered
+        self.prim_tests += tests
+        self.closer_hits += closer
+        return hit_obj, t_max, payload
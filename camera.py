@@ -1,4 +1,5 @@
 from util import *
+import numpy as np
 
 #A moveable camera class
 #The camera generates rays that are shot into the world
@@ -17,6 +18,10 @@ class Camera():
         u = Vec3.cross(vup, w).unit_length()
         v = Vec3.cross(w, u)
 
+        self.viewport_height = viewport_height
+        #angle covered by one pixel, set with set_resolution
+        self.pixel_spread = 0.0
+
         self.origin = lookfrom
         self.horizontal = viewport_width * u
         self.vertical = viewport_height * v
@@ -30,5 +35,27 @@ class Camera():
 
     #returns a ray to a coordinate in the display plane
     def get_ray(self, u, v):
-        direction = (self.lower_left_corner + self.horizontal*u + self.vertical*v) - self.origin
-        return Ray(self.origin, direction)
+        c = self.lower_left_corner
+        o = self.origin
+        h = self.horizontal
+        w = self.vertical
+        direction = Vec3(c.x + h.x*u + w.x*v - o.x,
+            c.y + h.y*u + w.y*v - o.y,
+            c.z + h.z*u + w.z*v - o.z)
+        return Ray(o, direction, self.pixel_spread)
+
+    #sets pixel_spread for an image this many pixels tall
+    def set_resolution(self, image_height):
+        self.pixel_spread = self.viewport_height / image_height
+
+    #vectorized get_ray: u and v are arrays of display plane coordinates
+    #returns the ray origins and directions as (n, 3) arrays
+    def get_rays(self, u, v):
+        u = np.asarray(u, dtype=np.float64)[:, None]
+        v = np.asarray(v, dtype=np.float64)[:, None]
+        origin = np.array(self.origin.unwrap(), dtype=np.float64)
+        direction = (np.array(self.lower_left_corner.unwrap(), dtype=np.float64) - origin
+            + np.array(self.horizontal.unwrap(), dtype=np.float64)*u
+            + np.array(self.vertical.unwrap(), dtype=np.float64)*v)
+        origins = np.broadcast_to(origin, direction.shape).copy()
+        return origins, direction
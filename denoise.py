@@ -0,0 +1,259 @@
+'''
+Feature buffers and an edge avoiding a-trous denoiser
+With denoise = True in RayTracer every tile is rendered into float buffers next to the image:
+    color       average linear color of the pixel's samples
+    variance    variance of the luminance of that average, from the difference of two halves of
+                the samples rendered as separate streams (the spatial variance for one sample)
+    albedo      first hit albedo, Color.value of the first surface (1 for the sky and glass)
+    normal      first hit normal, against the camera ray (0 for the sky)
+    depth       first hit distance t along the camera ray
+The features come from feature_samples rays per pixel on a regular grid, so they are free of noise.
+Once all tiles are done, the frame is filtered as a whole: the color is divided by the albedo,
+the remaining irradiance is smoothed by iterations of the 5x5 a-trous wavelet filter with holes
+growing as 1, 2, 4, ... pixels, and multiplied by the albedo again (textures stay sharp). Every tap
+is weighted down by the difference in normal, depth and luminance, the last relative to the
+pixel's standard deviation, so edges and real detail are kept while noise is averaged away
+(Dammertz et al. 2010, Schied et al. 2017).
+
+    python3 denoise.py --spp 4 16 64 --reference 1024     quality of denoised against noisy renders
+'''
+
+import argparse
+import json
+import time
+import numpy as np
+from PIL import Image
+from util import *
+from objects import *
+import film
+
+LUMINANCE = np.array([0.2126, 0.7152, 0.0722])
+#floats per pixel in the shared feature buffer, in this order
+AOV_CHANNELS = {"color": 3, "variance": 1, "albedo": 3, "normal": 3, "depth": 1}
+AOV_SIZE = sum(AOV_CHANNELS.values())
+#B3 spline kernel of the a-trous filter
+KERNEL = np.array([1/16, 1/4, 3/8, 1/4, 1/16])
+#depth of a pixel that sees the sky
+SKY_DEPTH = 1e4
+
+#named (height, width, channels) views into the flat buffer of every pixel's features, in image orientation
+def aov_views(buf, height, width):
+    arr = np.frombuffer(buf, dtype=np.float32).reshape((height, width, AOV_SIZE))
+    views = {}
+    start = 0
+    for name, size in AOV_CHANNELS.items():
+        views[name] = arr[:, :, start:start + size]
+        start += size
+    return views
+
+#renders a tile into the feature buffers and returns its summed color and samples per pixel like render_tile
+def render_tile(rt, buffers, j0, j1, i0, i1):
+    samples = rt.samples_per_pixel
+    first = samples // 2
+    if first == 0:
+        color_sum = rt.color_sum_tile(j0, j1, i0, i1, samples)
+        mean = color_sum / samples
+        variance = spatial_variance(mean @ LUMINANCE)
+    else:
+        sum_a = rt.color_sum_tile(j0, j1, i0, i1, first)
+        sum_b = rt.color_sum_tile(j0, j1, i0, i1, samples - first, first)
+        color_sum = sum_a + sum_b
+        mean = color_sum / samples
+        #two independent averages differ by var*(1/na + 1/nb) on average, the full average has var/n
+        diff = (sum_a / first - sum_b / (samples - first)) @ LUMINANCE
+        variance = diff*diff / (samples*(1/first + 1/(samples - first)))
+
+    albedo, normal, depth = feature_tile(rt, j0, j1, i0, i1)
+    film.write_tile(buffers["color"], j0, i0, mean)
+    film.write_tile(buffers["variance"], j0, i0, variance[..., None])
+    film.write_tile(buffers["albedo"], j0, i0, albedo)
+    film.write_tile(buffers["normal"], j0, i0, normal)
+    film.write_tile(buffers["depth"], j0, i0, depth[..., None])
+    return color_sum, samples
+
+#average first hit albedo, normal and depth of a tile, rows counted from the bottom like color_sum_tile
+#from a regular grid of n x n rays per pixel, with n*n the closest square to feature_samples
+def feature_tile(rt, j0, j1, i0, i1):
+    n = max(1, int(round(rt.feature_samples ** 0.5)))
+    offsets = [(a + 0.5) / n for a in range(n)]
+    shape = (j1-j0, i1-i0)
+    albedo = np.zeros(shape + (3,))
+    normal = np.zeros(shape + (3,))
+    depth = np.zeros(shape)
+    world = rt.world
+    camera = rt.camera
+    collision = CollisionPacket()
+    for j in range(j0, j1):
+        for i in range(i0, i1):
+            a = [0.0, 0.0, 0.0]
+            nrm = [0.0, 0.0, 0.0]
+            t = 0.0
+            for dv in offsets:
+                for du in offsets:
+                    ray = camera.get_ray((i + du) / (rt.image_width-1), (j + dv) / (rt.image_height-1))
+                    obj = world.hit(ray, 0.001, collision)
+                    if not obj:
+                        a[0] += 1.0
+                        a[1] += 1.0
+                        a[2] += 1.0
+                        t += SKY_DEPTH
+                        continue
+                    color = obj.material.albedo.value(collision)
+                    a[0] += color.x
+                    a[1] += color.y
+                    a[2] += color.z
+                    nrm[0] += collision.normal.x
+                    nrm[1] += collision.normal.y
+                    nrm[2] += collision.normal.z
+                    t += collision.t
+            albedo[j-j0, i-i0] = a
+            normal[j-j0, i-i0] = nrm
+            depth[j-j0, i-i0] = t
+    return albedo / (n*n), normal / (n*n), depth / (n*n)
+
+#variance of every value's 3x3 neighbourhood, for frames without a per pixel estimate
+def spatial_variance(lum):
+    mean = blur3(lum)
+    return np.maximum(blur3(lum*lum) - mean*mean, 0.0)
+
+#3x3 box average with the edges repeated
+def blur3(img):
+    h, w = img.shape[:2]
+    padded = np.pad(img, ((1, 1), (1, 1)) + ((0, 0),)*(img.ndim - 2), mode="edge")
+    return sum(padded[dy:dy+h, dx:dx+w] for dy in range(3) for dx in range(3)) / 9
+
+#the denoised linear color of a frame from its feature buffers (see aov_views)
+#sigma_color scales the luminance edge stop in standard deviations, sigma_normal is the exponent
+#of the normal weight and sigma_depth the allowed depth change per pixel of distance in units of
+#the local depth gradient
+def atrous(buffers, iterations=3, sigma_color=4.0, sigma_normal=128.0, sigma_depth=1.0):
+    albedo = np.maximum(buffers["albedo"].astype(np.float64), 0.01)
+    depth = buffers["depth"][..., 0].astype(np.float64)
+    #averaged normals are shorter than one at edges, unit length keeps the center tap's weight at one
+    normal = buffers["normal"].astype(np.float64)
+    length = np.sqrt(np.einsum("ijk,ijk->ij", normal, normal))
+    surface = length > 0
+    normal[surface] /= length[surface][:, None]
+
+    #filter the irradiance, texture detail lives in the albedo
+    irradiance = buffers["color"] / albedo
+    variance = buffers["variance"][..., 0].astype(np.float64) / np.maximum(albedo @ LUMINANCE, 0.01)**2
+    grad_y, grad_x = np.gradient(depth)
+    depth_grad = np.maximum(np.abs(grad_x), np.abs(grad_y))
+
+    for level in range(iterations):
+        irradiance, variance = atrous_step(irradiance, variance, normal, depth, depth_grad, surface, 1 << level,
+            sigma_color, sigma_normal, sigma_depth)
+    return irradiance*albedo
+
+#one a-trous iteration with holes of step pixels, returns the filtered color and its variance
+def atrous_step(color, variance, normal, depth, depth_grad, surface, step, sigma_color, sigma_normal, sigma_depth):
+    h, w = depth.shape
+    pad = 2*step
+    def padded(img):
+        return np.pad(img, ((pad, pad), (pad, pad)) + ((0, 0),)*(img.ndim - 2))
+    p_color, p_var, p_normal, p_depth = padded(color), padded(variance), padded(normal), padded(depth)
+    p_inside, p_surface = padded(np.ones((h, w), dtype=bool)), padded(surface)
+
+    lum = color @ LUMINANCE
+    #the luminance edge stop uses the 3x3 average of the variance, single pixel estimates are noisy
+    lum_scale = sigma_color*np.sqrt(blur3(variance)) + 1e-10
+    depth_scale = sigma_depth*depth_grad*step + 1e-10
+
+    total = np.zeros((h, w))
+    out_color = np.zeros_like(color)
+    out_var = np.zeros((h, w))
+    for dy in range(-2, 3):
+        for dx in range(-2, 3):
+            window = (slice(pad + dy*step, pad + dy*step + h), slice(pad + dx*step, pad + dx*step + w))
+            q_color = p_color[window]
+            q_normal = p_normal[window]
+            q_surface = p_surface[window]
+            #surfaces are compared by normal, the sky only with the sky
+            dot = np.maximum(np.einsum("ijk,ijk->ij", normal, q_normal), 0.0)
+            w_normal = np.where(surface & q_surface, dot**sigma_normal, surface == q_surface)
+            w_depth = np.exp(-np.abs(depth - p_depth[window]) / (depth_scale*max(abs(dx), abs(dy), 1)))
+            w_lum = np.exp(-np.abs(lum - q_color @ LUMINANCE) / lum_scale)
+            weight = KERNEL[dy+2]*KERNEL[dx+2]*w_normal*w_depth*w_lum*p_inside[window]
+            total += weight
+            out_color += weight[..., None]*q_color
+            out_var += weight*weight*p_var[window]
+
+    #the center tap always has a weight, so total is never zero
+    return out_color / total[..., None], out_var / (total*total)
+
+#writes the noisy image and the feature buffers next to fname: scene_noisy.png, scene_albedo.png
+#(without gamma), scene_normal.png (mapped from [-1, 1]) and scene_depth.png (near is bright)
+def save_buffers(fname, noisy, buffers):
+    root = fname.rsplit(".", 1)[0]
+    Image.fromarray(noisy, "RGB").save(f"{root}_noisy.png")
+    albedo = (255*np.clip(buffers["albedo"], 0, 1)).astype(np.uint8)
+    Image.fromarray(albedo, "RGB").save(f"{root}_albedo.png")
+    normal = (255*np.clip(0.5 + 0.5*buffers["normal"], 0, 1)).astype(np.uint8)
+    Image.fromarray(normal, "RGB").save(f"{root}_normal.png")
+    depth = buffers["depth"][..., 0]
+    near = depth[depth < SKY_DEPTH]
+    scale = near.max() if len(near) else 1.0
+    Image.fromarray((255*np.clip(1 - depth/scale, 0, 1)).astype(np.uint8), "L").save(f"{root}_depth.png")
+    print(f"Feature buffers written next to {fname}")
+
+#root mean square error of two linear images after tonemapping, in 8 bit levels
+def rmse(a, b):
+    diff = film.tonemap(a, 1).astype(np.float64) - film.tonemap(b, 1)
+    return float(np.sqrt(np.mean(diff*diff)))
+
+#renders the benchmark scene (see bench.py) at every sample count with the wavefront engine and
+#compares the noisy and the denoised images with a render of reference samples per pixel
+def quality_report(spp, reference=1024, width=160, iterations=3):
+    from bench import bench_scene
+
+    start = time.perf_counter()
+    ref_rt = bench_scene(40, image_width=width, samples_per_pixel=reference, use_wavefront=True)
+    ref_rt.wavefront.seed = 1
+    ref = ref_rt.color_sum_tile(0, ref_rt.image_height, 0, ref_rt.image_width, reference) / reference
+    ref = ref[::-1]
+    ref_seconds = time.perf_counter() - start
+    print(f"Reference: {reference} samples per pixel in {ref_seconds:.1f}s")
+
+    rows = []
+    for n in spp:
+        rt = bench_scene(40, image_width=width, samples_per_pixel=n, use_wavefront=True, denoise=True, denoise_iterations=iterations)
+        rt.wavefront.seed = 2
+        buffers = aov_views(rt.aov_arr.get_obj(), rt.image_height, rt.image_width)
+        start = time.perf_counter()
+        render_tile(rt, buffers, 0, rt.image_height, 0, rt.image_width)
+        render_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        denoised = atrous(buffers, iterations)
+        denoise_seconds = time.perf_counter() - start
+        rows.append({
+            "spp": n,
+            "noisy_rmse": rmse(buffers["color"], ref),
+            "denoised_rmse": rmse(denoised, ref),
+            "render_seconds": render_seconds,
+            "denoise_seconds": denoise_seconds,
+        })
+
+    print(f"{'spp':>6} {'noisy rmse':>11} {'denoised rmse':>14} {'render s':>9} {'denoise s':>10}")
+    for row in rows:
+        print(f"{row['spp']:6d} {row['noisy_rmse']:11.2f} {row['denoised_rmse']:14.2f} "
+            f"{row['render_seconds']:9.2f} {row['denoise_seconds']:10.2f}")
+    return {"reference_spp": reference, "reference_seconds": ref_seconds, "width": width, "results": rows}
+
+def main():
+    parser = argparse.ArgumentParser(description="Quality of denoised renders against a high sample reference")
+    parser.add_argument("--spp", type=int, nargs="+", default=[4, 16, 64])
+    parser.add_argument("--reference", type=int, default=1024)
+    parser.add_argument("--width", type=int, default=160)
+    parser.add_argument("--iterations", type=int, default=3)
+    parser.add_argument("--save", metavar="FILE", help="write the report as JSON")
+    args = parser.parse_args()
+
+    report = quality_report(args.spp, args.reference, args.width, args.iterations)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {args.save}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+'''
+Distributed rendering over TCP
+The coordinator pickles the scene (objects with their materials and textures, camera and render settings)
+once and sends it to every worker that connects. Workers rebuild the RayTracer, then repeatedly
+pull a tile, render its summed colors as float32 and send them back. The coordinator merges the
+tiles into one accumulation buffer and tonemaps it the same way run() does.
+Tiles held by a worker that disconnects or does not answer within the timeout are handed out again,
+and once the queue is empty idle workers also duplicate the oldest unfinished tiles.
+
+Single machine example:
+    python3 distributed.py coordinator --port 7000
+    python3 distributed.py worker --host localhost --port 7000 --processes 4
+'''
+
+import argparse
+import collections
+import multiprocessing as mp
+import pickle
+import random
+import threading
+import time
+from multiprocessing.connection import Listener, Client
+import numpy as np
+import film
+from materials import dumps_embedded
+from scheduler import make_tiles, estimate_cost
+
+AUTHKEY = b"raytracer"
+
+class Coordinator():
+    def __init__(self, rt, address=("", 7000), authkey=AUTHKEY, timeout=600):
+        self.rt = rt
+        self.address = address
+        self.authkey = authkey
+        self.timeout = timeout
+
+        #the scene is serialized once and the same bytes are sent to every worker,
+        #texture pixels are embedded so workers do not need the image files
+        self.job = dumps_embedded({
+            "lookat": rt.lookat,
+            "lookfrom": rt.lookfrom,
+            "settings": rt.settings(),
+            "objects": rt.world.hittables,
+        })
+
+        self.tiles = make_tiles(rt.image_height, rt.image_width, rt.tile_size)
+        for tile in self.tiles:
+            tile.cost = estimate_cost(rt, tile)
+        self.pending = collections.deque(sorted(self.tiles, key=lambda t: t.cost, reverse=True))
+        #tile index -> number of workers currently rendering it
+        self.in_flight = {}
+        self.done = set()
+        self.accum = np.zeros((rt.image_height, rt.image_width, 3), dtype=np.float32)
+        self.cond = threading.Condition()
+        self.workers_seen = 0
+
+    #serves workers until every tile has been merged, returns the tonemapped image
+    def run(self):
+        print(f"Coordinator listening on {self.address}, scene is {len(self.job)/1e6:.1f} MB, {len(self.tiles)} tiles")
+        start = time.perf_counter()
+        listener = Listener(self.address, authkey=self.authkey)
+        threading.Thread(target=self.accept, args=(listener,), daemon=True).start()
+
+        reported = 0
+        with self.cond:
+            while len(self.done) < len(self.tiles):
+                self.cond.wait(1.0)
+                if len(self.done) - reported >= max(1, len(self.tiles)//20):
+                    reported = len(self.done)
+                    print(f"{100*reported/len(self.tiles):.1f}% done, {len(self.tiles)-reported} tiles left, "
+                        f"{self.workers_seen} workers connected so far, {time.perf_counter()-start:.1f}s elapsed")
+            self.cond.notify_all()
+
+        listener.close()
+        print(f"Distributed render took {time.perf_counter()-start:.2f}s on {self.workers_seen} workers")
+        return film.tonemap(self.accum, self.rt.samples_per_pixel)
+
+    def accept(self, listener):
+        while True:
+            try:
+                conn = listener.accept()
+            except (OSError, EOFError):
+                return
+            with self.cond:
+                self.workers_seen += 1
+            threading.Thread(target=self.serve, args=(conn,), daemon=True).start()
+
+    #hands tiles to one worker until everything is done or the worker fails
+    def serve(self, conn):
+        tile = None
+        try:
+            conn.send_bytes(self.job)
+            while True:
+                tile = self.next_tile()
+                if tile is None:
+                    conn.send(None)
+                    return
+                conn.send(tile)
+                if not conn.poll(self.timeout):
+                    print(f"Worker timed out on {tile}, reissuing")
+                    return
+                index, color_sum = conn.recv()
+                self.finish(tile, color_sum)
+                tile = None
+        except (EOFError, OSError, pickle.UnpicklingError) as e:
+            if tile is not None:
+                print(f"Worker lost while rendering {tile} ({type(e).__name__}), reissuing")
+        finally:
+            if tile is not None:
+                self.release(tile)
+            conn.close()
+
+    #next tile for an idle worker, None once all tiles are done
+    def next_tile(self):
+        with self.cond:
+            while True:
+                if len(self.done) == len(self.tiles):
+                    return None
+                if self.pending:
+                    tile = self.pending.popleft()
+                else:
+                    #nothing left to hand out, help with a tile another worker is still rendering
+                    tile = next((t for t in self.tiles if self.in_flight.get(t.index) == 1), None)
+                if tile is not None:
+                    self.in_flight[tile.index] = self.in_flight.get(tile.index, 0) + 1
+                    return tile
+                self.cond.wait(1.0)
+
+    #merges a finished tile, duplicates of a tile that is already merged are dropped
+    def finish(self, tile, color_sum):
+        with self.cond:
+            self.in_flight[tile.index] -= 1
+            if tile.index not in self.done:
+                film.tile_view(self.accum, tile.j0, tile.j1, tile.i0, tile.i1)[...] = color_sum
+                self.done.add(tile.index)
+            self.cond.notify_all()
+
+    #puts the tile of a failed worker back at the front of the queue
+    def release(self, tile):
+        with self.cond:
+            self.in_flight[tile.index] -= 1
+            if tile.index not in self.done and self.in_flight[tile.index] == 0 and tile not in self.pending:
+                self.pending.appendleft(tile)
+            self.cond.notify_all()
+
+#connects to a coordinator, renders tiles until told to stop
+def worker(address, authkey=AUTHKEY):
+    from main import RayTracer
+
+    conn = Client(address, authkey=authkey)
+    job = pickle.loads(conn.recv_bytes())
+    rt = RayTracer(job["lookat"], job["lookfrom"], **job["settings"])
+    for obj in job["objects"]:
+        rt.add_object(obj)
+    rt.finalize()
+    random.seed()
+
+    tiles = 0
+    while True:
+        try:
+            tile = conn.recv()
+        except EOFError:
+            break
+        if tile is None:
+            break
+        color_sum = rt.color_sum_tile(tile.j0, tile.j1, tile.i0, tile.i1, rt.samples_per_pixel)
+        conn.send((tile.index, color_sum.astype(np.float32)))
+        tiles += 1
+    conn.close()
+    print(f"Worker done after {tiles} tiles")
+
+def main():
+    parser = argparse.ArgumentParser(description="Distributed rendering")
+    parser.add_argument("role", choices=["coordinator", "worker"])
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=7000)
+    parser.add_argument("--processes", type=int, default=1, help="worker processes to start on this machine")
+    parser.add_argument("--output", default="scene.png")
+    args = parser.parse_args()
+
+    if args.role == "worker":
+        procs = [mp.Process(target=worker, args=((args.host, args.port),)) for _ in range(args.processes)]
+        for p in procs:
+            p.start()
+        for p in procs:
+            p.join()
+        return
+
+    from main import RayTracer, build_scene, Vec3
+    rt = RayTracer(lookat = Vec3(0,0,0), lookfrom = Vec3(0,4,-4))
+    build_scene(rt)
+    rt.finalize()
+    rt.run_distributed(args.output, ("", args.port))
+
+if __name__ == "__main__":
+    main()
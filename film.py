@@ -0,0 +1,31 @@
+'''
+Helpers for turning accumulated radiance into image pixels
+Works on whole tiles or frames at once with numpy rather than one pixel at a time
+'''
+
+import numpy as np
+
+#converts summed colors into 8 bit pixels
+#color_sum is (..., 3), samples is a scalar or an array broadcastable against color_sum[..., 0]
+#average, gamma 2 (sqrt), clamp to [0, 0.999] and scale by 256
+def tonemap(color_sum, samples):
+    color = np.sqrt(np.maximum(average(color_sum, samples), 0.0))
+    return (256 * np.clip(color, 0.0, 0.999)).astype(np.uint8)
+
+#average linear color of summed colors, samples as in tonemap
+def average(color_sum, samples):
+    samples = np.asarray(samples, dtype=np.float64)
+    if samples.ndim > 0:
+        samples = np.maximum(samples, 1)[..., None]
+    return color_sum / samples
+
+#writes a tile of rows j0..j0+h (counted from the bottom of the image) into an image array
+#PIL top right is (0,0), so rows are flipped
+def write_tile(arr, j0, i0, tile):
+    tile_view(arr, j0, j0+tile.shape[0], i0, i0+tile.shape[1])[...] = tile
+
+#view of rows j0..j1 and columns i0..i1 of an image array, with rows counted from the bottom
+#writing into the view writes into the image, so it can be used to accumulate tiles in place
+def tile_view(arr, j0, j1, i0, i1):
+    image_height = arr.shape[0]
+    return arr[image_height-j1:image_height-j0, i0:i1][::-1]
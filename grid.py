@@ -0,0 +1,271 @@
+'''
+Uniform grid acceleration structure, an alternative to the BVH for dense, evenly spread objects
+The bounds of the scene are split into equal cells and every cell lists the objects whose bounding
+box overlaps it (a compressed list: cell c holds prims[start[c]:start[c+1]]). Building is two linear
+passes over the objects, counting and then filling. A ray walks the cells it passes through in order
+with a 3D-DDA (Amanatides and Woo) and stops as soon as the closest hit lies inside the current cell.
+    resolution      chosen so there are about cells_per_object cells per object, with cubic cells
+                    over the bounds of the objects, unless dims is given
+    mailboxing      an object in several cells is tested at most once per ray: each object remembers
+                    the id of the last ray tested against it
+    large objects   objects like the floor RectFlat, that would overlap more than large_fraction of
+                    the cells and more than a 2x2x2 block, are kept out of the cells and tested first
+                    against every ray, their hit then ends the walk early
+'''
+
+import math
+import time
+from array import array
+from util import *
+
+class UniformGrid():
+    cells_per_object = 2.0
+    large_fraction = 0.05
+    max_dims = 512
+
+    #bounds is (x0, y0, z0, x1, y1, z1), dims the cells per axis, cell_prims and large index into objects
+    def __init__(self, bounds, dims, start, cell_prims, large, objects):
+        self.bounds = bounds
+        self.dims = dims
+        self.start = start
+        self.cell_prims = cell_prims
+        self.large_idx = large
+        self.large = [objects[k] for k in large]
+        self.objects = objects
+        x0, y0, z0, x1, y1, z1 = bounds
+        nx, ny, nz = dims
+        self.cell_size = ((x1 - x0) / nx, (y1 - y0) / ny, (z1 - z0) / nz)
+        #id of the last ray tested against each object
+        self.mailbox = array('q', [-1])*len(objects)
+        self.ray_id = 0
+        self.cell_visits = 0
+        self.prim_tests = 0
+        self.closer_hits = 0
+
+    def __len__(self):
+        return self.dims[0]*self.dims[1]*self.dims[2]
+
+    #builds a grid over objects, dims (nx, ny, nz) overrides the automatic resolution
+    @classmethod
+    def build(cls, objects, dims=None):
+        start_time = time.perf_counter()
+        boxes = [(o.bb.minv.x, o.bb.minv.y, o.bb.minv.z, o.bb.maxv.x, o.bb.maxv.y, o.bb.maxv.z) for o in objects]
+
+        #objects that would fill a large part of a grid over everything are tested separately,
+        #the final grid only covers the others
+        large = []
+        if boxes:
+            bounds = pad_flat(box_union(boxes))
+            grid_dims = dims or cls.resolution(bounds, len(boxes))
+            limit = cls.large_fraction*grid_dims[0]*grid_dims[1]*grid_dims[2]
+            for k, box in enumerate(boxes):
+                lo, hi = cell_range(box, bounds, grid_dims)
+                if (hi[0]-lo[0]+1)*(hi[1]-lo[1]+1)*(hi[2]-lo[2]+1) > max(limit, 8):
+                    large.append(k)
+        large_set = set(large)
+        small = [k for k in range(len(boxes)) if k not in large_set]
+
+        if small:
+            bounds = pad_flat(box_union([boxes[k] for k in small]))
+            dims = dims or cls.resolution(bounds, len(small))
+        else:
+            bounds = (0.0, 0.0, 0.0, 1.0, 1.0, 1.0)
+            dims = (1, 1, 1)
+        nx, ny, nz = dims
+
+        #count the objects of every cell, turn the counts into start offsets and fill
+        ranges = [cell_range(boxes[k], bounds, dims) for k in small]
+        counts = array('i', [0])*(nx*ny*nz + 1)
+        for lo, hi in ranges:
+            for z in range(lo[2], hi[2]+1):
+                for y in range(lo[1], hi[1]+1):
+                    row = nx*(y + ny*z)
+                    for x in range(lo[0], hi[0]+1):
+                        counts[row + x + 1] += 1
+        for c in range(1, len(counts)):
+            counts[c] += counts[c-1]
+        start = array('i', counts)
+        cell_prims = array('i', [0])*counts[-1]
+        fill = array('i', counts)
+        for k, (lo, hi) in zip(small, ranges):
+            for z in range(lo[2], hi[2]+1):
+                for y in range(lo[1], hi[1]+1):
+                    row = nx*(y + ny*z)
+                    for x in range(lo[0], hi[0]+1):
+                        cell_prims[fill[row + x]] = k
+                        fill[row + x] += 1
+
+        grid = cls(bounds, tuple(dims), start, cell_prims, array('i', large), list(objects))
+        grid.build_seconds = time.perf_counter() - start_time
+        return grid
+
+    #cells per axis for n objects in bounds: about cells_per_object*n cubic cells
+    @classmethod
+    def resolution(cls, bounds, n):
+        extent = [bounds[3+a] - bounds[a] for a in range(3)]
+        side = (extent[0]*extent[1]*extent[2] / (cls.cells_per_object*max(n, 1))) ** (1/3)
+        return tuple(min(max(1, int(math.ceil(e / side))), cls.max_dims) for e in extent)
+
+    def stats(self):
+        cells = len(self)
+        refs = len(self.cell_prims)
+        empty = sum(1 for c in range(cells) if self.start[c] == self.start[c+1])
+        return {"cells": cells, "references": refs, "empty": empty, "large": len(self.large),
+            "objects_per_cell": refs / max(cells - empty, 1)}
+
+    #closest hit along the ray, or False
+    def hit(self, ray, t_min, t_max, collision_packet):
+        obj, t, payload = self.closest(ray, t_min, t_max)
+        if obj:
+            obj.fill(ray, t, payload, collision_packet)
+        return obj
+
+    #closest object along the ray, its distance and hit_t's payload, (False, t_max, None) for a miss,
+    #see FlatBVH.closest
+    def closest(self, ray, t_min, t_max):
+        self.ray_id += 1
+        ray_id = self.ray_id
+        hit_obj = False
+        tests = 0
+        closer = 0
+        payload = None
+
+        for obj in self.large:
+            tests += 1
+            hit = obj.hit_t(ray, t_min, t_max)
+            if hit is not None:
+                hit_obj = obj
+                t_max, payload = hit
+                closer += 1
+
+        o = ray.origin
+        d = ray.direction
+        ox, oy, oz = o.x, o.y, o.z
+        dx, dy, dz = d.x, d.y, d.z
+        x0, y0, z0, x1, y1, z1 = self.bounds
+        ix = 1.0/dx if dx != 0.0 else 1e300
+        iy = 1.0/dy if dy != 0.0 else 1e300
+        iz = 1.0/dz if dz != 0.0 else 1e300
+
+        #where the ray enters and leaves the grid
+        t0 = (x0 - ox)*ix
+        t1 = (x1 - ox)*ix
+        if t0 > t1: t0, t1 = t1, t0
+        lo = t0 if t0 > t_min else t_min
+        hi = t1 if t1 < t_max else t_max
+        t0 = (y0 - oy)*iy
+        t1 = (y1 - oy)*iy
+        if t0 > t1: t0, t1 = t1, t0
+        if t0 > lo: lo = t0
+        if t1 < hi: hi = t1
+        t0 = (z0 - oz)*iz
+        t1 = (z1 - oz)*iz
+        if t0 > t1: t0, t1 = t1, t0
+        if t0 > lo: lo = t0
+        if t1 < hi: hi = t1
+        if hi < lo:
+            self.prim_tests += tests
+            self.closer_hits += closer
+            return hit_obj, t_max, payload
+
+        nx, ny, nz = self.dims
+        sx, sy, sz = self.cell_size
+        #cell of the entry point and the t of the next cell boundary on every axis
+        cx = min(max(int((ox + dx*lo - x0) / sx), 0), nx - 1)
+        cy = min(max(int((oy + dy*lo - y0) / sy), 0), ny - 1)
+        cz = min(max(int((oz + dz*lo - z0) / sz), 0), nz - 1)
+        if dx > 0.0:
+            step_x, end_x, next_x = 1, nx, (x0 + (cx + 1)*sx - ox)*ix
+        elif dx < 0.0:
+            step_x, end_x, next_x = -1, -1, (x0 + cx*sx - ox)*ix
+        else:
+            step_x, end_x, next_x = 0, -1, 1e300
+        if dy > 0.0:
+            step_y, end_y, next_y = 1, ny, (y0 + (cy + 1)*sy - oy)*iy
+        elif dy < 0.0:
+            step_y, end_y, next_y = -1, -1, (y0 + cy*sy - oy)*iy
+        else:
+            step_y, end_y, next_y = 0, -1, 1e300
+        if dz > 0.0:
+            step_z, end_z, next_z = 1, nz, (z0 + (cz + 1)*sz - oz)*iz
+        elif dz < 0.0:
+            step_z, end_z, next_z = -1, -1, (z0 + cz*sz - oz)*iz
+        else:
+            step_z, end_z, next_z = 0, -1, 1e300
+        delta_x = abs(sx*ix)
+        delta_y = abs(sy*iy)
+        delta_z = abs(sz*iz)
+
+        start = self.start
+        cell_prims = self.cell_prims
+        objects = self.objects
+        mailbox = self.mailbox
+        visits = 0
+        while True:
+            visits += 1
+            cell = cx + nx*(cy + ny*cz)
+            for k in cell_prims[start[cell]:start[cell+1]]:
+                if mailbox[k] == ray_id:
+                    continue
+                mailbox[k] = ray_id
+                tests += 1
+                hit = objects[k].hit_t(ray, t_min, t_max)
+                if hit is not None:
+                    hit_obj = objects[k]
+                    t_max, payload = hit
+                    closer += 1
+
+            #leave the cell through its nearest boundary, unless the closest hit is inside it
+            if next_x < next_y and next_x < next_z:
+                if t_max < next_x or next_x > hi:
+                    break
+                cx += step_x
+                if cx == end_x:
+                    break
+                next_x += delta_x
+            elif next_y < next_z:
+                if t_max < next_y or next_y > hi:
+                    break
+                cy += step_y
+                if cy == end_y:
+                    break
+                next_y += delta_y
+            else:
+                if t_max < next_z or next_z > hi:
+                    break
+                cz += step_z
+                if cz == end_z:
+                    break
+                next_z += delta_z
+
+        self.cell_visits += visits
+        self.prim_tests += tests
+        self.closer_hits += closer
+        return hit_obj, t_max, payload
+
+#bounds (x0, y0, z0, x1, y1, z1) around a list of boxes in the same layout
+def box_union(boxes):
+    return (min(b[0] for b in boxes), min(b[1] for b in boxes), min(b[2] for b in boxes),
+        max(b[3] for b in boxes), max(b[4] for b in boxes), max(b[5] for b in boxes))
+
+#widens the axes where bounds are flat, so every cell has a size
+def pad_flat(bounds):
+    largest = max(bounds[3+a] - bounds[a] for a in range(3))
+    pad = max(largest*1e-3, 1e-6)
+    lo = list(bounds[:3])
+    hi = list(bounds[3:])
+    for a in range(3):
+        if hi[a] - lo[a] < pad:
+            lo[a] -= pad/2
+            hi[a] += pad/2
+    return tuple(lo + hi)
+
+#first and last cell (x, y, z) a box overlaps in a grid of dims cells over bounds
+def cell_range(box, bounds, dims):
+    lo = []
+    hi = []
+    for a in range(3):
+        size = (bounds[3+a] - bounds[a]) / dims[a]
+        lo.append(min(max(int((box[a] - bounds[a]) / size), 0), dims[a] - 1))
+        hi.append(min(max(int((box[3+a] - bounds[a]) / size), 0), dims[a] - 1))
+    return lo, hi
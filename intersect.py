@@ -0,0 +1,41 @@
+'''
+Ray primitive intersection kernels of the numpy engines
+Each tests many rays against a primitive at once and is shared by WavefrontRenderer.intersect_all
+(every ray against one primitive) and PacketBVH (packets of rays against the primitive of a leaf each),
+the arrays only have to broadcast against each other:
+    origins, directions     (..., 3)
+    a                       squared length of the directions (...)
+    closest                 closest hit so far of every ray (...), a hit has to be nearer
+Both return (hit, t): which rays hit the primitive between t_min and closest, and the distance
+along those rays (t is meaningless where hit is False)
+'''
+
+import numpy as np
+
+#spheres at center (..., 3) with radius (...), the nearest root that lies in the acceptable range
+def hit_spheres(origins, directions, a, center, radius, t_min, closest):
+    oc = origins - center
+    half_b = np.einsum("...k,...k->...", oc, directions)
+    c = np.einsum("...k,...k->...", oc, oc) - radius*radius
+    discriminant = half_b*half_b - a*c
+    cand = discriminant >= 0
+    if not cand.any():
+        return cand, closest
+    sqrtd = np.sqrt(np.where(cand, discriminant, 0))
+    root = (-half_b - sqrtd) / a
+    near_ok = (root >= t_min) & (root <= closest)
+    root = np.where(near_ok, root, (-half_b + sqrtd) / a)
+    return cand & (root >= t_min) & (root <= closest), root
+
+#flat rectangles x0..x1, z0..z1 at height k, bounds is (x0, x1, z0, z1), each broadcasting like k
+#rays above a rectangle that point up never hit it
+def hit_rects(origins, directions, bounds, k, t_min, closest):
+    x0, x1, z0, z1 = bounds
+    with np.errstate(divide="ignore", invalid="ignore"):
+        skip = (directions[..., 1] >= 0) & (origins[..., 1] >= k)
+        t = (k - origins[..., 1]) / directions[..., 1]
+        x = origins[..., 0] + t*directions[..., 0]
+        z = origins[..., 2] + t*directions[..., 2]
+        hit = (~skip & (t >= t_min) & (t <= closest)
+            & (x >= x0) & (x <= x1) & (z >= z0) & (z <= z1))
+    return hit, t
@@ -5,7 +5,25 @@ import numpy as np
 from util import *
 from camera import *
 from objects import *
+from packed import PackedScene
+from sharedscene import SharedScene
+from wavefront import WavefrontRenderer
+from scheduler import TileScheduler, Tile
+from output import TileOutput
+import adaptive
+from progressive import ProgressiveRender
+from preview import PreviewRender
+from animation import AnimationRender
+import distributed
+import metrics
+import samplers
+import shading
+import film
+import denoise
 import random
+import itertools
+import sys
+import time
 import multiprocessing as mp
 import ctypes
 from random import uniform
@@ -13,7 +31,7 @@ from random import uniform
 '''
 Main ray tracing class. Handles loading objects into the world,
 sending rays into the scene and saving the ray color into an image
-Also supports mulithreading along the rows of the output image
+Also supports multiprocessing, a pool of workers renders square tiles of the output image
 '''
 
 class RayTracer():
@@ -23,28 +41,221 @@ class RayTracer():
     ray_depth = 25
     image_height = int((image_width / aspect_ratio))
     use_BVH = True
-
-    def __init__(self, lookat, lookfrom):
+    #"bottom_up" or "sah", see World.create_BoundingHierarchy
+    bvh_builder = "bottom_up"
+    #intersect with a uniform grid instead of the BVH, see grid.py
+    use_grid = False
+    #render with the batched numpy wavefront engine instead of ray_color
+    use_wavefront = False
+    #the wavefront engine walks the BVH with packets of packet_size rays instead of testing every ray
+    #against every primitive (None). Packets only pay off in large scenes, scenes with fewer than
+    #coherence.PACKET_MIN_PRIMITIVES primitives are still tested brute force, and 8 is the fastest size.
+    #reorder_rays sorts the rays of every bounce after the first by direction octant and Morton code of
+    #their origin first, so packets hold rays that travel together (see coherence.py)
+    packet_size = None
+    reorder_rays = False
+    #worker processes used by run(), None uses every core
+    num_workers = None
+    tile_size = 32
+    #adaptive sampling: every pixel takes adaptive_min_samples, then batches of adaptive_batch
+    #until its relative error is below adaptive_threshold, at most samples_per_pixel in total
+    adaptive = False
+    adaptive_min_samples = 32
+    adaptive_batch = 32
+    adaptive_threshold = 0.02
+    #samples per pixel added by each pass of run_progressive
+    pass_samples = 16
+    #follow paths with a loop carrying the throughput instead of recursing in ray_color
+    use_iterative = False
+    #after rr_min_depth bounces, paths are randomly terminated with a probability based on their
+    #throughput, and survivors are weighted up to keep the image unbiased (iterative and wavefront engines)
+    russian_roulette = False
+    rr_min_depth = 3
+    #run() and run_singlethread() write finished tiles straight to disk instead of keeping the image
+    #in memory, see output.py. The file name selects the format: .png, .pfm or .npy
+    stream_output = False
+    #never open the image viewer
+    headless = False
+    #count hits per object type and material and write a JSON report of the render's counters
+    #next to the image, see metrics.py
+    collect_metrics = False
+    #copy the packed scene into shared memory for the worker processes, see share_scene. The wavefront
+    #engine and batch_shading then read the same pages in every worker, but the scalar engine still needs
+    #objects: forked workers keep the world they inherit, spawned ones rebuild it (see attach_scene)
+    shared_scene = False
+    #random choices of every path (camera jitter, Lambertian bounces, russian roulette) come from
+    #a sample pattern indexed by pixel, sample and bounce instead of the random module, see samplers.py
+    #None, "random", "stratified", "halton", "sobol" or "bluenoise"
+    sample_pattern = None
+    #the scalar engine intersects rays one at a time but shades every bounce of a tile's paths as a batch
+    #with the numpy kernels of shading.py instead of calling Material.scatter per hit (not with adaptive)
+    batch_shading = False
+    #run() and run_singlethread() also render first hit albedo, normal and depth buffers from
+    #feature_samples rays per pixel, and filter the frame with them before saving it, see denoise.py
+    #(not with adaptive or stream_output)
+    denoise = False
+    denoise_iterations = 3
+    feature_samples = 4
+    #run_preview() draws the image at 1/8, 1/4 and 1/2 resolution first, then refines it at full resolution
+    #until preview_budget seconds have passed or the estimated error is below preview_target_error (None for
+    #no limit), saving it at most every preview_interval seconds, see preview.py
+    preview_scales = (8, 4, 2)
+    preview_interval = 2.0
+    preview_budget = None
+    preview_target_error = None
+    #run_animation() refits the BVH to moved objects and builds it again once the SAH cost of the refit
+    #tree is rebuild_threshold times the cost right after the last build, see animation.py
+    rebuild_threshold = 1.5
+
+    #any of the parameters above can be overridden per instance as keyword arguments
+    #if only image_width is given, image_height follows from aspect_ratio
+    def __init__(self, lookat, lookfrom, **settings):
+        self.created = time.perf_counter()
+        for name, value in settings.items():
+            if name not in RENDER_SETTINGS:
+                raise TypeError(f"Unknown RayTracer setting: {name}")
+            setattr(self, name, value)
+        if "image_width" in settings and "image_height" not in settings:
+            self.image_height = int((self.image_width / self.aspect_ratio))
+
+        self.set_camera(lookfrom, lookat)
+
+        self.world = World(self.use_BVH, self.bvh_builder)
+
+        #in memory images, not allocated when tiles are streamed to disk
+        if not self.stream_output:
+            self.img = np.zeros((self.image_height, self.image_width, 3), dtype=np.uint8)
+            self.mp_arr = mp.Array(ctypes.c_byte, self.image_height*self.image_width*3)
+
+        #float color, variance and feature buffers of every pixel for the denoiser
+        if self.denoise:
+            if self.adaptive or self.stream_output:
+                raise ValueError("denoise needs the whole frame in memory and the same samples in every pixel")
+            self.aov_arr = mp.Array(ctypes.c_float, self.image_height*self.image_width*denoise.AOV_SIZE)
+
+        #samples taken per pixel, only filled in when adaptive sampling is on
+        if self.adaptive:
+            self.sample_counts = mp.Array(ctypes.c_int32, self.image_height*self.image_width)
+            self.sampler = adaptive.AdaptiveSampler(
+                self.adaptive_min_samples,
+                self.samples_per_pixel,
+                self.adaptive_threshold,
+                self.adaptive_batch)
+
+        self.height = self.image_height
+        self.width = self.image_width
+
+        #paths traced and ray segments (intersection queries) in this process
+        self.path_count = 0
+        self.segment_count = 0
+        #hits per object type and material, only counted with collect_metrics
+        self.hit_counts = {} if self.collect_metrics else None
+
+        #SharedScene while worker processes are running, see share_scene
+        self.shared = None
+
+        self.pattern = None
+        if self.sample_pattern is not None:
+            self.pattern = samplers.make_sampler(self.sample_pattern, self.samples_per_pixel)
+        #(i, j, sample index) of the sample being traced with a pattern
+        self.current_sample = None
+
+        #packed materials used by batch_shading, see shading_scene
+        self.shade_scene = None
+        #the PackedScene the world was loaded from, see load_packed
+        self.packed = None
+        #seconds from creating the RayTracer to the first ray, see report_startup
+        self.startup_seconds = None
+
+    #points the camera from lookfrom at lookat
+    def set_camera(self, lookfrom, lookat):
+        self.lookat = lookat
+        self.lookfrom = lookfrom
         self.camera = Camera(
             lookfrom = lookfrom,
             lookat = lookat,
             vup = Vec3(0,1,0),
             fov = 80,
             aspect_ratio = self.aspect_ratio)
+        self.camera.set_resolution(self.image_height)
+        if getattr(self, "wavefront", None) is not None:
+            self.wavefront.camera = self.camera
 
-        self.world = World(self.use_BVH)
-
-        self.img = np.zeros((self.image_height, self.image_width, 3), dtype=np.uint8)
-
-        self.mp_arr = mp.Array(ctypes.c_byte, self.image_height*self.image_width*3)
+    #the parameters of this instance, enough to recreate it with RayTracer(lookat, lookfrom, **settings)
+    def settings(self):
+        return {name: getattr(self, name) for name in RENDER_SETTINGS}
 
-        self.height = self.img.shape[0]
-        self.width = self.img.shape[1]
-
-    #setup the BVH after objects are added
+    #setup the grid or BVH after objects are added, a world loaded from a packed scene already has one
     def finalize(self):
-        if self.use_BVH:
-            self.world.create_BoundingHierarchy()
+        if self.packed is None:
+            if self.use_grid:
+                self.world.create_grid()
+            elif self.use_BVH:
+                self.world.create_BoundingHierarchy()
+        if self.use_wavefront:
+            self.wavefront = WavefrontRenderer(
+                self.packed_scene(),
+                self.camera,
+                self.image_width,
+                self.image_height,
+                self.ray_depth,
+                rr_min_depth = self.rr_min_depth if self.russian_roulette else None,
+                hit_counts = self.hit_counts,
+                sampler = self.pattern,
+                packet_size = self.packet_size,
+                reorder = self.reorder_rays)
+
+    #replaces the world with the objects and BVH of a packed scene (for example a compiled scene file,
+    #see scenefile.py), which is also used as is by the wavefront engine and share_scene
+    def load_packed(self, packed):
+        self.packed = packed
+        self.world = packed.to_world(self.bvh_builder)
+
+    #the world as a PackedScene
+    def packed_scene(self):
+        if self.packed is not None:
+            return self.packed
+        return PackedScene.from_world(self.world)
+
+    #copies the packed scene into shared memory for the worker processes
+    #the wavefront engine in this process switches to the shared arrays as well, so there is one copy
+    def share_scene(self):
+        self.shared = SharedScene(self.packed_scene().arrays)
+        if self.use_wavefront:
+            self.wavefront.scene = self.shared.packed()
+        print(f"Scene shared in {len(self.shared.spec)} blocks, {self.shared.nbytes/1e6:.1f} MB")
+
+    #frees the shared memory once the workers are done
+    def unshare_scene(self):
+        if self.use_wavefront:
+            self.wavefront.scene = PackedScene({name: np.array(arr) for name, arr in self.shared.arrays().items()})
+        self.shade_scene = None
+        self.shared.unlink()
+        self.shared = None
+
+    #runs in a spawned worker, which received the RayTracer without its world: rebuilds the world's
+    #objects from the shared scene. Forked workers keep the parent's world, copy on write
+    def attach_scene(self):
+        self.world = self.shared.packed().to_world(self.bvh_builder)
+        self.shade_scene = None
+
+    #with a shared scene, a pickled RayTracer (spawned workers) leaves out the world and the image,
+    #the wavefront engine's PackedScene pickles as the names of the shared blocks
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        #the material indices are keyed by object ids, which only hold in this process
+        state["shade_scene"] = None
+        state.pop("material_index", None)
+        if self.shared is not None:
+            state.pop("world", None)
+            state.pop("img", None)
+            state["packed"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.shared is not None:
+            self.attach_scene()
 
     #add an object to the scene
     def add_object(self, obj:Object):
@@ -52,85 +263,259 @@ class RayTracer():
 
     #draws pixels, from rows j_start to j_stop
     def color_rows(self, j_start, j_stop):
-        arr = np.frombuffer(self.mp_arr.get_obj(), dtype=np.uint8) 
-        arr = arr.reshape((self.image_height,self.image_width,3)) # b and arr share the same memory
+        self.color_tile(j_start, j_stop, 0, self.image_width)
+        print(f"Done row {j_start} - {j_stop}: Average intersections per ray : {(self.world.count / self.world.ray_count):.2f}")
 
+    #draws the pixels of rows j_start to j_stop and columns i_start to i_stop
+    #into arr, or into the shared image if arr is not given
+    #if linear is given, the average (not tonemapped) colors are written into it as well
+    def color_tile(self, j_start, j_stop, i_start, i_stop, arr=None, linear=None):
+        if arr is None and linear is None:
+            arr = np.frombuffer(self.mp_arr.get_obj(), dtype=np.uint8) 
+            arr = arr.reshape((self.image_height,self.image_width,3)) # b and arr share the same memory
+
+        if self.denoise:
+            color_sum, n = denoise.render_tile(self, self.aov_buffers(), j_start, j_stop, i_start, i_stop)
+        else:
+            color_sum, n = self.render_tile(j_start, j_stop, i_start, i_stop)
+        if self.adaptive:
+            film.write_tile(self.sample_count_array(), j_start, i_start, n)
+        if arr is not None:
+            film.write_tile(arr, j_start, i_start, film.tonemap(color_sum, n))
+        if linear is not None:
+            film.write_tile(linear, j_start, i_start, film.average(color_sum, n))
+
+    #summed color of a tile with the selected engine, and the samples taken per pixel
+    #(an array with adaptive sampling, samples_per_pixel otherwise)
+    def render_tile(self, j_start, j_stop, i_start, i_stop):
+        if self.use_wavefront and self.adaptive:
+            return self.wavefront.render_tile_adaptive(j_start, j_stop, i_start, i_stop, self.sampler)
+        if not self.adaptive:
+            return self.color_sum_tile(j_start, j_stop, i_start, i_stop, self.samples_per_pixel), self.samples_per_pixel
+
+        color_sum = np.zeros((j_stop-j_start, i_stop-i_start, 3))
+        counts = np.zeros((j_stop-j_start, i_stop-i_start), dtype=np.int32)
+        for j in range(j_start, j_stop, 1):
+            for i in range(i_start, i_stop, 1):
+                index = itertools.count()
+                color, n = self.sampler.sample_pixel(lambda: self.sample_color(i, j, next(index)))
+                color_sum[j-j_start, i-i_start] = color.unwrap()
+                counts[j-j_start, i-i_start] = n
+        return color_sum, counts
+
+    #summed color of samples per pixel over rows j_start to j_stop and columns i_start to i_stop
+    #returned as a (rows, columns, 3) float array with rows counted from the bottom of the image
+    #a different stream gives different samples, with a sample pattern the samples are numbered from stream
+    def color_sum_tile(self, j_start, j_stop, i_start, i_stop, samples, stream=0):
+        if self.use_wavefront:
+            return self.wavefront.render_tile(j_start, j_stop, i_start, i_stop, samples, stream)
+        if self.batch_shading:
+            return self.color_sum_tile_batched(j_start, j_stop, i_start, i_stop, samples, stream)
+
+        color_sum = np.zeros((j_stop-j_start, i_stop-i_start, 3))
         for j in range(j_start, j_stop, 1):
-            for i in range(self.image_width-1, -1, -1):
-                
+            for i in range(i_start, i_stop, 1):
                 color = Vec3(0,0,0)
-                for _ in range(self.samples_per_pixel):
-
-                    v = (j + random.uniform(0,1)) / (self.image_height-1)
-                    u = (i + random.uniform(0,1)) / (self.image_width-1)
-                    ray = self.camera.get_ray(u, v)
-                    color += self.ray_color(ray, self.world, self.ray_depth)
-                self.write_color(j, i , color, arr)
-        print(f"Done row {j_start} - {j_stop}: Average intersections per ray : {(self.world.count / self.world.ray_count):.2f}")
-        
-    #draw the image, mulithreading across pixel rows
+                for s in range(samples):
+                    color += self.sample_color(i, j, stream + s)
+                color_sum[j-j_start, i-i_start] = color.unwrap()
+        return color_sum
+
+    #same as color_sum_tile, but all paths of one sample index in the tile are traced together by trace_batch
+    def color_sum_tile_batched(self, j_start, j_stop, i_start, i_stop, samples, stream=0):
+        pixels = [(i, j) for j in range(j_start, j_stop) for i in range(i_start, i_stop)]
+        color_sum = np.zeros((len(pixels), 3))
+        for s in range(samples):
+            rays = [self.camera_ray(i, j, stream + s) for i, j in pixels]
+            color_sum += self.trace_batch(rays, [(i, j, stream + s) for i, j in pixels])
+        return color_sum.reshape((j_stop-j_start, i_stop-i_start, 3))
+
+    #summed color of samples through each of the pixels (jj[k], ii[k]), as a (len(jj), 3) float array
+    #stream numbers the samples as in color_sum_tile
+    def color_sum_pixels(self, jj, ii, samples, stream=0):
+        if self.use_wavefront:
+            return self.wavefront.render_points(jj, ii, samples, stream)
+        pixels = list(zip(ii.tolist(), jj.tolist()))
+        color_sum = np.zeros((len(pixels), 3))
+        for s in range(samples):
+            if self.batch_shading:
+                rays = [self.camera_ray(i, j, stream + s) for i, j in pixels]
+                color_sum += self.trace_batch(rays, [(i, j, stream + s) for i, j in pixels])
+                continue
+            for k, (i, j) in enumerate(pixels):
+                color_sum[k] += self.sample_color(i, j, stream + s).unwrap()
+        return color_sum
+
+    #color of one jittered sample through pixel (i, j), index numbers the samples of a pixel for the sample pattern
+    def sample_color(self, i, j, index=0):
+        return self.trace(self.camera_ray(i, j, index))
+
+    #jittered camera ray of one sample through pixel (i, j)
+    def camera_ray(self, i, j, index=0):
+        if self.pattern is None:
+            v = (j + random.uniform(0,1)) / (self.image_height-1)
+            u = (i + random.uniform(0,1)) / (self.image_width-1)
+        else:
+            self.current_sample = (i, j, index)
+            du, dv = self.pattern.sample2d(i, j, index, samplers.CAMERA_DIM)
+            v = (j + dv) / (self.image_height-1)
+            u = (i + du) / (self.image_width-1)
+        return self.camera.get_ray(u, v)
+
+    #2D sample for the scatter direction of a bounce of the current sample, None without a sample pattern
+    def scatter_sample(self, bounce):
+        if self.pattern is None:
+            return None
+        i, j, index = self.current_sample
+        return self.pattern.sample2d(i, j, index, samplers.scatter_dim(bounce))
+
+    #uniform number in [0, 1) for the russian roulette of a bounce of the current sample
+    def roulette_sample(self, bounce):
+        if self.pattern is None:
+            return random.random()
+        i, j, index = self.current_sample
+        return self.pattern.sample2d(i, j, index, samplers.roulette_dim(bounce))[0]
+
+    #views of the denoiser's buffers by name, in the same orientation as the image
+    def aov_buffers(self):
+        return denoise.aov_views(self.aov_arr.get_obj(), self.image_height, self.image_width)
+
+    #filters the rendered frame with its feature buffers and returns the tonemapped pixels,
+    #the noisy image and the buffers are saved next to fname
+    def denoise_image(self, fname, noisy):
+        buffers = self.aov_buffers()
+        start = time.perf_counter()
+        color = denoise.atrous(buffers, self.denoise_iterations)
+        print(f"Denoised in {time.perf_counter() - start:.2f}s")
+        denoise.save_buffers(fname, noisy, buffers)
+        return film.tonemap(color, 1)
+
+    #samples taken per pixel, in the same orientation as the image
+    def sample_count_array(self):
+        counts = np.frombuffer(self.sample_counts.get_obj(), dtype=np.int32)
+        return counts.reshape((self.image_height,self.image_width))
+
+    #draw the image, a fixed pool of worker processes pulls tiles from a queue
     def run(self, fname="scene.png"):
         print(f"Generating image {self.image_height} tall and {self.image_width} wide")
+        self.report_startup()
+
+        if self.stream_output:
+            output = TileOutput(fname, self.image_height, self.image_width)
+            self.scheduler = TileScheduler(self, self.num_workers, self.tile_size, work=output.render_tile)
+        else:
+            self.scheduler = TileScheduler(self, self.num_workers, self.tile_size)
+        self.scheduler.run()
+        self.report_counters(fname, self.scheduler.counters, self.scheduler.wall_time,
+            self.scheduler.timings, self.scheduler.workers)
+
+        if self.stream_output:
+            output.finish()
+            print(f"Image streamed to {fname}")
+            self.save_sample_counts(fname)
+            return
 
-        threads = []
-        S = 10
-        for j in range(0, math.ceil(self.image_height/S), 1):
-            j_start = j*S
-            j_stop = min(((j+1)*S),(self.image_height-1))
-            t = mp.Process(target=self.color_rows, args=(j_start, j_stop))
-
-            t.start()
-            threads.append(t)
-
-        [t.join() for t in threads]
         arr = np.frombuffer(self.mp_arr.get_obj(), dtype=np.uint8) 
         arr = arr.reshape((self.image_height,self.image_width,3)) # b and arr share the same memory
+        if self.denoise:
+            arr = self.denoise_image(fname, arr)
+
+        self.print_image(fname, arr)
+        self.save_sample_counts(fname)
+
+    #writes the sample count heatmap next to the image and reports the samples saved
+    def save_sample_counts(self, fname):
+        if not self.adaptive:
+            return
+        counts = self.sample_count_array()
+        adaptive.write_heatmap(counts, self.samples_per_pixel, adaptive.heatmap_name(fname))
+        adaptive.report_savings(counts, self.samples_per_pixel)
+
+    #draw the image in passes of pass_samples, checkpointing the accumulated colors to checkpoint_dir
+    #resumes from an existing checkpoint, and samples larger than a finished render adds more passes
+    def run_progressive(self, fname="scene.png", checkpoint_dir="checkpoint", samples=None):
+        print(f"Generating image {self.image_height} tall and {self.image_width} wide progressively")
+        self.report_startup()
+
+        render = ProgressiveRender(self, checkpoint_dir, self.pass_samples)
+        arr = render.run(samples or self.samples_per_pixel, fname)
+        self.print_image(fname, arr)
+
+    #draw a quick coarse image, then refine it until the time budget or the target error is reached,
+    #budget and target_error override preview_budget and preview_target_error
+    def run_preview(self, fname="scene.png", budget=None, target_error=None):
+        print(f"Generating image {self.image_height} tall and {self.image_width} wide as a preview")
+        self.report_startup()
+
+        render = PreviewRender(self, self.preview_interval, self.preview_scales)
+        arr = render.run(self.samples_per_pixel, fname,
+            budget if budget is not None else self.preview_budget,
+            target_error if target_error is not None else self.preview_target_error)
+        self.print_image(fname, arr)
+
+    #draw every frame of an animation.Animation into fname.format(frame) with one pool of workers,
+    #the per frame timings are returned and also written to timings_fname if given
+    def run_animation(self, animation, fname="frame_{:04d}.png", timings_fname=None):
+        print(f"Generating {animation.frames} frames {self.image_height} tall and {self.image_width} wide")
+        self.report_startup()
 
+        render = AnimationRender(self, animation, self.rebuild_threshold)
+        return render.run(fname, timings_fname)
+
+    #draw the image on remote workers, see distributed.py
+    #blocks until workers connected to address have rendered every tile
+    def run_distributed(self, fname="scene.png", address=("", 7000), authkey=distributed.AUTHKEY):
+        print(f"Generating image {self.image_height} tall and {self.image_width} wide on distributed workers")
+        self.report_startup()
+
+        coordinator = distributed.Coordinator(self, address, authkey)
+        arr = coordinator.run()
         self.print_image(fname, arr)
 
     #draw the image, using a single thread
     def run_singlethread(self, fname = "scene.png"):
         print(f"Generating image {self.image_height} tall and {self.image_width} wide")
+        self.report_startup()
 
-        for j in range(0, self.image_height, 1):
-            if j%10 == 0:
-                print(f"{100*(j/self.image_height):.2f}% done... \
+        start = time.perf_counter()
+        output = TileOutput(fname, self.image_height, self.image_width) if self.stream_output else None
+        for j in range(0, self.image_height, 10):
+            print(f"{100*(j/self.image_height):.2f}% done... \
     Average intersections per ray : {(self.world.count / self.world.ray_count):.2f}")
-            for i in range(self.image_width-1, -1, -1):
-                
-                color = Vec3(0,0,0)
-                for _ in range(self.samples_per_pixel):
-
-                    v = (j + random.uniform(0,1)) / (self.image_height-1)
-                    u = (i + random.uniform(0,1)) / (self.image_width-1)
-                    ray = self.camera.get_ray(u, v)
-                    color += self.ray_color(ray, self.world, self.ray_depth)
-                self.write_color(j, i , color, self.img)
-        self.print_image(fname, self.img)
-
-
-    #writes a color to the output image
-    def write_color(self, j, i , color, arr):
-        def clamp (x, min, max):
-            if (x < min): return min
-            if (x > max): return max
-            return x
-        color /= self.samples_per_pixel
-        color = color.sqrt()
-        final_color = Vec3(
-            int(256 * clamp(color.x, 0.0, 0.999)),
-            int(256 * clamp(color.y, 0.0, 0.999)),
-            int(256 * clamp(color.z, 0.0, 0.999)),
-        )
-        #PIL top right is (0,0)
-        arr[-j+(self.image_height-1),i] = final_color.unwrap()
-
-    #save the image to a file
+            if output:
+                output.render_tile(self, Tile(0, j, min(j+10, self.image_height), 0, self.image_width))
+            else:
+                self.color_tile(j, min(j+10, self.image_height), 0, self.image_width, self.img)
+        self.report_counters(fname, self.counters(), time.perf_counter() - start)
+        if output:
+            output.finish()
+        elif self.denoise:
+            self.print_image(fname, self.denoise_image(fname, self.img))
+        else:
+            self.print_image(fname, self.img)
+        self.save_sample_counts(fname)
+
+
+    #prints the time from creating the RayTracer (loading or building the scene, the BVH and textures)
+    #to the first ray, worker processes start after that
+    def report_startup(self):
+        self.startup_seconds = time.perf_counter() - self.created
+        print(f"Startup took {self.startup_seconds:.3f}s to the first ray")
+
+    #save the image to a file, and open it in the image viewer unless headless
     def print_image(self,fname,arr):
         pic = Image.fromarray(arr, 'RGB')
         pic.save(fname)
-        pic.show()
+        if not self.headless:
+            pic.show()
+
 
+    #color of a camera ray, following its path with the selected engine
+    def trace(self, ray):
+        self.path_count += 1
+        if self.use_iterative:
+            return self.ray_color_iterative(ray, self.world, self.ray_depth)
+        return self.ray_color(ray, self.world, self.ray_depth)
 
     #return the color of a ray shot into the world
     def ray_color(self, ray, world, depth):
@@ -139,10 +524,13 @@ class RayTracer():
         if depth <= 0:
             return Vec3(0,0,0)
 
+        self.segment_count += 1
         obj = world.hit(ray,0.001, collision)
         if obj:
-            bounced_ray, attenutation = obj.material.scatter(ray, collision)
-            if any(v == 0 for v in bounced_ray.direction.unwrap()):
+            if self.hit_counts is not None:
+                metrics.count_hit(self.hit_counts, obj)
+            bounced_ray, attenutation = obj.material.scatter(ray, collision, self.scatter_sample(self.ray_depth - depth))
+            if bounced_ray.direction.has_zero():
                 return Vec3(0,0,0)
             return attenutation * self.ray_color(bounced_ray, world, depth-1)
             
@@ -150,16 +538,191 @@ class RayTracer():
         t = 0.5*(ray_dir.y + 1.0)
         return Vec3(1, 1, 1)*(1.0-t) + Vec3(0.3, 0.5, 0.8)*t
 
+    #same as ray_color, but bounces in a loop carrying the product of attenuations (the throughput)
+    #with russian_roulette, paths past rr_min_depth survive with probability equal to their
+    #largest throughput component and are divided by that probability when they do
+    def ray_color_iterative(self, ray, world, depth):
+        throughput = Vec3(1, 1, 1)
+        rr_depth = self.rr_min_depth if self.russian_roulette else depth
+
+        for bounce in range(depth):
+            collision = CollisionPacket()
+            self.segment_count += 1
+            obj = world.hit(ray, 0.001, collision)
+            if not obj:
+                ray_dir = ray.unit_direction()
+                t = 0.5*(ray_dir.y + 1.0)
+                return throughput*(Vec3(1, 1, 1)*(1.0-t) + Vec3(0.3, 0.5, 0.8)*t)
+
+            if self.hit_counts is not None:
+                metrics.count_hit(self.hit_counts, obj)
+            ray, attenutation = obj.material.scatter(ray, collision, self.scatter_sample(bounce))
+            if ray.direction.has_zero():
+                return Vec3(0,0,0)
+            throughput = throughput*attenutation
+
+            if bounce+1 >= rr_depth:
+                p = min(max(throughput.x, throughput.y, throughput.z), 1.0)
+                if self.roulette_sample(bounce) >= p:
+                    return Vec3(0,0,0)
+                throughput = throughput/p
+
+        return Vec3(0,0,0)
+
+    #colors of a list of camera rays, like ray_color_iterative but bouncing all of them together:
+    #every ray is intersected with world.hit, then the hits of the bounce are shaded as one batch
+    #keys holds the (i, j, sample index) of every ray for the sample pattern
+    def trace_batch(self, rays, keys):
+        world = self.world
+        scene = self.shading_scene()
+        n = len(rays)
+        color = np.zeros((n, 3))
+        throughput = np.ones((n, 3))
+        path = np.arange(n)
+        keys = np.array(keys, dtype=np.uint64).reshape((n, 3))
+        #random numbers follow the random module's state, which every worker reseeds
+        rng = np.random.default_rng(random.getrandbits(64))
+        rr_depth = self.rr_min_depth if self.russian_roulette else self.ray_depth
+        self.path_count += n
+
+        for bounce in range(self.ray_depth):
+            if not rays:
+                break
+            self.segment_count += len(rays)
+            hit = np.zeros(len(rays), dtype=bool)
+            collisions = []
+            materials = []
+            for k, ray in enumerate(rays):
+                collision = CollisionPacket()
+                obj = world.hit(ray, 0.001, collision)
+                if obj:
+                    hit[k] = True
+                    collisions.append(collision)
+                    materials.append(self.material_index[id(obj)])
+                    if self.hit_counts is not None:
+                        metrics.count_hit(self.hit_counts, obj)
+
+            directions = np.array([ray.direction.unwrap() for ray in rays], dtype=np.float64)
+            miss = ~hit
+            if miss.any():
+                color[path[miss]] += throughput[miss]*shading.sky_color(directions[miss])
+            path = path[hit]
+            throughput = throughput[hit]
+            keys = keys[hit]
+            if len(path) == 0:
+                break
+
+            hits = shading.HitRecords.from_collisions(collisions, materials)
+            if self.pattern is None:
+                samples = lambda idx: rng.random((2, len(idx)))
+            else:
+                dim = samplers.scatter_dim(bounce)
+                samples = lambda idx: self.pattern.sample2d(keys[idx, 0], keys[idx, 1], keys[idx, 2], dim)
+            direction, attenuation = shading.shade(scene, hits, directions[hit], samples)
+            alive = ~(direction == 0).any(axis=1)
+            throughput = throughput*attenuation
+
+            if bounce+1 >= rr_depth:
+                p = np.minimum(throughput.max(axis=1), 1.0)
+                if self.pattern is None:
+                    u = rng.random(len(p))
+                else:
+                    u = self.pattern.sample2d(keys[:, 0], keys[:, 1], keys[:, 2], samplers.roulette_dim(bounce))[0]
+                survive = alive & (u < p)
+                throughput[survive] /= p[survive][:, None]
+                alive = survive
+
+            path = path[alive]
+            throughput = throughput[alive]
+            keys = keys[alive]
+            rays = [Ray(Vec3(*o), Vec3(*d)) for o, d in zip(hits.p[alive].tolist(), direction[alive].tolist())]
+
+        return color
+
+    #packed scene batch_shading reads the materials from, built once per process,
+    #and material_index, the packed material index of every object by id
+    def shading_scene(self):
+        if self.shade_scene is None:
+            if self.shared is not None:
+                self.shade_scene = self.shared.packed()
+            else:
+                self.shade_scene = PackedScene.from_world(self.world)
+            self.material_index = {id(obj): m
+                for obj, m in zip(self.world.hittables, self.shade_scene.object_materials().tolist())}
+        return self.shade_scene
+
+    #counters of the work done in this process so far, see metrics.py
+    #box_tests are BVH boxes tested, node_visits the boxes a ray passed through (flat traversal only,
+    #with packets the nodes a packet visited) and cell_visits the grid cells a ray walked through,
+    #the work inside the bottom level BVHs of mesh instances is included
+    def counters(self):
+        world = self.world
+        box_tests = 0
+        node_visits = 0
+        cell_visits = 0
+        if world.grid is not None:
+            cell_visits = world.grid.cell_visits
+        elif world.use_bb and world.traversal == "flat":
+            box_tests = world.flat_bvh.node_visits
+            node_visits = world.flat_bvh.nodes_entered
+        elif world.use_bb:
+            box_tests = BVH_node.visits
+        blas_box_tests, blas_entered, blas_prim_tests = world.blas_work()
+        counters = {
+            "paths": self.path_count,
+            "segments": self.segment_count,
+            "box_tests": box_tests + blas_box_tests,
+            "node_visits": node_visits + blas_entered,
+            "cell_visits": cell_visits,
+            "prim_tests": world.count + blas_prim_tests,
+            "closer_hits": world.closer_hits,
+            "attr_fills": world.fills,
+            "uv_fills": world.uv_fills,
+        }
+        if self.use_wavefront:
+            counters["paths"] += self.wavefront.path_count
+            counters["segments"] += self.wavefront.segment_count
+            counters["prim_tests"] += self.wavefront.prim_tests
+            counters["box_tests"] += self.wavefront.box_tests
+            counters["node_visits"] += self.wavefront.node_visits
+            counters["closer_hits"] += self.wavefront.closer_hits
+            counters["attr_fills"] += self.wavefront.attr_fills
+            counters["uv_fills"] += self.wavefront.uv_fills
+        if self.hit_counts:
+            metrics.add_counters(counters, self.hit_counts)
+        return counters
+
+    #prints the average path length and ray throughput of a render
+    #with collect_metrics, also writes the JSON report next to fname
+    def report_counters(self, fname, counters, seconds, timings=None, workers=1):
+        report = metrics.build_report(counters, seconds, timings, workers, self.startup_seconds)
+        if counters.get("cell_visits", 0):
+            visited = f"{report['per_segment']['cell_visits']:.1f} grid cells"
+        else:
+            visited = f"{report['per_segment']['box_tests']:.1f} box tests"
+        print(f"{counters['paths']} paths, {counters['segments']} rays, "
+            f"average path length {report['per_path']['segments']:.2f}, "
+            f"{visited} and {report['per_segment']['prim_tests']:.1f} "
+            f"primitive tests per ray, {report['rays_per_second']:.0f} rays/sec")
+        per_ray = report["per_segment"]
+        print(f"Attribute computations per ray: {per_ray['attr_fills']:.2f} "
+            f"({per_ray['uv_fills']:.2f} with texture coordinates)"
+            + (f", {per_ray['closer_hits']:.2f} with one for every closer hit"
+                if counters.get("closer_hits", 0) else ""))
+        if self.collect_metrics:
+            metrics.write_report(metrics.report_name(fname), report)
+
+#parameters that can be passed to RayTracer()
+RENDER_SETTINGS = [name for name, value in vars(RayTracer).items()
+    if not name.startswith("_") and not callable(value)]
+
 #checks if two spheres overlap
 def are_colliding(c1, r1, c2, r2):
     dist = math.sqrt((c1 - c2).len_squared())
     return dist < (r1+r2)
 
-#main driver
-def main():
-    #PARAMETERS
-    rt = RayTracer(lookat = Vec3(0,0,0), lookfrom = Vec3(0,4,-4)) 
-    NUM_SPHERES = 40
+#adds the wooden floor and num_spheres random spheres that do not collide
+def build_scene(rt, num_spheres=40):
     #floor plane dimensions
     floor_l = -10
     floor_r = 10
@@ -171,7 +734,7 @@ def main():
 
     # generate random spheres that do not collide
     spheres = [Sphere( Vec3(0.0,   2.0, 0.0), 2, Metal(SolidColor(Vec3(1.0,1.0,1.0))) )]
-    while(len(spheres)< NUM_SPHERES):
+    while(len(spheres)< num_spheres):
         test_radius = uniform(0.5,1.5)
         test_center = Vec3(random.uniform(-10,10), test_radius, random.uniform(-4,10))
 
@@ -186,6 +749,19 @@ def main():
 
     for s in spheres:
         rt.add_object(s)
+
+#main driver, renders the scene file given as the first argument or the default random scene
+def main():
+    if len(sys.argv) > 1:
+        from scenefile import load_scene
+        rt = load_scene(sys.argv[1])
+        rt.run()
+        return
+
+    #PARAMETERS
+    rt = RayTracer(lookat = Vec3(0,0,0), lookfrom = Vec3(0,4,-4)) 
+    NUM_SPHERES = 40
+    build_scene(rt, NUM_SPHERES)
     
     rt.finalize()
     rt.run()
@@ -13,11 +13,19 @@ from typing import Tuple
 from PIL import Image
 import numpy as np
 import random
+import os
+import io
+import hashlib
+import pickle
+import tempfile
 
 
 #Abstract class representing a material color
 #Textures are sampled using u,v coordinates
 class Color(ABC):
+    #whether value reads the collision's u, v and footprint, see Material.needs_uv
+    uses_uv = True
+
     @property
     @abstractmethod
     def value(self, u, v) -> Vec3:
@@ -25,6 +33,8 @@ class Color(ABC):
 
 #Uniform color
 class SolidColor(Color):
+    uses_uv = False
+
     def __init__(self, color):
         self.color = color
     def value(self, collision):
@@ -45,22 +55,181 @@ class CheckerColor(Color):
             else:
                 return Vec3(0.9,0.9,0.3)
 
+#Decoded textures, shared by every Texture using the same image file
+#Each image is decoded once into a pyramid of uint8 mip levels saved as .npy files in a cache directory.
+#Levels are memory mapped read only, so all materials and all worker processes read the same pages
+#instead of each holding a private float copy
+class TextureCache():
+    directory = os.path.join(tempfile.gettempdir(), "raytracer_textures")
+    #per process: cache key -> list of mip levels, level 0 is full resolution
+    loaded = {}
+
+    #key of an image file, changes when the file is modified
+    @classmethod
+    def key(cls, fname):
+        st = os.stat(fname)
+        ident = f"{os.path.abspath(fname)}:{st.st_size}:{st.st_mtime_ns}"
+        return hashlib.sha1(ident.encode()).hexdigest()[:16]
+
+    @classmethod
+    def get(cls, fname):
+        return cls.levels(cls.key(fname), lambda: np.asarray(Image.open(fname).convert("RGB")))
+
+    #mip levels stored under key, decode() is only called if they are not cached yet
+    @classmethod
+    def levels(cls, key, decode):
+        if key in cls.loaded:
+            return cls.loaded[key]
+
+        paths = cls.level_paths(key)
+        if paths is None:
+            paths = cls.store(key, build_mips(decode()))
+        levels = [np.load(path, mmap_mode="r") for path in paths]
+        cls.loaded[key] = levels
+        return levels
+
+    @classmethod
+    def level_paths(cls, key):
+        count_path = os.path.join(cls.directory, f"{key}.levels")
+        if not os.path.exists(count_path):
+            return None
+        with open(count_path) as f:
+            count = int(f.read())
+        return [os.path.join(cls.directory, f"{key}_{level}.npy") for level in range(count)]
+
+    #writes each level to a temporary file first, so a process reading the cache never sees a partial file
+    @classmethod
+    def store(cls, key, mips):
+        os.makedirs(cls.directory, exist_ok=True)
+        paths = []
+        for level, img in enumerate(mips):
+            path = os.path.join(cls.directory, f"{key}_{level}.npy")
+            tmp = f"{path}.{os.getpid()}.tmp"
+            with open(tmp, "wb") as f:
+                np.save(f, img)
+            os.replace(tmp, path)
+            paths.append(path)
+        count_path = os.path.join(cls.directory, f"{key}.levels")
+        tmp = f"{count_path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            f.write(str(len(mips)))
+        os.replace(tmp, count_path)
+        return paths
+
+#mip pyramid of a uint8 image, each level averages 2x2 blocks of the one above it down to 1x1
+def build_mips(img):
+    mips = [np.ascontiguousarray(img, dtype=np.uint8)]
+    while mips[-1].shape[0] > 1 or mips[-1].shape[1] > 1:
+        prev = mips[-1].astype(np.float32)
+        #odd sizes repeat their last row or column
+        if prev.shape[0] > 1 and prev.shape[0] % 2:
+            prev = np.concatenate([prev, prev[-1:]], axis=0)
+        if prev.shape[1] > 1 and prev.shape[1] % 2:
+            prev = np.concatenate([prev, prev[:, -1:]], axis=1)
+        if prev.shape[0] > 1:
+            prev = 0.5*(prev[0::2] + prev[1::2])
+        if prev.shape[1] > 1:
+            prev = 0.5*(prev[:, 0::2] + prev[:, 1::2])
+        mips.append(np.round(prev).astype(np.uint8))
+    return mips
+
 #A textture, loads from an image file
+#The pixels come from the TextureCache, so a Texture pickles as just its file name and cache key.
+#Lookups are bilinear, and blend between two mip levels chosen from collision.footprint,
+#the width of the ray's footprint in texture coordinates
 class Texture(Color):
-    def __init__(self, fname):
+    def __init__(self, fname, filtered=True):
         print(f"Loading Texture from: {fname}")
-        image = Image.open(fname)
-        self.img = np.asarray(image).astype(float)
-        self.img /= 255
-        self.height = self.img.shape[0]
-        self.width = self.img.shape[1]
+        self.fname = fname
+        self.filtered = filtered
+        self.key = TextureCache.key(fname)
+        self.levels = TextureCache.get(fname)
+        self.height = self.levels[0].shape[0]
+        self.width = self.levels[0].shape[1]
         print(f"Done!")
 
+    #full resolution pixels as floats in [0, 1]
+    @property
+    def img(self):
+        return self.levels[0].astype(np.float32) / 255
+
+    def __getstate__(self):
+        return {"fname": self.fname, "filtered": self.filtered, "key": self.key}
+
+    def __setstate__(self, state, decode=None):
+        self.__dict__.update(state)
+        decode = decode or (lambda: np.asarray(Image.open(self.fname).convert("RGB")))
+        self.levels = TextureCache.levels(self.key, decode)
+        self.height = self.levels[0].shape[0]
+        self.width = self.levels[0].shape[1]
+
     def value(self, collision):
-        h = int(collision.v*self.height)
-        w = int(collision.u*self.width)
-        return Vec3.from_array(self.img[h][w])
-    pass
+        if not self.filtered:
+            h = min(int(collision.v*self.height), self.height-1)
+            w = min(int(collision.u*self.width), self.width-1)
+            r, g, b = self.levels[0][h, w].tolist()
+            return Vec3(r/255, g/255, b/255)
+
+        #level of detail: one texel of the chosen level covers the footprint
+        texels = collision.footprint*max(self.width, self.height)
+        lod = math.log2(texels) if texels > 1 else 0.0
+        lod = min(lod, len(self.levels) - 1)
+        level = int(lod)
+        r, g, b = self.bilinear(self.levels[level], collision.u, collision.v)
+        frac = lod - level
+        if frac > 0:
+            r1, g1, b1 = self.bilinear(self.levels[level+1], collision.u, collision.v)
+            r += (r1 - r)*frac
+            g += (g1 - g)*frac
+            b += (b1 - b)*frac
+        return Vec3(r/255, g/255, b/255)
+
+    #bilinear lookup in one mip level, coordinates are clamped to the edges
+    def bilinear(self, img, u, v):
+        height = img.shape[0]
+        width = img.shape[1]
+        x = min(max(u*width - 0.5, 0.0), width - 1.0)
+        y = min(max(v*height - 0.5, 0.0), height - 1.0)
+        x0 = int(x)
+        y0 = int(y)
+        fx = x - x0
+        fy = y - y0
+        block = img[y0:y0+2, x0:x0+2].tolist()
+        p00 = block[0][0]
+        p01 = block[0][-1]
+        p10 = block[-1][0]
+        p11 = block[-1][-1]
+        return [
+            (p00[c]*(1-fx) + p01[c]*fx)*(1-fy) + (p10[c]*(1-fx) + p11[c]*fx)*fy
+            for c in range(3)]
+
+#pickler that stores the full resolution pixels of textures in the stream,
+#for sending a scene to a machine that does not have the image files
+class EmbeddingPickler(pickle.Pickler):
+    def reducer_override(self, obj):
+        if isinstance(obj, Texture):
+            return (texture_from_pixels, (obj.fname, obj.filtered, obj.key, np.asarray(obj.levels[0])))
+        return NotImplemented
+
+#rebuilds a texture sent with EmbeddingPickler, the pixels go into this machine's texture cache
+def texture_from_pixels(fname, filtered, key, pixels):
+    texture = Texture.__new__(Texture)
+    texture.__setstate__({"fname": fname, "filtered": filtered, "key": key}, lambda: pixels)
+    return texture
+
+#pickles obj with textures embedded, see EmbeddingPickler
+def dumps_embedded(obj):
+    buf = io.BytesIO()
+    EmbeddingPickler(buf).dump(obj)
+    return buf.getvalue()
+
+#uniformly distributed unit vector for a 2D sample (u, v): z is uniform in [-1, 1] and the angle around z in [0, 2pi)
+def unit_sphere_direction(sample):
+    u, v = sample
+    z = 1.0 - 2.0*u
+    r = math.sqrt(max(0.0, 1.0 - z*z))
+    phi = 2.0*math.pi*v
+    return Vec3(r*math.cos(phi), r*math.sin(phi), z)
 
 
 #Parents class for materials
@@ -69,31 +238,44 @@ class Texture(Color):
 class Material(ABC):
     albedo = None
 
+    #objects skip computing texture coordinates and footprint of hits on materials that never read them
+    @property
+    def needs_uv(self):
+        return self.albedo is not None and self.albedo.uses_uv
+
     def reflect(self, v, n) -> Vec3:
-        return v - 2*Vec3.dot(v,n)*n 
+        return Vec3.reflect(v, n)
 
+    #r_out_perp = ratio*(uv + cos_theta*n), r_out_parallel = -sqrt(|1 - |r_out_perp|^2|)*n
     def refract(self, uv, n, refact_ratio) -> Vec3:
-        cos_theta = min(Vec3.dot(-1*uv, n), 1.0)
-        r_out_perp = refact_ratio * (uv + (cos_theta*n))
-        r_out_parallel = -1*math.sqrt(abs(1.0 - r_out_perp.len_squared())) * n
+        cos_theta = min(-(uv.x*n.x + uv.y*n.y + uv.z*n.z), 1.0)
+        px = refact_ratio*(uv.x + cos_theta*n.x)
+        py = refact_ratio*(uv.y + cos_theta*n.y)
+        pz = refact_ratio*(uv.z + cos_theta*n.z)
+        k = -math.sqrt(abs(1.0 - (px*px + py*py + pz*pz)))
 
-        return r_out_perp + r_out_parallel
+        return Vec3(px + k*n.x, py + k*n.y, pz + k*n.z)
     
     def random_unit_sphere(self) -> Vec3:
+        rand = random.random
         while (True):
-            p = Vec3.random(-1,1)
-            if (p.len_squared() >= 1):
+            x = 2*rand() - 1
+            y = 2*rand() - 1
+            z = 2*rand() - 1
+            if (x*x + y*y + z*z >= 1):
                 continue
-            return p
+            return Vec3(x, y, z)
 
-    def scatter(self, inc_ray, collision) -> Tuple[Ray, Vec3]:
-        new_ray = self.bounce_ray(inc_ray, collision)
+    #sample is a 2D sample in [0, 1)^2 from samplers.py for the random choices of the bounce,
+    #None draws them from the random module
+    def scatter(self, inc_ray, collision, sample=None) -> Tuple[Ray, Vec3]:
+        new_ray = self.bounce_ray(inc_ray, collision, sample)
         color = self.albedo.value(collision)
         return (new_ray, color)
 
     @property
     @abstractmethod
-    def bounce_ray(self, inc_ray, collision) -> Ray:
+    def bounce_ray(self, inc_ray, collision, sample=None) -> Ray:
         pass
 
 
@@ -105,9 +287,14 @@ class Lambertian(Material):
         else:
             self.albedo = albedo
 
-    def bounce_ray(self, inc_ray, collision):
-        rand_dir = self.random_unit_sphere().unit_length()
-        scatter_direction = collision.normal + rand_dir
+    def bounce_ray(self, inc_ray, collision, sample=None):
+        n = collision.normal
+        if sample is None:
+            rand_dir = self.random_unit_sphere()
+            inv_len = 1.0 / math.sqrt(rand_dir.len_squared())
+            scatter_direction = Vec3.madd(n, rand_dir, inv_len)
+        else:
+            scatter_direction = n + unit_sphere_direction(sample)
 
         if scatter_direction.len_squared() < 0.001:
             scatter_direction = collision.normal
@@ -123,8 +310,8 @@ class Metal(Material):
         else:
             self.albedo = albedo
 
-    def bounce_ray(self, inc_ray, collision):
-        scatter_direction = self.reflect(inc_ray.unit_direction(), collision.normal)
+    def bounce_ray(self, inc_ray, collision, sample=None):
+        scatter_direction = Vec3.reflect(inc_ray.unit_direction(), collision.normal)
         if scatter_direction.len_squared() < 0.001:
             scatter_direction = collision.normal
         scattered = Ray(collision.p, scatter_direction)
@@ -136,21 +323,21 @@ class Dielectric(Material):
         self.index_of_refract = index_of_refract
         self.albedo = SolidColor(Vec3(1,1,1))
         
-    def bounce_ray(self, inc_ray, collision):
+    def bounce_ray(self, inc_ray, collision, sample=None):
         if collision.front_face:
             refraction_ratio = 1 / self.index_of_refract
         else:
             refraction_ratio = self.index_of_refract
 
         unit_direction = inc_ray.unit_direction()
-        cos_theta = min(Vec3.dot(-1*unit_direction, collision.normal), 1.0)
-        sin_theta = math.sqrt(1.0 - cos_theta*cos_theta)
+        cos_theta = min(-Vec3.dot(unit_direction, collision.normal), 1.0)
+        sin_theta = math.sqrt(max(0.0, 1.0 - cos_theta*cos_theta))
 
         cannot_refract = refraction_ratio * sin_theta > 1.0
         if (cannot_refract):
-            refract_direction = self.reflect(inc_ray.unit_direction(), collision.normal)
+            refract_direction = Vec3.reflect(unit_direction, collision.normal)
         else:
-            refract_direction = self.refract(inc_ray.unit_direction(), collision.normal, refraction_ratio)
+            refract_direction = self.refract(unit_direction, collision.normal, refraction_ratio)
 
         scattered = Ray(collision.p, refract_direction)
         return scattered
\ No newline at end of file
@@ -0,0 +1,309 @@
+'''
+Triangle meshes and instances
+A TriangleMesh holds packed numpy arrays of vertex positions, optional texture coordinates and
+triangles as vertex indices, loaded from Wavefront OBJ files by load_obj. Its bottom level BVH
+(a FlatBVH over its triangles, built with the SAH builder) is built once, in the mesh's own object space.
+An Instance places a mesh in the world with an affine Transform and a material. Instances are
+ordinary objects of the World, so they go into the world's (top level) BVH like spheres do,
+and a ray that reaches one is moved into the mesh's object space and traced through the
+shared bottom level BVH. A thousand instances of a mesh keep one copy of its triangles and BVH.
+
+    mesh = TriangleMesh.load("bunny.obj")
+    rt.add_object(Instance(mesh, Transform.from_trs((0, 1, 0), rotate=(0, 90, 0), scale=2), Lambertian()))
+'''
+
+import math
+import time
+import numpy as np
+from util import *
+from boundingbox import *
+from objects import *
+
+#triangles are padded by this much so triangles in an axis aligned plane still have a box with volume
+TRIANGLE_PAD = 1e-6
+
+#affine transform, a 3x4 matrix applied to column vectors, with its inverse
+#matrices are kept as tuples of 12 floats, which are the fastest to unpack per ray
+class Transform():
+    def __init__(self, matrix):
+        m = np.asarray(matrix, dtype=np.float64)[:3, :4]
+        inv = np.linalg.inv(np.vstack([m, [0.0, 0.0, 0.0, 1.0]]))[:3]
+        self.matrix = tuple(m.ravel().tolist())
+        self.inverse = tuple(inv.ravel().tolist())
+
+    #scales, then rotates about x, y and z (degrees) and then translates
+    @classmethod
+    def from_trs(cls, translate=(0, 0, 0), rotate=(0, 0, 0), scale=1.0):
+        ax, ay, az = (math.radians(a) for a in rotate)
+        rx = np.array([[1, 0, 0], [0, math.cos(ax), -math.sin(ax)], [0, math.sin(ax), math.cos(ax)]])
+        ry = np.array([[math.cos(ay), 0, math.sin(ay)], [0, 1, 0], [-math.sin(ay), 0, math.cos(ay)]])
+        rz = np.array([[math.cos(az), -math.sin(az), 0], [math.sin(az), math.cos(az), 0], [0, 0, 1]])
+        linear = rz @ ry @ rx @ np.diag(np.broadcast_to(np.asarray(scale, dtype=np.float64), 3))
+        return cls(np.hstack([linear, np.asarray(translate, dtype=np.float64).reshape((3, 1))]))
+
+    def point(self, x, y, z):
+        m = self.matrix
+        return (m[0]*x + m[1]*y + m[2]*z + m[3],
+            m[4]*x + m[5]*y + m[6]*z + m[7],
+            m[8]*x + m[9]*y + m[10]*z + m[11])
+
+    #world space box around a box of the object space
+    def box(self, bb):
+        lo, hi = bb.minv, bb.maxv
+        corners = [self.point(x, y, z) for x in (lo.x, hi.x) for y in (lo.y, hi.y) for z in (lo.z, hi.z)]
+        return BB(Vec3(*(min(c[a] for c in corners) for a in range(3))),
+            Vec3(*(max(c[a] for c in corners) for a in range(3))))
+
+#one triangle of a mesh, in the mesh's object space
+#only used inside the mesh's bottom level BVH: fill leaves the outward normal in the collision packet
+#and the Instance that was hit turns it into a world space normal against the ray
+class Triangle():
+    __slots__ = ("index", "v0", "e1", "e2", "normal", "uv", "bb")
+
+    def __init__(self, index, p0, p1, p2, uv=None):
+        self.index = index
+        self.v0 = p0
+        self.e1 = (p1[0] - p0[0], p1[1] - p0[1], p1[2] - p0[2])
+        self.e2 = (p2[0] - p0[0], p2[1] - p0[1], p2[2] - p0[2])
+        e1, e2 = self.e1, self.e2
+        nx = e1[1]*e2[2] - e1[2]*e2[1]
+        ny = e1[2]*e2[0] - e1[0]*e2[2]
+        nz = e1[0]*e2[1] - e1[1]*e2[0]
+        length = math.sqrt(nx*nx + ny*ny + nz*nz) or 1.0
+        self.normal = Vec3(nx/length, ny/length, nz/length)
+        #(u0, v0, u1 - u0, v1 - v0, u2 - u0, v2 - v0), None uses the barycentric coordinates
+        self.uv = uv
+        pad = TRIANGLE_PAD
+        self.bb = BB(Vec3(*(min(p0[a], p1[a], p2[a]) - pad for a in range(3))),
+            Vec3(*(max(p0[a], p1[a], p2[a]) + pad for a in range(3))))
+
+    def get_y(self):
+        return self.v0[1] + (self.e1[1] + self.e2[1])/3
+
+    #Moller-Trumbore intersection, hits from both sides
+    #distance only, see Object.hit_t
+    def hit_t(self, ray, t_min, t_max):
+        o = ray.origin
+        d = ray.direction
+        dx, dy, dz = d.x, d.y, d.z
+        e1x, e1y, e1z = self.e1
+        e2x, e2y, e2z = self.e2
+        px = dy*e2z - dz*e2y
+        py = dz*e2x - dx*e2z
+        pz = dx*e2y - dy*e2x
+        det = e1x*px + e1y*py + e1z*pz
+        if det == 0.0:
+            return None
+        inv_det = 1.0/det
+        v0 = self.v0
+        tx = o.x - v0[0]
+        ty = o.y - v0[1]
+        tz = o.z - v0[2]
+        b1 = (tx*px + ty*py + tz*pz)*inv_det
+        if b1 < 0.0 or b1 > 1.0:
+            return None
+        qx = ty*e1z - tz*e1y
+        qy = tz*e1x - tx*e1z
+        qz = tx*e1y - ty*e1x
+        b2 = (dx*qx + dy*qy + dz*qz)*inv_det
+        if b2 < 0.0 or b1 + b2 > 1.0:
+            return None
+        t = (e2x*qx + e2y*qy + e2z*qz)*inv_det
+        if t < t_min or t > t_max:
+            return None
+        return t, None
+
+    #the barycentric coordinates are worked out again only if the texture coordinates are needed
+    def fill(self, ray, t, payload, collision_packet, uv=True):
+        d = ray.direction
+        n = self.normal
+        collision_packet.t = t
+        collision_packet.normal = n
+        collision_packet.front_face = d.x*n.x + d.y*n.y + d.z*n.z <= 0
+        if not uv:
+            return
+        o = ray.origin
+        dx, dy, dz = d.x, d.y, d.z
+        e1x, e1y, e1z = self.e1
+        e2x, e2y, e2z = self.e2
+        px = dy*e2z - dz*e2y
+        py = dz*e2x - dx*e2z
+        pz = dx*e2y - dy*e2x
+        inv_det = 1.0/(e1x*px + e1y*py + e1z*pz)
+        v0 = self.v0
+        tx = o.x - v0[0]
+        ty = o.y - v0[1]
+        tz = o.z - v0[2]
+        b1 = (tx*px + ty*py + tz*pz)*inv_det
+        b2 = (dx*(ty*e1z - tz*e1y) + dy*(tz*e1x - tx*e1z) + dz*(tx*e1y - ty*e1x))*inv_det
+        uv = self.uv
+        if uv is None:
+            collision_packet.u = b1
+            collision_packet.v = b2
+        else:
+            collision_packet.u = uv[0] + b1*uv[2] + b2*uv[4]
+            collision_packet.v = uv[1] + b1*uv[3] + b2*uv[5]
+
+    def hit(self, ray, t_min, t_max, collision_packet):
+        hit = self.hit_t(ray, t_min, t_max)
+        if hit is None:
+            return False
+        self.fill(ray, hit[0], hit[1], collision_packet)
+        return True
+
+#triangle mesh in packed arrays: vertices (n, 3), indices (m, 3) and optional uvs (n, 2)
+class TriangleMesh():
+    leaf_size = 4
+
+    def __init__(self, vertices, indices, uvs=None, fname=None):
+        self.vertices = np.asarray(vertices, dtype=np.float64).reshape((-1, 3))
+        self.indices = np.asarray(indices, dtype=np.int32).reshape((-1, 3))
+        self.uvs = None if uvs is None else np.asarray(uvs, dtype=np.float64).reshape((-1, 2))
+        self.fname = fname
+        self.triangles = None
+        self.blas = None
+        lo = self.vertices.min(axis=0) if len(self.vertices) else np.zeros(3)
+        hi = self.vertices.max(axis=0) if len(self.vertices) else np.zeros(3)
+        self.bb = BB(Vec3(*(lo - TRIANGLE_PAD).tolist()), Vec3(*(hi + TRIANGLE_PAD).tolist()))
+
+    def __len__(self):
+        return len(self.indices)
+
+    @classmethod
+    def load(cls, fname):
+        start = time.perf_counter()
+        vertices, indices, uvs = load_obj(fname)
+        mesh = cls(vertices, indices, uvs, fname)
+        print(f"Loaded {fname}: {len(vertices)} vertices, {len(indices)} triangles in {time.perf_counter() - start:.3f}s")
+        return mesh
+
+    #the triangle objects, in the order of indices
+    def make_triangles(self):
+        tri = self.vertices[self.indices]
+        points = tri.tolist()
+        if self.uvs is None:
+            uvs = [None]*len(points)
+        else:
+            t = self.uvs[self.indices]
+            uvs = np.concatenate([t[:, 0], t[:, 1] - t[:, 0], t[:, 2] - t[:, 0]], axis=1).tolist()
+        return [Triangle(k, p[0], p[1], p[2], tuple(uv) if uv is not None else None)
+            for k, (p, uv) in enumerate(zip(points, uvs))]
+
+    #builds the bottom level BVH, only the first call does any work
+    def build(self):
+        if self.blas is not None:
+            return self.blas
+        start = time.perf_counter()
+        self.triangles = self.make_triangles()
+        if self.triangles:
+            root = build_sah(list(self.triangles), self.leaf_size)
+            if not isinstance(root, BVH_node):
+                root = BVH_node(root.bb, root, None)
+        else:
+            root = BVH_node(self.bb, None, None)
+        self.blas = FlatBVH.from_tree(root)
+        self.build_seconds = time.perf_counter() - start
+        return self.blas
+
+    #uses a BVH that was already built, e.g. from a PackedScene, prims are triangle indices
+    def attach_blas(self, bounds, offset, count, axis, prims):
+        self.triangles = self.make_triangles()
+        self.blas = FlatBVH(bounds, offset, count, axis, [self.triangles[k] for k in prims])
+        self.build_seconds = 0.0
+
+#a mesh placed in the world by a Transform, with one material for all of its triangles
+class Instance(Object):
+    bb = None
+    def __init__(self, mesh:TriangleMesh, transform:Transform, material:Material):
+        self.mesh = mesh
+        self.material = material
+        mesh.build()
+        self.set_transform(transform)
+
+    #places the instance, the mesh and its BVH are not touched
+    def set_transform(self, transform:Transform):
+        self.transform = transform
+        self.bb = transform.box(self.mesh.bb)
+        size = self.bb.maxv - self.bb.minv
+        #world space length of the unit of texture coordinates, for the ray footprint
+        self.uv_size = max(size.x, size.y, size.z, 1e-9)
+
+    def get_y(self):
+        return (self.bb.minv.y + self.bb.maxv.y)/2
+
+    #moves the ray into object space and traces it through the mesh's BVH
+    #the transformed direction is not normalized, so t is the same in both spaces
+    #the payload is the object space ray and the triangle that was hit, for fill
+    def hit_t(self, ray, t_min, t_max):
+        m = self.transform.inverse
+        o = ray.origin
+        d = ray.direction
+        local = Ray(
+            Vec3(m[0]*o.x + m[1]*o.y + m[2]*o.z + m[3],
+                m[4]*o.x + m[5]*o.y + m[6]*o.z + m[7],
+                m[8]*o.x + m[9]*o.y + m[10]*o.z + m[11]),
+            Vec3(m[0]*d.x + m[1]*d.y + m[2]*d.z,
+                m[4]*d.x + m[5]*d.y + m[6]*d.z,
+                m[8]*d.x + m[9]*d.y + m[10]*d.z))
+        triangle, t, _ = self.mesh.blas.closest(local, t_min, t_max)
+        if not triangle:
+            return None
+        return t, (local, triangle)
+
+    def fill(self, ray, t, payload, collision_packet):
+        local, triangle = payload
+        needs_uv = self.material.needs_uv
+        triangle.fill(local, t, None, collision_packet, needs_uv)
+
+        #normals transform with the inverse transpose, which keeps which side faces the ray
+        m = self.transform.inverse
+        n = collision_packet.normal
+        nx = m[0]*n.x + m[4]*n.y + m[8]*n.z
+        ny = m[1]*n.x + m[5]*n.y + m[9]*n.z
+        nz = m[2]*n.x + m[6]*n.y + m[10]*n.z
+        scale = 1.0/math.sqrt(nx*nx + ny*ny + nz*nz)
+        if not collision_packet.front_face:
+            scale = -scale
+
+        o = ray.origin
+        d = ray.direction
+        collision_packet.p = Vec3(o.x + d.x*t, o.y + d.y*t, o.z + d.z*t)
+        collision_packet.normal = Vec3(nx*scale, ny*scale, nz*scale)
+        if needs_uv:
+            collision_packet.footprint = ray.spread*t*math.sqrt(d.x*d.x + d.y*d.y + d.z*d.z) / self.uv_size
+
+    def __str__(self):
+        return f"Instance of {self.mesh.fname or 'mesh'} ({len(self.mesh)} triangles)"
+
+#reads a Wavefront OBJ file into (vertices, indices, uvs) arrays, uvs is None without texture coordinates
+#polygons are split into fans of triangles, vertex normals, groups and materials are ignored
+#(triangles are shaded with their flat normal). Corners with the same position but different texture
+#coordinates become separate vertices
+def load_obj(fname):
+    positions = []
+    texcoords = []
+    corners = []
+    with open(fname) as f:
+        for line in f:
+            if line.startswith("v "):
+                positions.append(line.split()[1:4])
+            elif line.startswith("vt "):
+                texcoords.append(line.split()[1:3])
+            elif line.startswith("f "):
+                face = [c.split("/") for c in line.split()[1:]]
+                for k in range(1, len(face) - 1):
+                    corners.extend((face[0], face[k], face[k+1]))
+
+    vertices = np.array(positions, dtype=np.float64).reshape((-1, 3))
+    uvs = np.array(texcoords, dtype=np.float64).reshape((-1, 2))
+    pos_idx = np.array([c[0] for c in corners], dtype=np.int64)
+    #negative indices count back from the end, positive ones start at 1
+    pos_idx = np.where(pos_idx < 0, len(vertices) + pos_idx, pos_idx - 1)
+
+    if len(uvs) == 0 or any(len(c) < 2 or c[1] == "" for c in corners):
+        return vertices, pos_idx.astype(np.int32).reshape((-1, 3)), None
+
+    uv_idx = np.array([c[1] for c in corners], dtype=np.int64)
+    uv_idx = np.where(uv_idx < 0, len(uvs) + uv_idx, uv_idx - 1)
+    pairs, inverse = np.unique(np.stack([pos_idx, uv_idx], axis=1), axis=0, return_inverse=True)
+    return vertices[pairs[:, 0]], inverse.astype(np.int32).reshape((-1, 3)), uvs[pairs[:, 1]]
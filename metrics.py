@@ -0,0 +1,79 @@
+'''
+Render metrics
+Every engine keeps plain integer counters of the work it does in its own process: camera rays (paths),
+bounces (ray segments), BVH box tests and nodes entered, grid cells visited, primitive tests, hit attribute
+computations (attr_fills, uv_fills for the ones with texture coordinates, and closer_hits, the ones a single phase
+intersection would have done) and, with collect_metrics, hits per object type and per material. The tile scheduler takes the difference of the counters around
+every tile in the workers and sums them in the parent, together with the wall time of each tile.
+The totals are printed at the end of a render and saved as a JSON report next to the image
+'''
+
+import json
+import os
+
+#counters every engine reports, hit counters are added under "hits.<type>" and "material_hits.<type>"
+COUNTERS = ["paths", "segments", "box_tests", "node_visits", "cell_visits", "prim_tests",
+    "closer_hits", "attr_fills", "uv_fills"]
+
+#adds a hit on obj to a dict of hit counters
+def count_hit(counts, obj):
+    kind = "hits." + type(obj).__name__
+    material = "material_hits." + type(obj.material).__name__
+    counts[kind] = counts.get(kind, 0) + 1
+    counts[material] = counts.get(material, 0) + 1
+
+#adds the counters in b to a
+def add_counters(a, b):
+    for k, v in b.items():
+        a[k] = a.get(k, 0) + v
+    return a
+
+def diff_counters(after, before):
+    return {k: v - before.get(k, 0) for k, v in after.items()}
+
+#file name of the report written next to an image, scene.png -> scene_metrics.json
+def report_name(fname):
+    root, ext = os.path.splitext(fname)
+    return f"{root}_metrics.json"
+
+#totals, averages per camera ray and per bounce, and per tile timings (tile index -> (seconds, pid))
+#startup is the time to the first ray, see RayTracer.report_startup
+def build_report(counters, seconds, timings=None, workers=1, startup=None):
+    paths = max(counters.get("paths", 0), 1)
+    segments = max(counters.get("segments", 0), 1)
+    report = {
+        "seconds": seconds,
+        "workers": workers,
+        "counters": dict(sorted(counters.items())),
+        "rays_per_second": counters.get("segments", 0) / max(seconds, 1e-9),
+        "paths_per_second": counters.get("paths", 0) / max(seconds, 1e-9),
+        "per_path": {
+            "segments": counters.get("segments", 0) / paths,
+        },
+        "per_segment": {
+            "box_tests": counters.get("box_tests", 0) / segments,
+            "node_visits": counters.get("node_visits", 0) / segments,
+            "cell_visits": counters.get("cell_visits", 0) / segments,
+            "prim_tests": counters.get("prim_tests", 0) / segments,
+            "closer_hits": counters.get("closer_hits", 0) / segments,
+            "attr_fills": counters.get("attr_fills", 0) / segments,
+            "uv_fills": counters.get("uv_fills", 0) / segments,
+        },
+    }
+    if startup is not None:
+        report["startup_seconds"] = startup
+    if timings:
+        times = [s for s, _ in timings.values()]
+        report["tiles"] = {
+            "count": len(times),
+            "min_seconds": min(times),
+            "mean_seconds": sum(times) / len(times),
+            "max_seconds": max(times),
+            "seconds": {str(index): s for index, (s, _) in sorted(timings.items())},
+        }
+    return report
+
+def write_report(fname, report):
+    with open(fname, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Metrics written to {fname}")
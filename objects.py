@@ -12,18 +12,26 @@ import sys
 import math
 from abc import ABC, abstractmethod
 from materials import *
-from dataclasses import dataclass
+from grid import UniformGrid
 
 
 #packet describing a ray intersection with an object
-@dataclass
+#slots instead of a dataclass: cheap to create once per ray and no shared default Vec3s
 class CollisionPacket():
-    t          : float = 0          #time to hit
-    p          : Vec3 = Vec3(0,0,0) #hit point
-    normal     : Vec3 = Vec3(0,0,0) #normal of the hit surface, always against the ray
-    front_face : bool = False       #was the surface facing the ray?
-    u          : float = 0          #horizontal texture coordinate
-    v          : float = 0          #vertical texture coordinate
+    __slots__ = ("t", "p", "normal", "front_face", "u", "v", "footprint")
+
+    def __init__(self):
+        self.t = 0              #time to hit
+        self.p = None           #hit point
+        self.normal = None      #normal of the hit surface, always against the ray
+        self.front_face = False #was the surface facing the ray?
+        self.u = 0              #horizontal texture coordinate
+        self.v = 0              #vertical texture coordinate
+        self.footprint = 0      #width of the ray's footprint in texture coordinates, used for texture filtering
+
+#shared normals of flat planes, never modified in place
+UP = Vec3(0,1,0)
+DOWN = Vec3(0,-1,0)
 
 #Parent class for all objects
 #Enforces a ray hit method, bounding box, and y position query
@@ -33,11 +41,29 @@ class Object(ABC):
     def bb(self):
         pass
 
+    #intersection runs in two phases: hit_t only finds the distance to the object along the ray and
+    #returns (t, payload), or None if it is not hit between t_min and t_max. Once the closest object is
+    #known, fill computes the hit point, normal and face orientation of that one hit from t and the
+    #payload hit_t returned with it (whatever the object needs to pick up where hit_t stopped, None for
+    #most objects), with texture coordinates and footprint only for materials that read them (see Material.needs_uv)
     @property
     @abstractmethod
-    def hit(self, ray, t_min, t_max, collision_packet):
+    def hit_t(self, ray, t_min, t_max):
         pass
 
+    @property
+    @abstractmethod
+    def fill(self, ray, t, payload, collision_packet):
+        pass
+
+    #both phases for a single object
+    def hit(self, ray, t_min, t_max, collision_packet):
+        hit = self.hit_t(ray, t_min, t_max)
+        if hit is None:
+            return False
+        self.fill(ray, hit[0], hit[1], collision_packet)
+        return True
+
     @property
     @abstractmethod
     def get_y(self):
@@ -45,7 +71,7 @@ class Object(ABC):
 
     def set_face_normal(self, ray, outward_normal):
         if Vec3.dot(ray.direction, outward_normal) > 0:
-            normal = -1*outward_normal
+            normal = -outward_normal
             front_face = False
         else:
             normal = outward_normal
@@ -68,33 +94,40 @@ class RectFlat(Object):
     def get_y(self):
         return self.k
 
-    def hit(self, ray, t_min, t_max, collision_packet):
-        if ray.direction.y >=0 and ray.origin.y >= self.k:
-            return False
+    def hit_t(self, ray, t_min, t_max):
+        o = ray.origin
+        d = ray.direction
+        if d.y >=0 and o.y >= self.k:
+            return None
 
-        t = (self.k - ray.origin.y) / ray.direction.y
+        t = (self.k - o.y) / d.y
         if t < t_min or t > t_max:
-            return False
+            return None
 
-        x = ray.origin.x + t*ray.direction.x
-        z = ray.origin.z + t*ray.direction.z
+        x = o.x + t*d.x
+        z = o.z + t*d.z
 
         if x<self.x0 or x>self.x1 or z<self.z0 or z>self.z1:
-            return False
+            return None
+        return t, None
+
+    def fill(self, ray, t, payload, collision_packet):
+        o = ray.origin
+        d = ray.direction
+        x = o.x + t*d.x
+        z = o.z + t*d.z
 
-        outward_normal = Vec3(0,1,0)
-        [normal, front_face] = self.set_face_normal(ray, outward_normal)
-        p = ray.at(t)
+        #normal always points against ray, the outward normal is +y
+        front_face = d.y <= 0
 
         collision_packet.t = t
-        collision_packet.p = p
-        collision_packet.normal = normal
+        collision_packet.p = Vec3(x, o.y + t*d.y, z)
+        collision_packet.normal = UP if front_face else DOWN
         collision_packet.front_face = front_face
-        collision_packet.u = (p.x - self.x0) / (self.x1 - self.x0)
-        collision_packet.v = (p.z - self.z0) / (self.z1 - self.z0)
-
-
-        return True
+        if self.material.needs_uv:
+            collision_packet.u = (x - self.x0) / (self.x1 - self.x0)
+            collision_packet.v = (z - self.z0) / (self.z1 - self.z0)
+            collision_packet.footprint = ray.spread*t*math.sqrt(d.x*d.x + d.y*d.y + d.z*d.z) / min(self.x1 - self.x0, self.z1 - self.z0)
 
 #Physical sphere instance
 class Sphere(Object):
@@ -106,17 +139,33 @@ class Sphere(Object):
         self.bb = BB(center - Vec3(radius, radius, radius),
             center + Vec3(radius, radius, radius))
 
+    #same as Sphere(Vec3(x, y, z), radius, material) without the temporary vectors,
+    #for scenes generated with hundreds of thousands of spheres
+    @classmethod
+    def from_values(cls, x, y, z, radius, material):
+        sphere = cls.__new__(cls)
+        sphere.center = Vec3(x, y, z)
+        sphere.radius = radius
+        sphere.material = material
+        sphere.bb = BB(Vec3(x - radius, y - radius, z - radius), Vec3(x + radius, y + radius, z + radius))
+        return sphere
+
     def get_y(self):
         return self.center.y
 
-    def hit(self, ray, t_min, t_max, collision_packet):
-        oc = ray.origin - self.center
-        a = ray.direction.len_squared()
-        half_b = Vec3.dot(oc, ray.direction)
-        c = oc.len_squared() - self.radius*self.radius
+    def hit_t(self, ray, t_min, t_max):
+        o = ray.origin
+        d = ray.direction
+        c = self.center
+        ocx = o.x - c.x
+        ocy = o.y - c.y
+        ocz = o.z - c.z
+        a = d.x*d.x + d.y*d.y + d.z*d.z
+        half_b = ocx*d.x + ocy*d.y + ocz*d.z
+        c = ocx*ocx + ocy*ocy + ocz*ocz - self.radius*self.radius
         discriminant = half_b*half_b - a*c
         if (discriminant < 0):
-            return False
+            return None
         sqrtd = math.sqrt(discriminant)
 
         # Find the nearest root that lies in the acceptable range.
@@ -124,28 +173,36 @@ class Sphere(Object):
         if root < t_min or t_max < root:
             root = (-half_b + sqrtd) / a
             if root < t_min or t_max < root:
-                return False
-
-        t = root
-        p = ray.at(t)
-        outward_normal = (p - self.center) / self.radius
-
-        norm_p = (p - self.center) / self.radius
-        theta = math.acos(-norm_p.y)
-        phi = math.atan2(-norm_p.z, norm_p.x) + math.pi
-        u = phi / (2*math.pi)
-        v = theta / math.pi
+                return None
+        return root, None
+
+    def fill(self, ray, t, payload, collision_packet):
+        o = ray.origin
+        d = ray.direction
+        c = self.center
+        #outward normal (p - center) / radius, from oc without building p first
+        inv_r = 1.0 / self.radius
+        nx = (o.x - c.x + d.x*t)*inv_r
+        ny = (o.y - c.y + d.y*t)*inv_r
+        nz = (o.z - c.z + d.z*t)*inv_r
+
+        if self.material.needs_uv:
+            theta = math.acos(max(-1.0, min(1.0, -ny)))
+            phi = math.atan2(-nz, nx) + math.pi
+            collision_packet.u = phi / (2*math.pi)
+            collision_packet.v = theta / math.pi
+            #v spans half the circumference
+            collision_packet.footprint = ray.spread*t*math.sqrt(d.x*d.x + d.y*d.y + d.z*d.z) / (math.pi*self.radius)
 
         #normal always points against ray
-        [normal, front_face] = self.set_face_normal(ray, outward_normal)
+        front_face = d.x*nx + d.y*ny + d.z*nz <= 0
+        if not front_face:
+            nx, ny, nz = -nx, -ny, -nz
 
         collision_packet.t = t
-        collision_packet.p = p
-        collision_packet.normal = normal
+        collision_packet.p = Vec3(o.x + d.x*t, o.y + d.y*t, o.z + d.z*t)
+        collision_packet.normal = Vec3(nx, ny, nz)
         collision_packet.front_face = front_face
-        collision_packet.u = u
-        collision_packet.v = v
-        return True
 
     def __str__(self):
         return f"Sphere, center {self.center} radius {self.radius}"
@@ -153,39 +210,117 @@ class Sphere(Object):
         
 
 class World():
-    hittables = []
     count = 0
     ray_count = 1
-
-    def __init__(self, BVH_ON=True):
+    #hits that were closer than the ones before them along their ray (what a single phase intersection
+    #computes attributes for), attribute fills actually done, and the fills that computed texture coordinates
+    closer_hits = 0
+    fills = 0
+    uv_fills = 0
+
+    #builder selects how the BVH is constructed:
+    #   "bottom_up" pairs objects sorted by height until one root is left
+    #   "sah" splits top down using the surface area heuristic
+    #traversal selects how rays walk the BVH:
+    #   "flat" uses the compiled FlatBVH with nearest child first, closest hit traversal
+    #   "tree" collects every hit leaf from the BVH_node tree and tests them afterwards
+    #a UniformGrid built with create_grid takes the place of the BVH
+    def __init__(self, BVH_ON=True, builder="bottom_up", leaf_size=2, traversal="flat"):
         self.use_bb = BVH_ON
+        self.traversal = traversal
+        self.builder = builder
+        self.leaf_size = leaf_size
+        self.hittables = []
+        self.grid = None
+        #BVH_node tree of the BVH, see tree
+        self.bb_root = None
+        #bottom level BVHs of the meshes of the world's instances, each once
+        self.blases = []
 
     def add_object(self, obj:Object):
         self.hittables.append(obj)
+        blas = getattr(getattr(obj, "mesh", None), "blas", None)
+        if blas is not None and all(b is not blas for b in self.blases):
+            self.blases.append(blas)
+
+    #box tests, nodes entered and triangle tests inside the bottom level BVHs so far, they only grow
+    #like the top level counters, so the work of a tile is the difference around it
+    def blas_work(self):
+        return (sum(b.node_visits for b in self.blases), sum(b.nodes_entered for b in self.blases),
+            sum(b.prim_tests for b in self.blases))
+
+    #report prints the statistics of the new BVH
+    def create_BoundingHierarchy(self, report=True):
+        #if empty scene, BVH is just one trivial node
+        if len(self.hittables) == 0:
+            self.bb_root = BVH_node(BB(Vec3(0,0,0), Vec3(0,0,0)), None, None)
+            self.flat_bvh = FlatBVH.from_tree(self.bb_root)
+            return
 
-    #bottom up tree 
-    def create_BoundingHierarchy(self):
-        def combine_boxes(b0, b1):
-            small = Vec3(
-                min(b0.minv.x, b1.minv.x),
-                min(b0.minv.y, b1.minv.y),
-                min(b0.minv.z, b1.minv.z))
-            big = Vec3(
-                max(b0.maxv.x, b1.maxv.x),
-                max(b0.maxv.y, b1.maxv.y),
-                max(b0.maxv.z, b1.maxv.z))   
-            return BB(small, big)
+        if self.builder == "sah":
+            root = build_sah(list(self.hittables), self.leaf_size)
+            if not isinstance(root, BVH_node):
+                root = BVH_node(root.bb, root, None)
+            self.bb_root = root
+        elif self.builder == "bottom_up":
+            self.bb_root = self.build_bottom_up()
+        else:
+            raise ValueError(f"Unknown BVH builder: {self.builder}")
+
+        self.flat_bvh = FlatBVH.from_tree(self.bb_root)
+        if not report:
+            return
 
+        stats = self.bvh_stats()
+        print(f"BVH ({self.builder}): {stats['nodes']} nodes, {stats['leaves']} leaves, "
+            f"depth {stats['depth']}, SAH cost {stats['sah_cost']:.2f}")
+
+    #builds a uniform grid over the objects, see grid.py, hit uses it instead of the BVH
+    def create_grid(self, dims=None):
+        self.grid = UniformGrid.build(self.hittables, dims)
+        stats = self.grid.stats()
+        nx, ny, nz = self.grid.dims
+        print(f"Grid: {nx}x{ny}x{nz} cells, {stats['references']} references, {stats['large']} large objects, "
+            f"{stats['objects_per_cell']:.2f} objects per non empty cell, built in {self.grid.build_seconds:.3f}s")
+
+    #the BVH as a tree of BVH_nodes, built with the world's builder on first use when the world only has
+    #a FlatBVH (loaded from a packed scene, see PackedScene.to_world). The FlatBVH is then compiled again
+    #from the tree, into arrays of its own that can be refit
+    def tree(self):
+        if not self.use_bb:
+            raise ValueError("The world has no BVH, it was created with BVH_ON=False")
+        if self.bb_root is None:
+            self.create_BoundingHierarchy(report=False)
+        return self.bb_root
+
+    #after objects moved: fits the BVH boxes around their new positions without changing the tree
+    #(the grid has no boxes to fit and is built again), returns the SAH cost of the refit BVH or None
+    def refit(self):
+        if self.grid is not None:
+            self.grid = UniformGrid.build(self.hittables, self.grid.dims)
+            return None
+        if not self.use_bb or not self.hittables:
+            return None
+        refit_tree(self.tree())
+        self.flat_bvh.refit()
+        return self.bvh_stats()["sah_cost"]
+
+    def bvh_stats(self):
+        return bvh_stats(self.tree())
+
+    #BVH nodes visited per ray so far, for comparing traversals
+    def node_visits_per_ray(self):
+        if self.traversal == "flat":
+            return self.flat_bvh.node_visits / self.ray_count
+        return BVH_node.visits / self.ray_count
+
+    #bottom up tree 
+    def build_bottom_up(self):
         #sort the object list based on y coordinate
         #this is to try to minimize the size of bounding boxes of the nodes in the BVH
         builder = [o for o in self.hittables]
         builder = sorted(builder, key=lambda x: x.get_y(), reverse=True)
 
-        #if empty scene, BVH is just one trivial node
-        if len(builder) == 0:
-            self.bb_root = BVH_node(BB(Vec3(0,0,0), Vec3(0,0,0)), None, None)
-            return
-
         #if generate BVH bottom up manner
         #each loop, remove two nodes or objects and attach to a new node with those objects as leaves
         #continue until a single node (the root) is left
@@ -196,7 +331,7 @@ class World():
                 if len(builder) >= 2:
                     left = builder.pop()
                     right = builder.pop()
-                    combined_box = combine_boxes(left.bb, right.bb)
+                    combined_box = surrounding_box(left.bb, right.bb)
                 else:
                     left = builder.pop()
                     right = None
@@ -210,27 +345,47 @@ class World():
                 break
 
         #last remaining node is the root of the tree
-        self.bb_root = builder[0]
+        return builder[0]
     
     #send a ray into the world
+    #the closest object is found with distance tests only, then its hit attributes are filled in once
     def hit(self, ray:Ray, t_min, collision_packet):
 
-        ret = False
+        obj = False
         closest_so_far = 99999
-
-        if self.use_bb:
-            ray_intersect_list = []
-            self.bb_root.hit(ray, t_min, t_max=9999, obj_list=ray_intersect_list)
+        self.ray_count += 1
+
+        if self.grid is not None:
+            tests, closer = self.grid.prim_tests, self.grid.closer_hits
+            obj, t, payload = self.grid.closest(ray, t_min, closest_so_far)
+            self.count += self.grid.prim_tests - tests
+            self.closer_hits += self.grid.closer_hits - closer
+        elif self.use_bb and self.traversal == "flat":
+            tests, closer = self.flat_bvh.prim_tests, self.flat_bvh.closer_hits
+            obj, t, payload = self.flat_bvh.closest(ray, t_min, closest_so_far)
+            self.count += self.flat_bvh.prim_tests - tests
+            self.closer_hits += self.flat_bvh.closer_hits - closer
         else:
-            ray_intersect_list = self.hittables
-        
-
-        self.count += len(ray_intersect_list)
-        self.ray_count += 1  
-
-        for obj in ray_intersect_list:
-            if obj.hit(ray, t_min, closest_so_far, collision_packet):
-                ret = obj
-                closest_so_far = collision_packet.t
-        return ret
+            if self.use_bb:
+                ray_intersect_list = []
+                self.tree().hit(ray, t_min, t_max=9999, obj_list=ray_intersect_list)
+            else:
+                ray_intersect_list = self.hittables
+            self.count += len(ray_intersect_list)
+
+            t = closest_so_far
+            payload = None
+            for candidate in ray_intersect_list:
+                hit = candidate.hit_t(ray, t_min, t)
+                if hit is not None:
+                    obj = candidate
+                    t, payload = hit
+                    self.closer_hits += 1
+
+        if obj:
+            obj.fill(ray, t, payload, collision_packet)
+            self.fills += 1
+            if obj.material.needs_uv:
+                self.uv_fills += 1
+        return obj
                 
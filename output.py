@@ -0,0 +1,114 @@
+'''
+Bounded memory image output for very large renders
+Finished tiles are written straight into disk backed .npy memmaps instead of an image held in memory:
+8 bit tonemapped pixels for .png output and float32 average colors for the raw .npy and .pfm formats.
+Every worker opens the memmaps itself and flushes after each tile, so no process holds more than
+a tile of the image. Once all tiles are done, PNG and PFM files are written a band of rows at a time
+by streaming writers, .npy output is the memmap itself
+'''
+
+import os
+import struct
+import zlib
+import numpy as np
+
+#formats run_streaming can write, by file extension
+STREAM_FORMATS = (".png", ".pfm", ".npy")
+
+class TileOutput():
+    def __init__(self, fname, height, width, band_rows=64):
+        self.fname = fname
+        self.height = height
+        self.width = width
+        self.band_rows = band_rows
+        self.format = os.path.splitext(fname)[1].lower()
+        if self.format not in STREAM_FORMATS:
+            raise ValueError(f"Cannot stream {fname}, supported formats are {', '.join(STREAM_FORMATS)}")
+
+        #8 bit pixels for png, float colors for the raw formats, both in image orientation
+        self.ldr_path = fname + ".part.npy" if self.format == ".png" else None
+        if self.format == ".npy":
+            self.linear_path = fname
+        elif self.format == ".pfm":
+            self.linear_path = fname + ".part.npy"
+        else:
+            self.linear_path = None
+
+        if self.ldr_path:
+            np.lib.format.open_memmap(self.ldr_path, mode="w+", dtype=np.uint8, shape=(height, width, 3)).flush()
+        if self.linear_path:
+            np.lib.format.open_memmap(self.linear_path, mode="w+", dtype=np.float32, shape=(height, width, 3)).flush()
+        #memmaps opened by each worker process on first use
+        self.buffers = None
+
+    def open(self):
+        ldr = np.load(self.ldr_path, mmap_mode="r+") if self.ldr_path else None
+        linear = np.load(self.linear_path, mmap_mode="r+") if self.linear_path else None
+        return ldr, linear
+
+    #runs in a worker: renders a tile into the memmaps and flushes it to disk
+    def render_tile(self, rt, tile):
+        if self.buffers is None:
+            self.buffers = self.open()
+        ldr, linear = self.buffers
+        rt.color_tile(tile.j0, tile.j1, tile.i0, tile.i1, ldr, linear)
+        for buf in self.buffers:
+            if buf is not None:
+                buf.flush()
+
+    #writes the final file from the memmaps, one band of rows at a time
+    def finish(self):
+        self.buffers = None
+        ldr, linear = self.open()
+        if self.format == ".png":
+            write_png(self.fname, ldr, self.band_rows)
+        elif self.format == ".pfm":
+            write_pfm(self.fname, linear, self.band_rows)
+        del ldr, linear
+        for path in (self.ldr_path, self.linear_path):
+            if path and path != self.fname:
+                os.remove(path)
+
+#a PNG chunk: length, type, data and the crc of type and data
+def png_chunk(kind, data):
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff)
+
+#writes an 8 bit RGB image (height, width, 3) as PNG, compressing band_rows rows at a time
+#the image can be a memmap, only one band is read into memory at once
+def write_png(fname, img, band_rows=64):
+    height, width = img.shape[:2]
+    compressor = zlib.compressobj(6)
+    with open(fname, "wb") as f:
+        f.write(b"\x89PNG\r\n\x1a\n")
+        #8 bits per channel, color type 2 (RGB), default compression, filter and no interlace
+        f.write(png_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)))
+        for j in range(0, height, band_rows):
+            band = np.asarray(img[j:j+band_rows])
+            #every row starts with its filter type, 0 is none
+            rows = np.zeros((band.shape[0], 1 + width*3), dtype=np.uint8)
+            rows[:, 1:] = band.reshape((band.shape[0], width*3))
+            data = compressor.compress(rows.tobytes())
+            if data:
+                f.write(png_chunk(b"IDAT", data))
+        f.write(png_chunk(b"IDAT", compressor.flush()))
+        f.write(png_chunk(b"IEND", b""))
+
+#writes float colors (height, width, 3) as a little endian PFM file, which stores rows bottom to top
+def write_pfm(fname, img, band_rows=64):
+    height, width = img.shape[:2]
+    with open(fname, "wb") as f:
+        f.write(f"PF\n{width} {height}\n-1.0\n".encode())
+        for j in range(height, 0, -band_rows):
+            band = np.asarray(img[max(j-band_rows, 0):j], dtype="<f4")
+            f.write(band[::-1].tobytes())
+
+#reads a PFM file written by write_pfm (or any 3 channel PFM) in image orientation
+def read_pfm(fname):
+    with open(fname, "rb") as f:
+        if f.readline().strip() != b"PF":
+            raise ValueError(f"{fname} is not a 3 channel PFM file")
+        width, height = map(int, f.readline().split())
+        scale = float(f.readline())
+        dtype = "<f4" if scale < 0 else ">f4"
+        data = np.frombuffer(f.read(), dtype=dtype, count=width*height*3)
+    return data.reshape((height, width, 3))[::-1]
@@ -0,0 +1,339 @@
+'''
+Packs the objects of a World into flat numpy arrays (structure of arrays)
+The packed scene is what the batched renderers work on: spheres, flat rectangles,
+material parameters, the flattened BVH or uniform grid and texture pixels, each stored in contiguous arrays.
+Triangle meshes are stored once with their bottom level BVHs, and instances as a mesh index and a transform.
+It is also what worker processes receive, see sharedscene.py, and to_world rebuilds
+the scalar objects from it
+'''
+
+import numpy as np
+from objects import *
+from mesh import *
+
+#material kinds
+MAT_LAMBERTIAN = 0
+MAT_METAL = 1
+MAT_DIELECTRIC = 2
+#class names of the material kinds
+MAT_NAMES = ["Lambertian", "Metal", "Dielectric"]
+
+#color kinds
+COLOR_SOLID = 0
+COLOR_CHECKER = 1
+COLOR_TEXTURE = 2
+
+#object kinds, in the order of world.hittables
+KIND_SPHERE = 0
+KIND_RECT = 1
+KIND_INSTANCE = 2
+
+class PackedScene():
+    #shared is the SharedScene holding the arrays, if they live in shared memory
+    def __init__(self, arrays, shared=None):
+        self.arrays = arrays
+        self.shared = shared
+        for name, value in arrays.items():
+            setattr(self, name, value)
+
+    #a scene in shared memory pickles as the names of its blocks
+    def __reduce__(self):
+        if self.shared is not None:
+            return (self.shared.packed, ())
+        return (PackedScene, (self.arrays,))
+
+    @property
+    def num_spheres(self):
+        return len(self.sphere_radius)
+
+    @property
+    def num_rects(self):
+        return len(self.rect_k)
+
+    @property
+    def num_instances(self):
+        return len(self.inst_mesh)
+
+    #returns the uint8 pixels of texture idx as a (height, width, 3) view into tex_data
+    def texture(self, idx):
+        offset, height, width = self.tex_info[idx]
+        return self.tex_data[offset:offset + height*width*3].reshape((height, width, 3))
+
+    #rebuilds the scene's objects in a new World, every call creates new objects and materials
+    #the BVH is not rebuilt: its bounds and counts are read straight from the packed arrays. builder,
+    #leaf_size and traversal should be the settings the scene was packed with, the world builds its
+    #BVH_node tree with them when it needs one (see World.tree)
+    def to_world(self, builder="bottom_up", leaf_size=2, traversal="flat"):
+        materials = [self.material(idx) for idx in range(len(self.mat_type))]
+        meshes = [self.mesh(idx) for idx in range(len(self.mesh_info))]
+        world = World(len(self.bvh_count) > 0, builder, leaf_size, traversal)
+        for kind, idx in zip(self.obj_kind.tolist(), self.obj_index.tolist()):
+            if kind == KIND_SPHERE:
+                obj = Sphere(Vec3.from_array(self.sphere_center[idx].tolist()), float(self.sphere_radius[idx]),
+                    materials[self.sphere_material[idx]])
+            elif kind == KIND_INSTANCE:
+                obj = Instance(meshes[self.inst_mesh[idx]], Transform(self.inst_transform[idx].reshape((3, 4))),
+                    materials[self.inst_material[idx]])
+            else:
+                x0, x1, z0, z1 = self.rect_bounds[idx].tolist()
+                obj = RectFlat(x0, x1, z0, z1, float(self.rect_k[idx]), materials[self.rect_material[idx]])
+            world.add_object(obj)
+
+        if world.use_bb:
+            #memoryviews index to plain python numbers, like the array module arrays FlatBVH is built with
+            prims = [world.hittables[k] for k in self.bvh_prims.tolist()]
+            world.flat_bvh = FlatBVH(memoryview(self.bvh_bounds), memoryview(self.bvh_offset),
+                memoryview(self.bvh_count), memoryview(self.bvh_axis), prims)
+        if len(self.grid_dims) > 0:
+            world.grid = UniformGrid(tuple(self.grid_bounds.tolist()), tuple(self.grid_dims.tolist()),
+                memoryview(self.grid_start), memoryview(self.grid_prims), self.grid_large.tolist(), world.hittables)
+        return world
+
+    #TriangleMesh idx with its bottom level BVH read from the packed arrays, like the world's BVH
+    def mesh(self, idx):
+        vert_start, vert_count, tri_start, tri_count, node_start, node_count, has_uvs = self.mesh_info[idx].tolist()
+        vertices = self.mesh_vertices[vert_start:vert_start + vert_count]
+        uvs = self.mesh_uvs[vert_start:vert_start + vert_count] if has_uvs else None
+        fname = str(self.mesh_fname[idx]) or None
+        mesh = TriangleMesh(vertices, self.mesh_indices[tri_start:tri_start + tri_count], uvs, fname)
+        nodes = slice(node_start, node_start + node_count)
+        mesh.attach_blas(memoryview(self.blas_bounds[6*node_start:6*(node_start + node_count)]),
+            memoryview(self.blas_offset[nodes]), memoryview(self.blas_count[nodes]), memoryview(self.blas_axis[nodes]),
+            self.blas_prims[tri_start:tri_start + tri_count].tolist())
+        return mesh
+
+    def material(self, idx):
+        kind = self.mat_color_kind[idx]
+        if kind == COLOR_SOLID:
+            albedo = SolidColor(Vec3.from_array(self.mat_color[idx].tolist()))
+        elif kind == COLOR_CHECKER:
+            albedo = CheckerColor()
+        else:
+            albedo = self.texture_object(self.mat_texture[idx])
+
+        if self.mat_type[idx] == MAT_LAMBERTIAN:
+            return Lambertian(albedo)
+        if self.mat_type[idx] == MAT_METAL:
+            return Metal(albedo)
+        return Dielectric(float(self.mat_ior[idx]))
+
+    #Texture for texture idx, its mip levels come from the TextureCache
+    #and the packed pixels are only decoded if the cache does not have them
+    def texture_object(self, idx):
+        texture = Texture.__new__(Texture)
+        texture.__setstate__({
+            "fname": str(self.tex_fname[idx]),
+            "filtered": bool(self.tex_filtered[idx]),
+            "key": self.tex_key[idx].decode()}, self.texture_pixels(idx))
+        return texture
+
+    #mip levels of texture idx from the TextureCache, as used by Texture
+    def texture_levels(self, idx):
+        return TextureCache.levels(self.tex_key[idx].decode(), self.texture_pixels(idx))
+
+    #the packed pixels of texture idx, for the TextureCache to build mip levels from
+    def texture_pixels(self, idx):
+        return lambda: np.asarray(self.texture(idx))
+
+    #material index of every object, in the order of world.hittables
+    def object_materials(self):
+        materials = np.zeros(len(self.obj_kind), dtype=np.int32)
+        for kind, table in ((KIND_SPHERE, self.sphere_material), (KIND_RECT, self.rect_material),
+                (KIND_INSTANCE, self.inst_material)):
+            mask = self.obj_kind == kind
+            materials[mask] = table[self.obj_index[mask]]
+        return materials
+
+    @classmethod
+    def from_world(cls, world):
+        materials = []
+        material_ids = {}
+        textures = []
+        texture_ids = {}
+
+        def material_index(material):
+            if id(material) not in material_ids:
+                material_ids[id(material)] = len(materials)
+                materials.append(material)
+            return material_ids[id(material)]
+
+        spheres = [o for o in world.hittables if isinstance(o, Sphere)]
+        rects = [o for o in world.hittables if isinstance(o, RectFlat)]
+        instances = [o for o in world.hittables if isinstance(o, Instance)]
+        sphere_ids = {id(s): idx for idx, s in enumerate(spheres)}
+        rect_ids = {id(r): idx for idx, r in enumerate(rects)}
+        instance_ids = {id(i): idx for idx, i in enumerate(instances)}
+        obj_ids = {}
+        obj_kind = np.zeros(len(world.hittables), dtype=np.int8)
+        obj_index = np.zeros(len(world.hittables), dtype=np.int32)
+        for idx, obj in enumerate(world.hittables):
+            if isinstance(obj, Sphere):
+                obj_kind[idx], obj_index[idx] = KIND_SPHERE, sphere_ids[id(obj)]
+            elif isinstance(obj, RectFlat):
+                obj_kind[idx], obj_index[idx] = KIND_RECT, rect_ids[id(obj)]
+            elif isinstance(obj, Instance):
+                obj_kind[idx], obj_index[idx] = KIND_INSTANCE, instance_ids[id(obj)]
+            else:
+                raise TypeError(f"Cannot pack object {type(obj).__name__}")
+            obj_ids[id(obj)] = idx
+
+        sphere_center = np.array([s.center.unwrap() for s in spheres], dtype=np.float64).reshape((-1, 3))
+        sphere_radius = np.array([s.radius for s in spheres], dtype=np.float64)
+        sphere_material = np.array([material_index(s.material) for s in spheres], dtype=np.int32)
+
+        rect_bounds = np.array([[r.x0, r.x1, r.z0, r.z1] for r in rects], dtype=np.float64).reshape((-1, 4))
+        rect_k = np.array([r.k for r in rects], dtype=np.float64)
+        rect_material = np.array([material_index(r.material) for r in rects], dtype=np.int32)
+
+        #every mesh once, however many instances use it
+        meshes = []
+        mesh_ids = {}
+        for inst in instances:
+            if id(inst.mesh) not in mesh_ids:
+                mesh_ids[id(inst.mesh)] = len(meshes)
+                meshes.append(inst.mesh)
+        inst_mesh = np.array([mesh_ids[id(i.mesh)] for i in instances], dtype=np.int32)
+        inst_transform = np.array([i.transform.matrix for i in instances], dtype=np.float64).reshape((-1, 12))
+        inst_material = np.array([material_index(i.material) for i in instances], dtype=np.int32)
+        mesh_arrays = pack_meshes(meshes)
+
+        n = len(materials)
+        mat_type = np.zeros(n, dtype=np.int8)
+        mat_ior = np.ones(n, dtype=np.float64)
+        mat_color_kind = np.zeros(n, dtype=np.int8)
+        mat_color = np.zeros((n, 3), dtype=np.float64)
+        mat_texture = np.full(n, -1, dtype=np.int32)
+
+        for idx, material in enumerate(materials):
+            if isinstance(material, Lambertian):
+                mat_type[idx] = MAT_LAMBERTIAN
+            elif isinstance(material, Metal):
+                mat_type[idx] = MAT_METAL
+            elif isinstance(material, Dielectric):
+                mat_type[idx] = MAT_DIELECTRIC
+                mat_ior[idx] = material.index_of_refract
+            else:
+                raise TypeError(f"Cannot pack material {type(material).__name__}")
+
+            albedo = material.albedo
+            if isinstance(albedo, SolidColor):
+                mat_color_kind[idx] = COLOR_SOLID
+                mat_color[idx] = albedo.color.unwrap()
+            elif isinstance(albedo, CheckerColor):
+                mat_color_kind[idx] = COLOR_CHECKER
+            elif isinstance(albedo, Texture):
+                mat_color_kind[idx] = COLOR_TEXTURE
+                if id(albedo) not in texture_ids:
+                    texture_ids[id(albedo)] = len(textures)
+                    textures.append(albedo)
+                mat_texture[idx] = texture_ids[id(albedo)]
+            else:
+                raise TypeError(f"Cannot pack color {type(albedo).__name__}")
+
+        tex_info = np.zeros((len(textures), 3), dtype=np.int64)
+        offset = 0
+        for idx, texture in enumerate(textures):
+            tex_info[idx] = (offset, texture.height, texture.width)
+            offset += texture.height*texture.width*3
+        tex_data = np.zeros(offset, dtype=np.uint8)
+        for idx, texture in enumerate(textures):
+            start = tex_info[idx][0]
+            tex_data[start:start + texture.height*texture.width*3] = np.asarray(texture.levels[0]).ravel()
+        tex_key = np.array([t.key for t in textures], dtype="S16")
+        tex_fname = np.array([t.fname for t in textures], dtype=str)
+        tex_filtered = np.array([t.filtered for t in textures], dtype=bool)
+
+        #the flattened BVH, primitives are indices into world.hittables
+        flat = getattr(world, "flat_bvh", None) if world.use_bb else None
+        if flat is not None:
+            bvh_bounds = np.array(flat.bounds, dtype=np.float64)
+            bvh_offset = np.array(flat.offset, dtype=np.int32)
+            bvh_count = np.array(flat.count, dtype=np.int32)
+            bvh_axis = np.array(flat.axis, dtype=np.int8)
+            bvh_prims = np.array([obj_ids[id(o)] for o in flat.prims], dtype=np.int32)
+        else:
+            bvh_bounds = np.zeros(0, dtype=np.float64)
+            bvh_offset = np.zeros(0, dtype=np.int32)
+            bvh_count = np.zeros(0, dtype=np.int32)
+            bvh_axis = np.zeros(0, dtype=np.int8)
+            bvh_prims = np.zeros(0, dtype=np.int32)
+
+        #the uniform grid, its cells and large objects are already indices into world.hittables
+        grid = world.grid
+        if grid is not None:
+            grid_bounds = np.array(grid.bounds, dtype=np.float64)
+            grid_dims = np.array(grid.dims, dtype=np.int32)
+            grid_start = np.array(grid.start, dtype=np.int32)
+            grid_prims = np.array(grid.cell_prims, dtype=np.int32)
+            grid_large = np.array(grid.large_idx, dtype=np.int32)
+        else:
+            grid_bounds = np.zeros(0, dtype=np.float64)
+            grid_dims = np.zeros(0, dtype=np.int32)
+            grid_start = np.zeros(0, dtype=np.int32)
+            grid_prims = np.zeros(0, dtype=np.int32)
+            grid_large = np.zeros(0, dtype=np.int32)
+
+        return cls({
+            "sphere_center": sphere_center,
+            "sphere_radius": sphere_radius,
+            "sphere_material": sphere_material,
+            "rect_bounds": rect_bounds,
+            "rect_k": rect_k,
+            "rect_material": rect_material,
+            "mat_type": mat_type,
+            "mat_ior": mat_ior,
+            "mat_color_kind": mat_color_kind,
+            "mat_color": mat_color,
+            "mat_texture": mat_texture,
+            "tex_info": tex_info,
+            "tex_data": tex_data,
+            "tex_key": tex_key,
+            "tex_fname": tex_fname,
+            "tex_filtered": tex_filtered,
+            "obj_kind": obj_kind,
+            "obj_index": obj_index,
+            "bvh_bounds": bvh_bounds,
+            "bvh_offset": bvh_offset,
+            "bvh_count": bvh_count,
+            "bvh_axis": bvh_axis,
+            "bvh_prims": bvh_prims,
+            "grid_bounds": grid_bounds,
+            "grid_dims": grid_dims,
+            "grid_start": grid_start,
+            "grid_prims": grid_prims,
+            "grid_large": grid_large,
+            "inst_mesh": inst_mesh,
+            "inst_transform": inst_transform,
+            "inst_material": inst_material,
+            **mesh_arrays,
+        })
+
+#the meshes' vertices, triangles and bottom level BVHs concatenated into one set of arrays
+#mesh_info holds the start and length of every mesh's vertices, triangles and BVH nodes in them,
+#the BVH offsets stay local to each mesh and its primitives are triangle indices, one per triangle
+def pack_meshes(meshes):
+    info = np.zeros((len(meshes), 7), dtype=np.int64)
+    vert = tri = node = 0
+    for idx, mesh in enumerate(meshes):
+        blas = mesh.build()
+        info[idx] = (vert, len(mesh.vertices), tri, len(mesh), node, len(blas), mesh.uvs is not None)
+        vert += len(mesh.vertices)
+        tri += len(mesh)
+        node += len(blas)
+
+    def concat(parts, dtype, shape):
+        parts = [np.asarray(p, dtype=dtype).reshape(shape) for p in parts]
+        return np.concatenate(parts) if parts else np.zeros((0,) + shape[1:], dtype=dtype)
+
+    return {
+        "mesh_info": info,
+        "mesh_fname": np.array([m.fname or "" for m in meshes], dtype=str),
+        "mesh_vertices": concat([m.vertices for m in meshes], np.float64, (-1, 3)),
+        "mesh_indices": concat([m.indices for m in meshes], np.int32, (-1, 3)),
+        "mesh_uvs": concat([m.uvs if m.uvs is not None else np.zeros((len(m.vertices), 2)) for m in meshes], np.float64, (-1, 2)),
+        "blas_bounds": concat([m.blas.bounds for m in meshes], np.float64, (-1,)),
+        "blas_offset": concat([m.blas.offset for m in meshes], np.int32, (-1,)),
+        "blas_count": concat([m.blas.count for m in meshes], np.int32, (-1,)),
+        "blas_axis": concat([m.blas.axis for m in meshes], np.int8, (-1,)),
+        "blas_prims": concat([[t.index for t in m.blas.prims] for m in meshes], np.int32, (-1,)),
+    }
@@ -0,0 +1,255 @@
+'''
+Preview rendering: a usable image as early as possible, refined until a time budget or quality target
+The image is first drawn coarse to fine: at every scale of rt.preview_scales (for example 8, 4, 2)
+one sample is traced through the center of every scale x scale block of pixels and fills the block.
+Then passes at full resolution are added into an accumulation buffer with a sample count per pixel.
+The first pass takes one sample per pixel, later passes as many as fit in the write interval, and the
+image file is rewritten at most every interval seconds and always when the render stops:
+    budget          wall clock seconds for the whole preview, workers skip the tiles left in a pass or a
+                    scale once it is spent, the pixels they did finish keep their extra samples
+    target_error    mean relative standard error of the pixels' luminance, estimated from the spread of
+                    the passes (at least two passes per pixel are needed for an estimate)
+    samples_per_pixel   the render stops there in any case
+Ctrl-C stops the render as well, the best image so far is still saved and returned.
+One pool of worker processes is started once for the whole preview (sharing the scene first with
+rt.shared_scene), every scale and pass only queues its tiles, tagged with the scale or sample level
+to bring them to
+'''
+
+import ctypes
+import gc
+import multiprocessing as mp
+import os
+import random
+import time
+import numpy as np
+from PIL import Image
+import film
+from scheduler import make_tiles, estimate_cost, get_result
+
+LUMINANCE = np.array([0.2126, 0.7152, 0.0722])
+
+#worker loop: runs ("coarse", scale, tile) and ("pass", level, tile) tasks until the None sentinel is received
+def preview_worker(rt, render, task_queue, result_queue):
+    #forked workers inherit the parent's random state, reseed so they do not repeat each other's samples
+    random.seed()
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+        kind, value, tile = task
+        if kind == "coarse":
+            render.coarse_tile(rt, tile, value)
+        else:
+            render.pass_tile(rt, tile, value)
+        result_queue.put(tile.index)
+
+class PreviewRender():
+    def __init__(self, rt, interval=2.0, scales=(8, 4, 2)):
+        self.rt = rt
+        self.interval = interval
+        self.scales = sorted(scales, reverse=True)
+        self.tiles = make_tiles(rt.image_height, rt.image_width, rt.tile_size)
+        pixels = rt.image_height*rt.image_width
+        #shared with the workers: coarse colors, summed colors, samples and passes per pixel,
+        #and the sum over passes of (pass luminance sum)^2 / pass samples for the error estimate
+        self.coarse_arr = mp.Array(ctypes.c_float, pixels*3)
+        self.accum_arr = mp.Array(ctypes.c_double, pixels*3)
+        self.counts_arr = mp.Array(ctypes.c_int32, pixels)
+        self.passes_arr = mp.Array(ctypes.c_int32, pixels)
+        self.pass_sq_arr = mp.Array(ctypes.c_double, pixels)
+        #seconds from the start of run to the first image saved and to the first full resolution image
+        self.latency = {}
+        #time.time() after which workers skip their tiles, None for no limit
+        self.deadline = None
+
+    #numpy views of the shared buffers, in image orientation (row 0 is the top of the image)
+    def buffers(self):
+        h, w = self.rt.image_height, self.rt.image_width
+        view = lambda arr, dtype, shape: np.frombuffer(arr.get_obj(), dtype=dtype).reshape(shape)
+        return {"coarse": view(self.coarse_arr, np.float32, (h, w, 3)),
+            "accum": view(self.accum_arr, np.float64, (h, w, 3)),
+            "counts": view(self.counts_arr, np.int32, (h, w)),
+            "passes": view(self.passes_arr, np.int32, (h, w)),
+            "pass_sq": view(self.pass_sq_arr, np.float64, (h, w))}
+
+    #renders until budget seconds have passed, the estimated error is below target_error or every pixel
+    #has target_samples samples, returns the best 8 bit image
+    def run(self, target_samples, fname="scene.png", budget=None, target_error=None):
+        self.start = time.perf_counter()
+        self.deadline = time.time() + budget if budget is not None else None
+        self.last_write = None
+        self.changed = False
+        buffers = self.buffers()
+        reason = "target samples reached"
+        interrupted = False
+        self.start_workers()
+        try:
+            for k, scale in enumerate(self.scales):
+                if k > 0 and self.out_of_time():
+                    break
+                print(f"Preview at 1/{scale} resolution")
+                self.run_tiles("coarse", scale)
+                self.maybe_write(fname, force=(k == 0))
+
+            seconds_per_sample = None
+            done = 0
+            while done < target_samples:
+                if self.out_of_time():
+                    reason = "time budget spent"
+                    break
+                error = self.error(buffers)
+                if target_error is not None and error is not None and error <= target_error:
+                    reason = f"error {error:.4f} below target"
+                    break
+
+                #one sample per pixel first, then passes that take about one write interval
+                samples = 1 if seconds_per_sample is None else max(1, int(self.interval / seconds_per_sample))
+                samples = min(samples, target_samples - done)
+                if self.deadline is not None and seconds_per_sample is not None:
+                    samples = max(1, min(samples, int((self.deadline - time.time()) / seconds_per_sample)))
+                print(f"Preview pass: {done} -> {done + samples} samples per pixel"
+                    + (f", error {error:.4f}" if error is not None else ""))
+
+                pass_start = time.perf_counter()
+                self.run_tiles("pass", done + samples)
+                seconds_per_sample = (time.perf_counter() - pass_start) / samples
+                done = int(buffers["counts"].min())
+                if done > 0:
+                    self.latency.setdefault("full resolution", time.perf_counter() - self.start)
+                self.maybe_write(fname)
+        except KeyboardInterrupt:
+            reason = "interrupted"
+            interrupted = True
+        finally:
+            self.stop_workers(terminate=interrupted)
+
+        arr = self.write_image(fname) if self.changed else self.image()
+        self.report(reason, buffers)
+        return arr
+
+    def out_of_time(self):
+        return self.deadline is not None and time.time() >= self.deadline
+
+    #shares the scene and starts the worker pool, the tiles' costs are probed once for every scale and pass
+    def start_workers(self):
+        rt = self.rt
+        for tile in self.tiles:
+            if tile.cost == 0:
+                tile.cost = estimate_cost(rt, tile)
+        self.queue_order = sorted(self.tiles, key=lambda t: t.cost, reverse=True)
+        if rt.shared_scene:
+            rt.share_scene()
+        self.task_queue = mp.Queue()
+        self.result_queue = mp.Queue()
+        workers = rt.num_workers or mp.cpu_count()
+        self.procs = [mp.Process(target=preview_worker, args=(rt, self, self.task_queue, self.result_queue))
+            for _ in range(workers)]
+        gc.freeze()
+        for p in self.procs:
+            p.start()
+        gc.unfreeze()
+        print(f"Preview of {len(self.tiles)} tiles on {workers} workers")
+
+    #after Ctrl-C the workers are stopped where they are instead of finishing the queued tiles
+    def stop_workers(self, terminate=False):
+        for p in self.procs:
+            if terminate:
+                p.terminate()
+            else:
+                self.task_queue.put(None)
+        for p in self.procs:
+            p.join()
+        if self.rt.shared is not None:
+            self.rt.unshare_scene()
+
+    #queues every tile for a scale ("coarse") or a sample level ("pass") and waits for them
+    def run_tiles(self, kind, value):
+        for tile in self.queue_order:
+            self.task_queue.put((kind, value, tile))
+        for _ in self.queue_order:
+            get_result(self.result_queue, self.procs)
+        self.changed = True
+
+    #runs in a worker: one sample through the center of every block of scale x scale pixels in the tile
+    #once the budget is spent, tiles keep the blocks of the coarser scale before
+    def coarse_tile(self, rt, tile, scale):
+        if scale != self.scales[0] and self.out_of_time():
+            return
+        blocks = [(j, i) for j in range(tile.j0, tile.j1, scale) for i in range(tile.i0, tile.i1, scale)]
+        jj = np.array([min(j + scale//2, tile.j1 - 1) for j, _ in blocks])
+        ii = np.array([min(i + scale//2, tile.i1 - 1) for _, i in blocks])
+        colors = rt.color_sum_pixels(jj, ii, 1)
+        coarse = self.buffers()["coarse"]
+        for (j, i), color in zip(blocks, colors):
+            film.tile_view(coarse, j, min(j + scale, tile.j1), i, min(i + scale, tile.i1))[...] = color
+
+    #runs in a worker: brings a tile up to level samples per pixel, unless the budget is spent
+    def pass_tile(self, rt, tile, level):
+        if self.out_of_time():
+            return
+        buffers = self.buffers()
+        view = lambda name: film.tile_view(buffers[name], tile.j0, tile.j1, tile.i0, tile.i1)
+        counts = view("counts")
+        have = int(counts.min())
+        samples = level - have
+        if samples <= 0:
+            return
+        color_sum = rt.color_sum_tile(tile.j0, tile.j1, tile.i0, tile.i1, samples, stream=have)
+        view("accum")[...] += color_sum
+        view("pass_sq")[...] += (color_sum @ LUMINANCE)**2 / samples
+        view("passes")[...] += 1
+        counts[...] += samples
+
+    #mean over the pixels of the standard error of their luminance relative to their brightness
+    #(floored at 0.05 as in adaptive.py), None until every pixel has two passes
+    def error(self, buffers):
+        passes = buffers["passes"]
+        if passes.min() < 2:
+            return None
+        n = buffers["counts"].astype(np.float64)
+        s = buffers["accum"] @ LUMINANCE
+        #spread of the pass means around the pixel mean, weighted by the samples of each pass
+        var = np.maximum(buffers["pass_sq"] - s*s/n, 0) / (passes - 1)
+        return float(np.mean(np.sqrt(var / n) / np.maximum(s / n, 0.05)))
+
+    #accumulated colors where a pixel has samples, the coarse preview elsewhere
+    def image(self):
+        buffers = self.buffers()
+        counts = buffers["counts"]
+        arr = film.tonemap(buffers["accum"], counts)
+        coarse = counts == 0
+        if coarse.any():
+            arr[coarse] = film.tonemap(buffers["coarse"][coarse], 1)
+        return arr
+
+    #writes the image if interval seconds have passed since the last write
+    def maybe_write(self, fname, force=False):
+        if force or self.last_write is None or time.perf_counter() - self.last_write >= self.interval:
+            self.write_image(fname)
+
+    #saved to a temporary file first, so a viewer watching fname never reads half an image
+    def write_image(self, fname):
+        arr = self.image()
+        root, ext = os.path.splitext(fname)
+        tmp = root + ".tmp" + ext
+        Image.fromarray(arr, 'RGB').save(tmp)
+        os.replace(tmp, fname)
+        self.last_write = time.perf_counter()
+        self.changed = False
+        self.latency.setdefault("first image", self.last_write - self.start)
+        print(f"Preview saved to {fname} after {self.last_write - self.start:.2f}s")
+        return arr
+
+    def report(self, reason, buffers):
+        counts = buffers["counts"]
+        error = self.error(buffers)
+        print(f"Preview stopped ({reason}) after {time.perf_counter() - self.start:.2f}s: "
+            f"{counts.min()}-{counts.max()} samples per pixel"
+            + (f", estimated error {error:.4f}" if error is not None else ""))
+        if "first image" in self.latency:
+            print(f"Latency to the first image: {self.latency['first image']:.3f}s"
+                + (f", {self.latency['first image'] + self.rt.startup_seconds:.3f}s including startup"
+                    if self.rt.startup_seconds is not None else ""))
+        if "full resolution" in self.latency:
+            print(f"Latency to the first full resolution image: {self.latency['full resolution']:.3f}s")
@@ -0,0 +1,145 @@
+'''
+Progressive rendering with crash safe checkpoints
+The image is rendered in passes of a few samples per pixel. Every tile keeps its float32 color sums and
+per pixel sample counts in its own file of a checkpoint directory. A worker finishing a tile writes both
+to a temporary file, syncs it to disk and renames it over the tile's file, so a crash at any point leaves
+each tile either before or after its last pass, never with samples its counts do not record.
+A later run with the same checkpoint directory picks up from the counts, and asking for more samples
+extends a finished render
+'''
+
+import glob
+import json
+import os
+import time
+import numpy as np
+from PIL import Image
+import film
+from scheduler import TileScheduler, make_tiles
+
+class Checkpoint():
+    def __init__(self, directory):
+        self.directory = directory
+        self.state_path = os.path.join(directory, "state.json")
+
+    def exists(self):
+        return os.path.exists(self.state_path)
+
+    #creates the directory, or checks that the existing checkpoint matches the image and tile size
+    def open(self, height, width, tile_size):
+        if self.exists():
+            state = self.load_state()
+            if (state["height"], state["width"]) != (height, width):
+                raise ValueError(f"Checkpoint in {self.directory} is {state['width']}x{state['height']}, "
+                    f"cannot resume a {width}x{height} render")
+            if state.get("tile_size") != tile_size:
+                raise ValueError(f"Checkpoint in {self.directory} has tiles of {state.get('tile_size')} pixels, "
+                    f"cannot resume with tile_size {tile_size}")
+            #tiles a crashed worker was writing, the tile files themselves are intact
+            for tmp in glob.glob(os.path.join(self.directory, "*.tmp")):
+                os.remove(tmp)
+            return state
+
+        os.makedirs(self.directory, exist_ok=True)
+        state = {"height": height, "width": width, "tile_size": tile_size, "passes": 0}
+        self.save_state(state)
+        return state
+
+    def tile_path(self, tile):
+        return os.path.join(self.directory, f"tile_{tile.j0}_{tile.i0}.npz")
+
+    #color sums and sample counts of a tile, in the orientation of film.tile_view, zeros before its first pass
+    def load_tile(self, tile):
+        path = self.tile_path(tile)
+        shape = (tile.j1 - tile.j0, tile.i1 - tile.i0)
+        if not os.path.exists(path):
+            return np.zeros(shape + (3,), dtype=np.float32), np.zeros(shape, dtype=np.int32)
+        with np.load(path) as data:
+            return data["accum"], data["counts"]
+
+    #replaces the tile's colors and counts together, see the module description
+    def save_tile(self, tile, accum, counts):
+        path = self.tile_path(tile)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            np.savez(f, accum=accum, counts=counts)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+    #accumulation buffer and sample counts of the whole image, in image orientation (row 0 is the top of the image)
+    def buffers(self, tiles, height, width):
+        accum = np.zeros((height, width, 3), dtype=np.float32)
+        counts = np.zeros((height, width), dtype=np.int32)
+        for tile in tiles:
+            tile_accum, tile_counts = self.load_tile(tile)
+            film.tile_view(accum, tile.j0, tile.j1, tile.i0, tile.i1)[...] = tile_accum
+            film.tile_view(counts, tile.j0, tile.j1, tile.i0, tile.i1)[...] = tile_counts
+        return accum, counts
+
+    def load_state(self):
+        with open(self.state_path) as f:
+            return json.load(f)
+
+    #written to a temporary file first so a crash never leaves a half written state
+    def save_state(self, state):
+        tmp = self.state_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp, self.state_path)
+
+class ProgressiveRender():
+    def __init__(self, rt, checkpoint_dir, pass_samples=16):
+        self.rt = rt
+        self.checkpoint = Checkpoint(checkpoint_dir)
+        self.pass_samples = pass_samples
+        self.tiles = make_tiles(rt.image_height, rt.image_width, rt.tile_size)
+
+    #renders until every pixel has target_samples samples, saving the image after every pass
+    #returns the final 8 bit image
+    def run(self, target_samples, fname="scene.png"):
+        rt = self.rt
+        state = self.checkpoint.open(rt.image_height, rt.image_width, rt.tile_size)
+        done = min(int(self.checkpoint.load_tile(tile)[1].min()) for tile in self.tiles)
+        if done > 0:
+            print(f"Resuming from {self.checkpoint.directory}: {done} samples per pixel already rendered")
+
+        while done < target_samples:
+            level = min(done + self.pass_samples, target_samples)
+            start = time.perf_counter()
+            tiles = self.tiles_below(level)
+            print(f"Pass {state['passes']+1}: {done} -> {level} samples per pixel, {len(tiles)} tiles")
+
+            self.level = level
+            scheduler = TileScheduler(rt, rt.num_workers, rt.tile_size, work=self.render_tile, tiles=tiles)
+            scheduler.run()
+
+            state["passes"] += 1
+            state["samples"] = level
+            self.checkpoint.save_state(state)
+            self.save_image(fname)
+            print(f"Pass took {time.perf_counter() - start:.2f}s, checkpoint saved")
+            done = level
+
+        return self.save_image(fname)
+
+    #tiles that have not reached level samples yet, tiles finished before a crash are skipped
+    def tiles_below(self, level):
+        return [tile for tile in self.tiles if self.checkpoint.load_tile(tile)[1].min() < level]
+
+    #runs in a worker: brings a tile up to self.level samples per pixel and commits it to the checkpoint
+    def render_tile(self, rt, tile):
+        accum, counts = self.checkpoint.load_tile(tile)
+        have = int(counts.min())
+        samples = self.level - have
+        if samples <= 0:
+            return
+        color_sum = rt.color_sum_tile(tile.j0, tile.j1, tile.i0, tile.i1, samples, stream=have)
+        self.checkpoint.save_tile(tile, accum + color_sum.astype(np.float32), counts + samples)
+
+    #tonemaps the accumulated buffer and saves it
+    def save_image(self, fname):
+        accum, counts = self.checkpoint.buffers(self.tiles, self.rt.image_height, self.rt.image_width)
+        arr = film.tonemap(accum, counts)
+        Image.fromarray(arr, 'RGB').save(fname)
+        return arr
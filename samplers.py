@@ -0,0 +1,307 @@
+'''
+Sample patterns for camera jitter and scatter directions
+Instead of independent random numbers, every random decision of a path reads a 2D sample that is
+a pure function of (pixel, sample index, dimension): dimension 0 jitters the camera ray and every
+bounce uses the next dimensions for its scatter direction and russian roulette. Renders are then
+the same whatever the number of workers or the tile order, and the patterns below spread the
+samples of a pixel far more evenly than independent random numbers, which lowers the noise for
+the same number of samples:
+    random      hashed white noise, the reference
+    stratified  correlated multi-jittered sampling (Kensler 2013), one sample per cell of a jittered grid
+    halton      Halton sequence with random digit permutations chosen per pixel
+    sobol       2D Sobol points with hash based Owen scrambling, sample order shuffled per pixel and dimension (Burley 2020)
+    bluenoise   Sobol points rotated per pixel by a blue noise mask, so the remaining error is spread as
+                high frequency noise across neighbouring pixels
+The integer helpers work on python ints and on numpy uint64 arrays alike, so the scalar engine
+asks for one sample at a time and the wavefront engine for whole batches.
+'''
+
+import math
+from abc import ABC, abstractmethod
+import numpy as np
+
+MASK = 0xffffffff
+#2^-32
+INV_2_32 = 1.0 / 4294967296.0
+
+#32 bit integer hash (lowbias32)
+def mix(x):
+    x = x & MASK
+    x ^= x >> 16
+    x = (x * 0x7feb352d) & MASK
+    x ^= x >> 15
+    x = (x * 0x846ca68b) & MASK
+    x ^= x >> 16
+    return x
+
+#hash of several integers
+def hash_ints(*values):
+    h = 0x2545f491
+    for v in values:
+        h = mix(h ^ mix(v + 0x9e3779b9))
+    return h
+
+def reverse_bits(x):
+    x = ((x >> 1) & 0x55555555) | ((x & 0x55555555) << 1)
+    x = ((x >> 2) & 0x33333333) | ((x & 0x33333333) << 2)
+    x = ((x >> 4) & 0x0f0f0f0f) | ((x & 0x0f0f0f0f) << 4)
+    x = ((x >> 8) & 0x00ff00ff) | ((x & 0x00ff00ff) << 8)
+    return ((x >> 16) & 0xffff) | ((x & 0xffff) << 16)
+
+#hash based Owen scrambling of a 32 bit fraction (Laine and Karras permutation on the reversed bits)
+def owen_scramble(x, seed):
+    x = reverse_bits(x)
+    x = (x + seed) & MASK
+    x ^= (x * 0x6c50b47c) & MASK
+    x ^= (x * 0xb82f1e52) & MASK
+    x ^= (x * 0xc7afe638) & MASK
+    x ^= (x * 0x8d22f6e6) & MASK
+    return reverse_bits(x)
+
+#first two dimensions of the Sobol sequence as 32 bit fractions
+#the first is the van der Corput sequence, the second has the Pascal matrix as generator
+def sobol2d(index):
+    x = reverse_bits(index)
+    y = index & 0
+    v = 1 << 31
+    bits = index.bit_length() if isinstance(index, int) else 32
+    for bit in range(bits):
+        y ^= ((index >> bit) & 1) * v
+        v ^= v >> 1
+    return x, y
+
+#one round of Kensler's hash permutation, w is the bit mask covering the permutation length
+def permute_round(i, p, w):
+    i = i ^ p
+    i = (i * 0xe170893d) & MASK
+    i ^= p >> 16
+    i ^= (i & w) >> 4
+    i ^= p >> 8
+    i = (i * 0x0929eb3f) & MASK
+    i ^= p >> 23
+    i ^= (i & w) >> 1
+    i = (i * (1 | p >> 27)) & MASK
+    i = (i * 0x6935fa69) & MASK
+    i ^= (i & w) >> 11
+    i = (i * 0x74dcb303) & MASK
+    i ^= (i & w) >> 2
+    i = (i * 0x9e501cc3) & MASK
+    i ^= (i & w) >> 2
+    i = (i * 0xc860a3df) & MASK
+    i &= w
+    i ^= i >> 5
+    return i
+
+#element i of a random permutation of range(l) selected by p (Kensler, "Correlated Multi-Jittered Sampling")
+#values that fall outside the range are permuted again until they land inside it
+def permute(i, l, p):
+    w = l - 1
+    for shift in (1, 2, 4, 8, 16):
+        w |= w >> shift
+    i = permute_round(i, p, w)
+    if isinstance(i, np.ndarray):
+        out = i >= l
+        while out.any():
+            i[out] = permute_round(i[out], p[out] if isinstance(p, np.ndarray) else p, w)
+            out = i >= l
+    else:
+        while i >= l:
+            i = permute_round(i, p, w)
+    return (i + p) % l
+
+#hashed float in [0, 1) for index i and seed p
+def randfloat(i, p):
+    i = i ^ p
+    i ^= i >> 17
+    i ^= i >> 10
+    i = (i * 0xb36534e5) & MASK
+    i ^= i >> 12
+    i ^= i >> 21
+    i = (i * 0x93fc4795) & MASK
+    i ^= 0xdf6e307f
+    i ^= i >> 17
+    i = (i * (1 | p >> 18)) & MASK
+    return i * INV_2_32
+
+#dimension 0 jitters the camera ray, bounce b scatters with dimension 1 + 2b and plays russian roulette with 2 + 2b
+CAMERA_DIM = 0
+
+def scatter_dim(bounce):
+    return 1 + 2*bounce
+
+def roulette_dim(bounce):
+    return 2 + 2*bounce
+
+#Every sampler returns a 2D sample in [0, 1)^2 for pixel (px, py), sample index and dimension.
+#Arguments can be python ints or numpy uint64 arrays of the same length (signed arrays would overflow).
+#The helpers above never modify their arguments in place.
+class Sampler(ABC):
+    def __init__(self, samples_per_pixel, seed=0):
+        self.samples_per_pixel = samples_per_pixel
+        self.seed = seed
+
+    def pixel_seed(self, px, py, dim):
+        return hash_ints(self.seed, px, py, dim)
+
+    @abstractmethod
+    def sample2d(self, px, py, index, dim):
+        pass
+
+class RandomSampler(Sampler):
+    def sample2d(self, px, py, index, dim):
+        h = hash_ints(self.pixel_seed(px, py, dim), index)
+        return randfloat(h, 0x68bc21eb), randfloat(h, 0x02e5be93)
+
+#correlated multi-jittered samples: the samples_per_pixel samples of a pixel fill an m x n grid
+#one per cell, and each row and column of fine strata exactly once. Sample indices past
+#samples_per_pixel start a new, differently permuted set
+class StratifiedSampler(Sampler):
+    def __init__(self, samples_per_pixel, seed=0):
+        super().__init__(samples_per_pixel, seed)
+        self.m = max(1, int(math.sqrt(samples_per_pixel)))
+        self.n = (samples_per_pixel + self.m - 1) // self.m
+
+    def sample2d(self, px, py, index, dim):
+        N = self.samples_per_pixel
+        m = self.m
+        n = self.n
+        p = hash_ints(self.pixel_seed(px, py, dim), index // N)
+        s = permute(index % N, N, (p * 0x51633e2d) & MASK)
+        sx = permute(s % m, m, (p * 0x68bc21eb) & MASK)
+        sy = permute(s // m, n, (p * 0x02e5be93) & MASK)
+        jx = randfloat(s, (p * 0x967a889b) & MASK)
+        jy = randfloat(s, (p * 0x368cc8b7) & MASK)
+        return (s % m + (sy + jx) / n) / m, (s // m + (sx + jy) / m) / n
+
+PRIMES = [p for p in range(2, 600) if all(p % q for q in range(2, int(p**0.5) + 1))]
+
+#radical inverse of index in base with every digit passed through its own random permutation of
+#range(base) selected by seed (random permutation scrambling). Large bases need it: the first few
+#unscrambled digits of consecutive indices all lie in a small part of [0, 1).
+#A fixed number of digits is used so leading zeros are scrambled as well
+def scrambled_radical_inverse(index, base, seed):
+    digits = math.ceil(32 / math.log2(base))
+    inv = 1.0 / base
+    f = inv
+    result = 0.0
+    for d in range(digits):
+        digit = permute(index % base, base, mix(seed + d))
+        result = result + digit*f
+        index = index // base
+        f *= inv
+    return result
+
+#dimension d uses the primes 2d and 2d+1, every pixel permutes the digits differently
+class HaltonSampler(Sampler):
+    def sample2d(self, px, py, index, dim):
+        b0 = PRIMES[(2*dim) % len(PRIMES)]
+        b1 = PRIMES[(2*dim + 1) % len(PRIMES)]
+        p = self.pixel_seed(px, py, dim)
+        x = scrambled_radical_inverse(index, b0, mix(p ^ 0x967a889b))
+        y = scrambled_radical_inverse(index, b1, mix(p ^ 0x368cc8b7))
+        return x, y
+
+#every dimension is its own 2D Sobol pattern: the sample order is shuffled and the points Owen scrambled
+#with seeds from the pixel and dimension, so dimensions are not correlated with each other
+class SobolSampler(Sampler):
+    def sample2d(self, px, py, index, dim):
+        p = self.pixel_seed(px, py, dim)
+        x, y = sobol2d(owen_scramble(index, p))
+        x = owen_scramble(x, mix(p ^ 0x967a889b))
+        y = owen_scramble(y, mix(p ^ 0x368cc8b7))
+        return x*INV_2_32, y*INV_2_32
+
+#the same Owen scrambled Sobol points for every pixel, rotated by two values of a blue noise mask
+#neighbouring pixels get very different rotations, so their errors do not form clumps
+class BlueNoiseSampler(Sampler):
+    def __init__(self, samples_per_pixel, seed=0):
+        super().__init__(samples_per_pixel, seed)
+        self.mask = blue_noise_mask(seed=seed)
+
+    def sample2d(self, px, py, index, dim):
+        size = self.mask.shape[0]
+        d = hash_ints(self.seed, dim)
+        x, y = sobol2d(owen_scramble(index, d))
+        x = owen_scramble(x, mix(d ^ 0x967a889b))*INV_2_32
+        y = owen_scramble(y, mix(d ^ 0x368cc8b7))*INV_2_32
+        #each dimension reads the mask at its own offsets
+        ox = d % size
+        oy = (d >> 8) % size
+        rx = self.mask[(py + oy) % size, (px + ox) % size]
+        ry = self.mask[(py + oy + size//2) % size, (px + ox + size//3) % size]
+        return (x + rx) % 1.0, (y + ry) % 1.0
+
+SAMPLERS = {
+    "random": RandomSampler,
+    "stratified": StratifiedSampler,
+    "halton": HaltonSampler,
+    "sobol": SobolSampler,
+    "bluenoise": BlueNoiseSampler,
+}
+
+def make_sampler(name, samples_per_pixel, seed=0):
+    if name not in SAMPLERS:
+        raise ValueError(f"Unknown sample pattern {name}, choose from {', '.join(SAMPLERS)}")
+    return SAMPLERS[name](samples_per_pixel, seed)
+
+#blue noise masks by (size, seed), built once per process
+masks = {}
+
+#a size x size tileable blue noise mask of values in (0, 1), built with the void and cluster method:
+#pixels are ranked by repeatedly filling the largest void of a gaussian energy field
+def blue_noise_mask(size=64, sigma=1.5, seed=0):
+    if (size, seed) in masks:
+        return masks[(size, seed)]
+
+    n = size*size
+    d = np.minimum(np.arange(size), size - np.arange(size))
+    kernel = np.exp(-(d[:, None]**2 + d[None, :]**2) / (2*sigma*sigma))
+    kernel_fft = np.fft.rfft2(kernel)
+
+    def energy_of(pattern):
+        return np.fft.irfft2(np.fft.rfft2(pattern) * kernel_fft, s=(size, size)).ravel()
+
+    def splat(energy, k, sign):
+        y, x = divmod(k, size)
+        energy += sign*np.roll(kernel, (y, x), axis=(0, 1)).ravel()
+
+    rng = np.random.default_rng(seed)
+    pattern = np.zeros(n, dtype=bool)
+    pattern[rng.choice(n, n//10, replace=False)] = True
+
+    #initial binary pattern: move the tightest cluster into the largest void until they coincide
+    energy = energy_of(pattern.reshape((size, size)).astype(np.float64))
+    for _ in range(n):
+        cluster = np.where(pattern, energy, -np.inf).argmax()
+        pattern[cluster] = False
+        splat(energy, cluster, -1)
+        void = np.where(pattern, np.inf, energy).argmin()
+        pattern[void] = True
+        splat(energy, void, 1)
+        if void == cluster:
+            break
+
+    rank = np.zeros(n, dtype=np.int64)
+    ones = int(pattern.sum())
+
+    #ranks below the initial pattern: remove tightest clusters
+    prototype = pattern.copy()
+    prototype_energy = energy.copy()
+    for r in range(ones - 1, -1, -1):
+        cluster = np.where(pattern, energy, -np.inf).argmax()
+        pattern[cluster] = False
+        splat(energy, cluster, -1)
+        rank[cluster] = r
+
+    #ranks above it: fill the largest voids
+    pattern = prototype
+    energy = prototype_energy
+    for r in range(ones, n):
+        void = np.where(pattern, np.inf, energy).argmin()
+        pattern[void] = True
+        splat(energy, void, 1)
+        rank[void] = r
+
+    mask = ((rank + 0.5) / n).reshape((size, size))
+    masks[(size, seed)] = mask
+    return mask
@@ -0,0 +1,273 @@
+'''
+Scene description files
+A scene is a JSON file with the camera, render settings, textures, meshes, materials and objects:
+    {
+        "camera": {"lookfrom": [0, 4, -4], "lookat": [0, 0, 0]},
+        "settings": {"image_width": 960, "samples_per_pixel": 100},
+        "textures": {"wood": {"file": "wood.jpg", "filtered": true}},
+        "meshes": {"bunny": {"file": "bunny.obj"}},
+        "materials": {
+            "floor": {"type": "lambertian", "texture": "wood"},
+            "red": {"type": "lambertian", "color": [0.8, 0.3, 0.3]},
+            "tiles": {"type": "lambertian", "checker": true},
+            "mirror": {"type": "metal", "color": [1, 1, 1]},
+            "glass": {"type": "dielectric", "ior": 1.5}
+        },
+        "objects": [
+            {"type": "rect", "x0": -10, "x1": 10, "z0": -4, "z1": 10, "k": 0, "material": "floor"},
+            {"type": "sphere", "center": [0, 2, 0], "radius": 2, "material": "mirror"},
+            {"type": "instance", "mesh": "bunny", "translate": [3, 0, 2], "rotate": [0, 90, 0], "scale": 2, "material": "red"}
+        ]
+    }
+An instance is placed either by translate, rotate (degrees about x, y, z) and scale, or by "transform",
+the 12 numbers of a 3x4 matrix. Every mesh file is loaded once, however many instances use it.
+Texture and mesh files are relative to the scene file. load_scene compiles the scene into a PackedScene
+(geometry, materials, the flattened BVH or uniform grid and decoded texture pixels) saved as .npy files in the
+SceneCache, under a hash of the scene's contents, the settings the BVH depends on and the bytes of
+every texture and mesh file. Later runs of an unchanged scene memory map the arrays instead of decoding
+textures and building the BVH again.
+
+    python3 scenefile.py export scene.json --spheres 40 --seed 1   writes main.build_scene's random scene
+    python3 scenefile.py compile scene.json                        compiles a scene ahead of the first render
+    python3 main.py scene.json                                     renders a scene file
+Large random scenes are generated by scenegen.py
+'''
+
+import argparse
+import hashlib
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+import numpy as np
+from util import *
+from objects import *
+from mesh import *
+from packed import PackedScene
+
+#changes whenever the layout of the compiled arrays changes, so older artifacts are not used
+FORMAT_VERSION = 3
+#RayTracer settings the compiled scene depends on
+COMPILE_SETTINGS = ["use_BVH", "bvh_builder", "use_grid"]
+
+#Compiled scenes, one directory of .npy files per scene key
+class SceneCache():
+    directory = os.path.join(tempfile.gettempdir(), "raytracer_scenes")
+
+    @classmethod
+    def path(cls, key):
+        return os.path.join(cls.directory, key)
+
+    #the PackedScene stored under key with every array memory mapped, None if there is none
+    @classmethod
+    def load(cls, key):
+        path = cls.path(key)
+        if not os.path.isdir(path):
+            return None
+        arrays = {}
+        for name in os.listdir(path):
+            if name.endswith(".npy"):
+                arrays[name[:-4]] = np.load(os.path.join(path, name), mmap_mode="r")
+        return PackedScene(arrays)
+
+    #writes into a temporary directory first, so a process reading the cache never sees a partial scene
+    @classmethod
+    def store(cls, key, packed):
+        os.makedirs(cls.directory, exist_ok=True)
+        tmp = tempfile.mkdtemp(dir=cls.directory, prefix=f"{key}.tmp")
+        for name, arr in packed.arrays.items():
+            np.save(os.path.join(tmp, f"{name}.npy"), np.asarray(arr))
+        try:
+            os.rename(tmp, cls.path(key))
+        except OSError:
+            #another process stored the same scene first
+            shutil.rmtree(tmp)
+        return cls.path(key)
+
+#loads a scene file into a new RayTracer, settings override the ones in the file
+#with compiled, the world comes from the SceneCache, compiling it on the first run
+def load_scene(fname, compiled=True, **settings):
+    from main import RayTracer
+    start = time.perf_counter()
+    with open(fname) as f:
+        desc = json.load(f)
+    base = os.path.dirname(os.path.abspath(fname))
+    camera = desc["camera"]
+    rt = RayTracer(Vec3(*camera["lookat"]), Vec3(*camera["lookfrom"]), **{**desc.get("settings", {}), **settings})
+    #time to the first ray includes reading the file
+    rt.created = start
+
+    if not compiled:
+        add_objects(rt, desc, base)
+        rt.finalize()
+        print(f"Scene {fname} built in {time.perf_counter() - start:.3f}s")
+        return rt
+
+    key = scene_key(desc, base, rt)
+    packed = SceneCache.load(key)
+    if packed is None:
+        add_objects(rt, desc, base)
+        rt.finalize()
+        path = SceneCache.store(key, rt.packed_scene())
+        print(f"Scene {fname} compiled to {path} in {time.perf_counter() - start:.3f}s")
+    else:
+        rt.load_packed(packed)
+        rt.finalize()
+        print(f"Scene {fname} loaded from {SceneCache.path(key)} in {time.perf_counter() - start:.3f}s")
+    return rt
+
+#content hash of a scene: its description, the settings its BVH depends on and its texture and mesh files
+def scene_key(desc, base, rt):
+    h = hashlib.sha256()
+    h.update(json.dumps([FORMAT_VERSION, desc, [getattr(rt, name) for name in COMPILE_SETTINGS]], sort_keys=True).encode())
+    for section in ("textures", "meshes"):
+        for name, entry in sorted(desc.get(section, {}).items()):
+            with open(os.path.join(base, entry["file"]), "rb") as f:
+                h.update(hashlib.sha256(f.read()).digest())
+    return h.hexdigest()[:32]
+
+#builds the textures, materials and objects of a scene description into rt
+def add_objects(rt, desc, base):
+    textures = {name: Texture(os.path.join(base, t["file"]), t.get("filtered", True))
+        for name, t in desc.get("textures", {}).items()}
+    materials = {name: make_material(m, textures) for name, m in desc.get("materials", {}).items()}
+    meshes = {name: TriangleMesh.load(os.path.join(base, m["file"])) for name, m in desc.get("meshes", {}).items()}
+
+    for obj in desc.get("objects", []):
+        material = materials[obj["material"]]
+        if obj["type"] == "sphere":
+            rt.add_object(Sphere(Vec3(*obj["center"]), obj["radius"], material))
+        elif obj["type"] == "rect":
+            rt.add_object(RectFlat(obj["x0"], obj["x1"], obj["z0"], obj["z1"], obj["k"], material))
+        elif obj["type"] == "instance":
+            if "transform" in obj:
+                transform = Transform(np.reshape(obj["transform"], (3, 4)))
+            else:
+                transform = Transform.from_trs(obj.get("translate", (0, 0, 0)), obj.get("rotate", (0, 0, 0)), obj.get("scale", 1.0))
+            rt.add_object(Instance(meshes[obj["mesh"]], transform, material))
+        else:
+            raise ValueError(f"Unknown object type {obj['type']}")
+
+def make_material(desc, textures):
+    if desc["type"] == "dielectric":
+        return Dielectric(desc.get("ior", 1.5))
+
+    if "texture" in desc:
+        albedo = textures[desc["texture"]]
+    elif desc.get("checker"):
+        albedo = CheckerColor()
+    else:
+        albedo = SolidColor(Vec3(*desc["color"]))
+
+    if desc["type"] == "lambertian":
+        return Lambertian(albedo)
+    if desc["type"] == "metal":
+        return Metal(albedo)
+    raise ValueError(f"Unknown material type {desc['type']}")
+
+#scene description of a RayTracer's camera, changed settings and objects
+#texture and mesh files are given relative to the directory base
+def describe(rt, base="."):
+    from main import RayTracer, RENDER_SETTINGS
+    textures = {}
+    meshes = {}
+    materials = {}
+    names = {}
+
+    def mesh_name(mesh):
+        if mesh.fname is None:
+            raise TypeError("Cannot describe a mesh that was not loaded from a file")
+        if id(mesh) not in names:
+            names[id(mesh)] = f"mesh{len(meshes)}"
+            meshes[names[id(mesh)]] = {"file": os.path.relpath(mesh.fname, base)}
+        return names[id(mesh)]
+
+    def texture_name(texture):
+        if id(texture) not in names:
+            names[id(texture)] = f"texture{len(textures)}"
+            textures[names[id(texture)]] = {"file": os.path.relpath(texture.fname, base), "filtered": texture.filtered}
+        return names[id(texture)]
+
+    def material_name(material):
+        if id(material) in names:
+            return names[id(material)]
+        if isinstance(material, Dielectric):
+            m = {"type": "dielectric", "ior": material.index_of_refract}
+        else:
+            m = {"type": "lambertian" if isinstance(material, Lambertian) else "metal"}
+            if isinstance(material.albedo, Texture):
+                m["texture"] = texture_name(material.albedo)
+            elif isinstance(material.albedo, CheckerColor):
+                m["checker"] = True
+            else:
+                m["color"] = material.albedo.color.unwrap()
+        names[id(material)] = f"material{len(materials)}"
+        materials[names[id(material)]] = m
+        return names[id(material)]
+
+    objects = []
+    for obj in rt.world.hittables:
+        if isinstance(obj, Sphere):
+            objects.append({"type": "sphere", "center": obj.center.unwrap(), "radius": obj.radius,
+                "material": material_name(obj.material)})
+        elif isinstance(obj, RectFlat):
+            objects.append({"type": "rect", "x0": obj.x0, "x1": obj.x1, "z0": obj.z0, "z1": obj.z1, "k": obj.k,
+                "material": material_name(obj.material)})
+        elif isinstance(obj, Instance):
+            objects.append({"type": "instance", "mesh": mesh_name(obj.mesh), "transform": list(obj.transform.matrix),
+                "material": material_name(obj.material)})
+        else:
+            raise TypeError(f"Cannot describe object {type(obj).__name__}")
+
+    return {
+        "camera": {"lookfrom": rt.lookfrom.unwrap(), "lookat": rt.lookat.unwrap()},
+        "settings": {name: getattr(rt, name) for name in RENDER_SETTINGS
+            if getattr(rt, name) != getattr(RayTracer, name)},
+        "textures": textures,
+        "meshes": meshes,
+        "materials": materials,
+        "objects": objects,
+    }
+
+#writes a RayTracer's scene as a scene file
+def save_scene(rt, fname):
+    save_description(describe(rt, os.path.dirname(os.path.abspath(fname))), fname)
+
+#writes a scene description, one object per line
+def save_description(desc, fname):
+    lines = ["{"]
+    for section in ("camera", "settings", "textures", "meshes", "materials"):
+        if section in desc:
+            lines.append(f'    "{section}": {json.dumps(desc[section])},')
+    lines.append('    "objects": [')
+    lines.append(",\n".join(f"        {json.dumps(obj)}" for obj in desc["objects"]))
+    lines.append("    ]")
+    lines.append("}")
+    with open(fname, "w") as f:
+        f.write("\n".join(lines) + "\n")
+    print(f"Scene written to {fname}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Scene files")
+    sub = parser.add_subparsers(dest="command", required=True)
+    export = sub.add_parser("export", help="write the random scene of main.build_scene as a scene file")
+    export.add_argument("fname")
+    export.add_argument("--spheres", type=int, default=40)
+    export.add_argument("--seed", type=int, default=1)
+    compile_cmd = sub.add_parser("compile", help="compile a scene file into the scene cache")
+    compile_cmd.add_argument("fname")
+    args = parser.parse_args()
+
+    if args.command == "export":
+        from main import RayTracer, build_scene
+        random.seed(args.seed)
+        rt = RayTracer(Vec3(0,0,0), Vec3(0,4,-4))
+        build_scene(rt, args.spheres)
+        save_scene(rt, args.fname)
+    else:
+        load_scene(args.fname)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+'''
+Random scene generator for stress scenes
+Places non overlapping spheres on a floor like main.build_scene, but checks each candidate only
+against the spheres in the neighbouring cells of a uniform spatial hash instead of against every
+sphere placed so far, so 100k spheres take seconds instead of hours. Everything is drawn from one
+seeded numpy generator, so a seed always gives the same scene:
+    radius      (low, high) with a "uniform" or "loguniform" distribution (more small spheres)
+    materials   weights of the material kinds, e.g. {"lambertian": 0.6, "metal": 0.3, "dielectric": 0.1}
+    palette     None gives every sphere its own color, k shares k materials of each kind between spheres
+The floor grows with the number of spheres unless bounds are given. Spheres go straight into
+a RayTracer (add_to) or into a scene description for scenefile.py (describe).
+
+    python3 scenegen.py 100000 big.json --seed 1     writes a scene file with 100k spheres
+'''
+
+import argparse
+import math
+import time
+import numpy as np
+from util import *
+from objects import *
+
+MATERIAL_KINDS = ["lambertian", "metal", "dielectric"]
+DEFAULT_MIX = {"lambertian": 1.0, "metal": 1.0, "dielectric": 1.0}
+
+#grid of square cells over the floor, each holding the (x, z, radius) of the spheres whose center is in it
+#with cells at least as large as the largest diameter, overlapping spheres are always in neighbouring cells
+class SpatialHash():
+    def __init__(self, cell_size):
+        self.cell_size = cell_size
+        self.cells = {}
+
+    def cell(self, x, z):
+        return (math.floor(x / self.cell_size), math.floor(z / self.cell_size))
+
+    def insert(self, x, z, radius):
+        key = self.cell(x, z)
+        if key in self.cells:
+            self.cells[key].append((x, z, radius))
+        else:
+            self.cells[key] = [(x, z, radius)]
+
+    #checks a sphere resting on the floor against the spheres near it, like main.are_colliding
+    def collides(self, x, z, radius):
+        cx, cz = self.cell(x, z)
+        cells = self.cells
+        for i in (cx - 1, cx, cx + 1):
+            for k in (cz - 1, cz, cz + 1):
+                for ox, oz, r in cells.get((i, k), ()):
+                    dx = x - ox
+                    dz = z - oz
+                    dy = radius - r
+                    reach = radius + r
+                    if dx*dx + dy*dy + dz*dz < reach*reach:
+                        return True
+        return False
+
+class SceneGenerator():
+    #bounds is the floor (x0, x1, z0, z1), None sizes it so spheres cover about density of its area
+    def __init__(self, num_spheres, seed=1, bounds=None, radius=(0.5, 1.5), distribution="uniform",
+            materials=None, palette=None, density=0.3, max_attempts=50):
+        if distribution not in ("uniform", "loguniform"):
+            raise ValueError(f"Unknown radius distribution {distribution}")
+        mix = materials or DEFAULT_MIX
+        for kind in mix:
+            if kind not in MATERIAL_KINDS:
+                raise ValueError(f"Unknown material kind {kind}, choose from {', '.join(MATERIAL_KINDS)}")
+        self.num_spheres = num_spheres
+        self.rng = np.random.default_rng(seed)
+        self.radius = radius
+        self.distribution = distribution
+        self.mix = mix
+        self.palette = palette
+        self.max_attempts = max_attempts
+        self.bounds = bounds or self.fit_floor(density)
+
+        #filled in by generate
+        self.centers = np.zeros((0, 3))
+        self.radii = np.zeros(0)
+        self.kinds = np.zeros(0, dtype=np.int8)
+        self.colors = np.zeros((0, 3))
+
+    #a floor in front of the default camera, large enough for the spheres to cover density of its area
+    def fit_floor(self, density):
+        low, high = self.radius
+        #mean squared radius of the distribution
+        if self.distribution == "uniform" or low == high:
+            mean_sq = (low*low + low*high + high*high) / 3
+        else:
+            mean_sq = (high*high - low*low) / (2*math.log(high / low))
+        side = max(20.0, math.sqrt(self.num_spheres*math.pi*mean_sq / density))
+        return (-side/2, side/2, -4.0, side - 4.0)
+
+    def draw_radii(self, n):
+        low, high = self.radius
+        if self.distribution == "uniform":
+            return self.rng.uniform(low, high, n)
+        return np.exp(self.rng.uniform(math.log(low), math.log(high), n))
+
+    #places the spheres, candidates are drawn in batches and tested one by one against the spatial hash
+    #stops early with fewer spheres if max_attempts candidates per sphere are rejected
+    def generate(self):
+        x0, x1, z0, z1 = self.bounds
+        grid = SpatialHash(2*self.radius[1])
+        xs = []
+        zs = []
+        rs = []
+        attempts = 0
+        limit = self.max_attempts*self.num_spheres
+        while len(rs) < self.num_spheres and attempts < limit:
+            batch = min(max(1024, 2*(self.num_spheres - len(rs))), limit - attempts)
+            cand_r = self.draw_radii(batch).tolist()
+            cand_x = self.rng.uniform(x0, x1, batch).tolist()
+            cand_z = self.rng.uniform(z0, z1, batch).tolist()
+            for x, z, r in zip(cand_x, cand_z, cand_r):
+                attempts += 1
+                if not grid.collides(x, z, r):
+                    grid.insert(x, z, r)
+                    xs.append(x)
+                    zs.append(z)
+                    rs.append(r)
+                    if len(rs) == self.num_spheres:
+                        break
+        if len(rs) < self.num_spheres:
+            print(f"Only placed {len(rs)} of {self.num_spheres} spheres in {attempts} attempts, the floor is full")
+
+        n = len(rs)
+        self.radii = np.array(rs)
+        self.centers = np.stack([np.array(xs), self.radii, np.array(zs)], axis=1).reshape((n, 3))
+        weights = np.array([self.mix.get(kind, 0.0) for kind in MATERIAL_KINDS])
+        self.kinds = self.rng.choice(len(MATERIAL_KINDS), n, p=weights/weights.sum()).astype(np.int8)
+        #the same range as the random albedos of Lambertian() and Metal()
+        if self.palette is None:
+            self.colors = self.rng.uniform(0.3, 1.0, (n, 3))
+        else:
+            self.colors = self.rng.integers(0, self.palette, n)
+            self.palette_colors = self.rng.uniform(0.3, 1.0, (len(MATERIAL_KINDS), self.palette, 3))
+        return self
+
+    #material name of every sphere and the scene file description of every name
+    #dielectrics are all the same, with a palette the colors of the other kinds are shared as well
+    def material_table(self):
+        names = []
+        table = {}
+        for idx, (kind, color) in enumerate(zip(self.kinds.tolist(), self.colors.tolist())):
+            kind_name = MATERIAL_KINDS[kind]
+            if kind_name == "dielectric":
+                name, desc = kind_name, {"type": kind_name, "ior": 1.5}
+            elif self.palette is None:
+                name, desc = f"{kind_name}{idx}", {"type": kind_name, "color": color}
+            else:
+                name, desc = f"{kind_name}{color}", {"type": kind_name, "color": self.palette_colors[kind][color].tolist()}
+            if name not in table:
+                table[name] = desc
+            names.append(name)
+        return names, table
+
+    #the material of every sphere, spheres with the same material name share the object
+    def materials(self):
+        from scenefile import make_material
+        names, table = self.material_table()
+        made = {name: make_material(desc, {}) for name, desc in table.items()}
+        return [made[name] for name in names]
+
+    #adds the floor and the spheres to a RayTracer
+    def add_to(self, rt, floor_material=None):
+        x0, x1, z0, z1 = self.bounds
+        rt.add_object(RectFlat(x0, x1, z0, z1, 0, floor_material or Lambertian(CheckerColor())))
+        from_values = Sphere.from_values
+        for (x, y, z), r, material in zip(self.centers.tolist(), self.radii.tolist(), self.materials()):
+            rt.add_object(from_values(x, y, z, r, material))
+
+    #scene description for scenefile.py with the default camera, the floor is a checkerboard
+    def describe(self, settings=None):
+        x0, x1, z0, z1 = self.bounds
+        names, table = self.material_table()
+        objects = [{"type": "rect", "x0": x0, "x1": x1, "z0": z0, "z1": z1, "k": 0, "material": "floor"}]
+        for (x, y, z), r, name in zip(self.centers.tolist(), self.radii.tolist(), names):
+            objects.append({"type": "sphere", "center": [x, y, z], "radius": r, "material": name})
+        return {
+            "camera": {"lookfrom": [0, 4, -4], "lookat": [0, 0, 0]},
+            "settings": settings or {},
+            "textures": {},
+            "materials": {"floor": {"type": "lambertian", "checker": True}, **table},
+            "objects": objects,
+        }
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a random stress scene file")
+    parser.add_argument("num_spheres", type=int)
+    parser.add_argument("fname")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--radius", type=float, nargs=2, default=(0.5, 1.5), metavar=("LOW", "HIGH"))
+    parser.add_argument("--distribution", choices=("uniform", "loguniform"), default="uniform")
+    parser.add_argument("--mix", type=float, nargs=3, default=(1.0, 1.0, 1.0), metavar=("LAMBERTIAN", "METAL", "DIELECTRIC"),
+        help="relative weights of the material kinds")
+    parser.add_argument("--palette", type=int, default=None, help="materials of each kind shared between the spheres")
+    parser.add_argument("--density", type=float, default=0.3, help="fraction of the floor covered by spheres")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    gen = SceneGenerator(args.num_spheres, args.seed, radius=tuple(args.radius), distribution=args.distribution,
+        materials=dict(zip(MATERIAL_KINDS, args.mix)), palette=args.palette, density=args.density).generate()
+    print(f"Placed {len(gen.radii)} spheres in {time.perf_counter() - start:.2f}s")
+
+    from scenefile import save_description
+    save_description(gen.describe(), args.fname)
+
+if __name__ == "__main__":
+    main()
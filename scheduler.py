@@ -0,0 +1,210 @@
+'''
+Tile scheduler for multiprocess rendering
+A fixed pool of worker processes pulls square tiles from a shared work queue.
+Tiles are queued most expensive first (estimated by probing a few camera rays),
+so the long floor and sphere tiles start early and cheap sky tiles fill in the gaps at the end.
+A worker that dies stops the render with an error instead of leaving the parent waiting for its tiles
+'''
+
+import gc
+import multiprocessing as mp
+import queue
+import random
+import time
+import os
+from util import *
+from objects import CollisionPacket
+import metrics
+
+#a rectangle of pixels, rows j0..j1 counted from the bottom of the image, columns i0..i1
+class Tile():
+    def __init__(self, index, j0, j1, i0, i1):
+        self.index = index
+        self.j0 = j0
+        self.j1 = j1
+        self.i0 = i0
+        self.i1 = i1
+        self.cost = 0
+
+    @property
+    def pixels(self):
+        return (self.j1 - self.j0)*(self.i1 - self.i0)
+
+    def __str__(self):
+        return f"Tile {self.index}: rows {self.j0}-{self.j1} cols {self.i0}-{self.i1}"
+
+#splits the image into tiles of size x size pixels, the last row and column of tiles may be smaller
+def make_tiles(height, width, size):
+    tiles = []
+    for j0 in range(0, height, size):
+        for i0 in range(0, width, size):
+            tiles.append(Tile(len(tiles), j0, min(j0+size, height), i0, min(i0+size, width)))
+    return tiles
+
+#rough relative cost of a tile: shoots a few camera rays through it
+#rays that escape to the sky are cheap, rays that hit something keep bouncing
+def estimate_cost(rt, tile, probes=2):
+    hits = 0
+    for a in range(probes):
+        for b in range(probes):
+            j = tile.j0 + (a + 0.5)*(tile.j1 - tile.j0)/probes
+            i = tile.i0 + (b + 0.5)*(tile.i1 - tile.i0)/probes
+            ray = rt.camera.get_ray(i / (rt.image_width-1), j / (rt.image_height-1))
+            if rt.world.hit(ray, 0.001, CollisionPacket()):
+                hits += 1
+    #a hit costs several bounces, a miss costs one ray
+    return tile.pixels*(1 + 4*hits/(probes*probes))
+
+#default work for a tile: draw it into the shared image
+def color_tile(rt, tile):
+    rt.color_tile(tile.j0, tile.j1, tile.i0, tile.i1)
+
+#memory only this process uses (pages shared with the parent or other workers are not counted), in bytes
+#None where /proc is not available
+def private_memory():
+    try:
+        with open("/proc/self/smaps_rollup") as f:
+            fields = dict(line.split(":", 1) for line in f if line.startswith("Private_"))
+    except OSError:
+        return None
+    return sum(int(v.split()[0]) for v in fields.values())*1024
+
+#worker loop: pull tiles until the None sentinel is received
+#launched is the time the parent started the workers, the first message reports the startup time
+def tile_worker(rt, work, task_queue, result_queue, launched):
+    #forked workers inherit the parent's random state, reseed so they do not repeat each other's samples
+    random.seed()
+    result_queue.put((None, time.time() - launched, os.getpid(), {"memory": private_memory()}))
+    while True:
+        tile = task_queue.get()
+        if tile is None:
+            break
+        start = time.perf_counter()
+        before = rt.counters()
+        work(rt, tile)
+        stats = metrics.diff_counters(rt.counters(), before)
+        stats["memory"] = private_memory()
+        result_queue.put((tile.index, time.perf_counter() - start, os.getpid(), stats))
+
+#next message from the workers in procs, polled every poll seconds so a worker that died (killed for
+#running out of memory, a crash in native code) stops the render with an error instead of a hang
+#the other workers are terminated, the tiles they were drawing are lost
+def get_result(result_queue, procs, poll=1.0):
+    while True:
+        try:
+            return result_queue.get(timeout=poll)
+        except queue.Empty:
+            pass
+        dead = [p for p in procs if p.exitcode not in (None, 0)]
+        if not dead and any(p.exitcode is None for p in procs):
+            continue
+        #a worker may have put its last results just before exiting
+        try:
+            return result_queue.get(timeout=poll)
+        except queue.Empty:
+            pass
+        for p in procs:
+            if p.is_alive():
+                p.terminate()
+        if dead:
+            raise RuntimeError("Worker " + ", ".join(f"{p.pid} died with exit code {p.exitcode}" for p in dead))
+        raise RuntimeError("Every worker exited before the render was finished")
+
+#work(rt, tile) is run for every tile in a worker process, by default it draws the tile into rt.mp_arr
+#tiles restricts the run to a subset of the image's tiles, tiles that already have a cost are not probed again
+class TileScheduler():
+    def __init__(self, rt, workers=None, tile_size=32, work=color_tile, tiles=None):
+        self.rt = rt
+        self.workers = workers or mp.cpu_count()
+        self.tile_size = tile_size
+        self.work = work
+        self.tiles = tiles if tiles is not None else make_tiles(rt.image_height, rt.image_width, tile_size)
+        self.timings = {}
+        #pid -> (startup seconds, private memory in bytes after startup)
+        self.startup = {}
+        #pid -> largest private memory in bytes reported after a tile
+        self.memory = {}
+        #counters summed over all workers, see RayTracer.counters
+        self.counters = {}
+
+    #with rt.shared_scene, the scene is moved into shared memory for the duration of the run
+    def run(self):
+        if self.rt.shared_scene:
+            self.rt.share_scene()
+        try:
+            self.run_workers()
+        finally:
+            if self.rt.shared is not None:
+                self.rt.unshare_scene()
+
+    def run_workers(self):
+        start = time.perf_counter()
+        for tile in self.tiles:
+            if tile.cost == 0:
+                tile.cost = estimate_cost(self.rt, tile)
+        queue_order = sorted(self.tiles, key=lambda t: t.cost, reverse=True)
+        print(f"Scheduling {len(self.tiles)} tiles of {self.tile_size}x{self.tile_size} on {self.workers} workers "
+            f"(cost estimate took {time.perf_counter() - start:.2f}s)")
+
+        task_queue = mp.Queue()
+        result_queue = mp.Queue()
+        for tile in queue_order:
+            task_queue.put(tile)
+        for _ in range(self.workers):
+            task_queue.put(None)
+
+        tiles = {tile.index: tile for tile in self.tiles}
+        launched = time.time()
+        procs = [mp.Process(target=tile_worker, args=(self.rt, self.work, task_queue, result_queue, launched)) for _ in range(self.workers)]
+        #objects that exist now are moved out of the garbage collector's reach, so forked workers
+        #collecting garbage do not write to the pages they share with the parent
+        gc.freeze()
+        for p in procs:
+            p.start()
+        gc.unfreeze()
+
+        total_pixels = sum(t.pixels for t in self.tiles)
+        done_pixels = 0
+        next_report = 0.05
+        while len(self.timings) < len(self.tiles):
+            index, seconds, pid, stats = get_result(result_queue, procs)
+            if index is None:
+                self.startup[pid] = (seconds, stats["memory"])
+                continue
+            self.timings[index] = (seconds, pid)
+            memory = stats.pop("memory")
+            if memory is not None:
+                self.memory[pid] = max(memory, self.memory.get(pid, 0))
+            metrics.add_counters(self.counters, stats)
+            done_pixels += tiles[index].pixels
+            if done_pixels / total_pixels >= next_report:
+                elapsed = time.perf_counter() - start
+                print(f"{100*done_pixels/total_pixels:.1f}% done, {len(self.timings)}/{len(self.tiles)} tiles, {elapsed:.1f}s elapsed, "
+                    f"{self.counters.get('segments', 0)/elapsed:.0f} rays/sec")
+                next_report = done_pixels/total_pixels + 0.05
+
+        for p in procs:
+            p.join()
+
+        self.wall_time = time.perf_counter() - start
+        self.report()
+
+    #per tile timing summary
+    def report(self, slowest=5):
+        times = sorted(((s, i) for i, (s, _) in self.timings.items()), reverse=True)
+        if not times:
+            return
+        busy = sum(s for s, _ in times)
+        print(f"Rendered {len(times)} tiles in {self.wall_time:.2f}s: "
+            f"tile time min {times[-1][0]:.3f}s, mean {busy/len(times):.3f}s, max {times[0][0]:.3f}s, "
+            f"worker utilization {100*busy/(self.wall_time*self.workers):.1f}%")
+        if self.startup:
+            startup = [s for s, _ in self.startup.values()]
+            memory = [m for _, m in self.startup.values() if m is not None]
+            print(f"Worker startup {1000*min(startup):.1f}-{1000*max(startup):.1f}ms"
+                + (f", private memory {max(memory)/1e6:.1f} MB after startup" if memory else "")
+                + (f", {max(self.memory.values())/1e6:.1f} MB at most while rendering" if self.memory else ""))
+        tiles = {tile.index: tile for tile in self.tiles}
+        for seconds, index in times[:slowest]:
+            tile = tiles[index]
+            print(f"    {tile} took {seconds:.3f}s (estimated cost {tile.cost:.0f})")
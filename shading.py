@@ -0,0 +1,173 @@
+'''
+Batched shading
+Shades a whole batch of hits at once instead of calling Material.scatter and Color.value per hit.
+Hits are grouped by material kind, and every group is bounced by one numpy kernel:
+    Lambertian   the normal plus a uniformly distributed unit vector (cosine weighted directions)
+    Metal        mirror reflection
+    Dielectric   refraction, or reflection past the critical angle
+Albedos are grouped the same way by color kind: solid colors, checkers and textures, each texture
+looked up with the same bilinear and trilinear mip filtering as Texture.value.
+The wavefront engine shades every bounce with shade(), and with batch_shading the scalar engine
+intersects its rays one at a time but shades all of them together, see RayTracer.trace_batch
+'''
+
+import numpy as np
+from packed import *
+
+SKY_TOP = np.array([0.3, 0.5, 0.8])
+
+#hits of a batch of rays, structure of arrays
+#normal points against the ray, material indexes the packed scene's material arrays and
+#footprint is the width of the ray's footprint in texture coordinates (see CollisionPacket)
+class HitRecords():
+    def __init__(self, p, normal, front_face, u, v, material, footprint=None):
+        self.p = p
+        self.normal = normal
+        self.front_face = front_face
+        self.u = u
+        self.v = v
+        self.material = material
+        self.footprint = footprint if footprint is not None else np.zeros(len(material))
+
+    def __len__(self):
+        return len(self.material)
+
+    #records of scalar CollisionPackets, materials holds the packed material index of every hit
+    @classmethod
+    def from_collisions(cls, collisions, materials):
+        values = np.array([
+            (c.p.x, c.p.y, c.p.z, c.normal.x, c.normal.y, c.normal.z, c.u, c.v, c.footprint, c.front_face)
+            for c in collisions], dtype=np.float64).reshape((-1, 10))
+        return cls(values[:, 0:3], values[:, 3:6], values[:, 9] > 0, values[:, 6], values[:, 7],
+            np.asarray(materials, dtype=np.int32), values[:, 8])
+
+#indices of the elements of keys equal to each of range(count), every group in its original order
+def groups(keys, count):
+    order = np.argsort(keys, kind="stable")
+    bounds = np.searchsorted(keys[order], np.arange(count + 1))
+    return [order[bounds[k]:bounds[k+1]] for k in range(count)]
+
+#bounce directions and attenuations of a batch of hits
+#directions are the directions of the incoming rays, samples(idx) returns the 2D samples (u, v)
+#in [0, 1)^2 of the hits idx for the Lambertian bounces
+#rays whose new direction has a zero component are absorbed, as in ray_color
+def shade(scene, hits, directions, samples):
+    unit = directions / np.linalg.norm(directions, axis=1)[:, None]
+    direction = np.zeros((len(hits), 3))
+    mtype = scene.mat_type[hits.material]
+    for kind, idx in enumerate(groups(mtype, len(MAT_NAMES))):
+        if len(idx) == 0:
+            continue
+        if kind == MAT_LAMBERTIAN:
+            direction[idx] = lambertian(hits.normal[idx], *samples(idx))
+        elif kind == MAT_METAL:
+            direction[idx] = metal(unit[idx], hits.normal[idx])
+        else:
+            ior = scene.mat_ior[hits.material[idx]]
+            direction[idx] = dielectric(unit[idx], hits.normal[idx], hits.front_face[idx], ior)
+    return direction, albedo(scene, hits)
+
+#the normal plus a uniform unit vector from the samples u, v, which is cosine weighted about the normal
+def lambertian(normal, u, v):
+    direction = normal + unit_sphere_directions(u, v)
+    return keep_nonzero(direction, normal)
+
+def metal(unit, normal):
+    return keep_nonzero(reflect(unit, normal), normal)
+
+#refracts with Snell's law, rays that cannot refract are reflected
+def dielectric(unit, normal, front_face, ior):
+    ratio = np.where(front_face, 1.0 / ior, ior)
+    cos_theta = np.minimum(np.einsum("ij,ij->i", -unit, normal), 1.0)
+    sin_theta = np.sqrt(np.maximum(1.0 - cos_theta*cos_theta, 0.0))
+    cannot_refract = ratio*sin_theta > 1.0
+    r_out_perp = ratio[:, None]*(unit + cos_theta[:, None]*normal)
+    r_out_parallel = -np.sqrt(np.abs(1.0 - np.einsum("ij,ij->i", r_out_perp, r_out_perp)))[:, None]*normal
+    return np.where(cannot_refract[:, None], reflect(unit, normal), r_out_perp + r_out_parallel)
+
+#directions that are almost zero are replaced by the normal, like Material.bounce_ray does
+def keep_nonzero(direction, normal):
+    degenerate = np.einsum("ij,ij->i", direction, direction) < 0.001
+    direction[degenerate] = normal[degenerate]
+    return direction
+
+#color of each hit's material at its texture coordinates
+def albedo(scene, hits):
+    material = hits.material
+    color = scene.mat_color[material].copy()
+    kind = scene.mat_color_kind[material]
+    solid, checker, textured = groups(kind, 3)
+
+    if len(checker):
+        even_v = (hits.v[checker] / 0.03).astype(np.int64) % 2 == 0
+        even_u = (hits.u[checker] / 0.03).astype(np.int64) % 2 == 0
+        dark = even_v == even_u
+        color[checker] = np.where(dark[:, None], (0.3, 0.3, 0.3), (0.9, 0.9, 0.3))
+
+    if len(textured):
+        tex_idx = scene.mat_texture[material[textured]]
+        for t in np.unique(tex_idx):
+            idx = textured[tex_idx == t]
+            color[idx] = texture_lookup(scene.texture_levels(t), bool(scene.tex_filtered[t]),
+                hits.u[idx], hits.v[idx], hits.footprint[idx])
+
+    return color
+
+#colors of a texture at u, v, filtered like Texture.value: nearest texel of the full resolution level
+#if unfiltered, otherwise bilinear in the two mip levels around the footprint's level of detail
+def texture_lookup(levels, filtered, u, v, footprint):
+    height, width = levels[0].shape[:2]
+    if not filtered:
+        h = np.minimum((v*height).astype(np.int64), height-1)
+        w = np.minimum((u*width).astype(np.int64), width-1)
+        return levels[0][h, w] / 255
+
+    texels = footprint*max(width, height)
+    lod = np.log2(np.maximum(texels, 1.0))
+    lod = np.minimum(lod, len(levels) - 1)
+    level = lod.astype(np.int64)
+    frac = lod - level
+    color = np.zeros((len(u), 3))
+    for l in np.unique(level):
+        idx = np.flatnonzero(level == l)
+        c = bilinear(levels[l], u[idx], v[idx])
+        blend = frac[idx] > 0
+        if blend.any():
+            b = idx[blend]
+            c[blend] += (bilinear(levels[l+1], u[b], v[b]) - c[blend])*frac[b][:, None]
+        color[idx] = c
+    return color / 255
+
+#bilinear lookups in one mip level, coordinates are clamped to the edges
+def bilinear(img, u, v):
+    height, width = img.shape[:2]
+    x = np.clip(u*width - 0.5, 0.0, width - 1.0)
+    y = np.clip(v*height - 0.5, 0.0, height - 1.0)
+    x0 = x.astype(np.int64)
+    y0 = y.astype(np.int64)
+    x1 = np.minimum(x0 + 1, width - 1)
+    y1 = np.minimum(y0 + 1, height - 1)
+    fx = (x - x0)[:, None]
+    fy = (y - y0)[:, None]
+    p00 = img[y0, x0].astype(np.float64)
+    p01 = img[y0, x1].astype(np.float64)
+    p10 = img[y1, x0].astype(np.float64)
+    p11 = img[y1, x1].astype(np.float64)
+    return (p00*(1-fx) + p01*fx)*(1-fy) + (p10*(1-fx) + p11*fx)*fy
+
+#color of the sky seen along each direction
+def sky_color(directions):
+    unit = directions / np.linalg.norm(directions, axis=1)[:, None]
+    t = 0.5*(unit[:, 1] + 1.0)[:, None]
+    return (1.0 - t) + SKY_TOP*t
+
+#uniformly distributed unit vectors for arrays of 2D samples u, v, see materials.unit_sphere_direction
+def unit_sphere_directions(u, v):
+    z = 1.0 - 2.0*u
+    r = np.sqrt(np.maximum(0.0, 1.0 - z*z))
+    phi = 2.0*np.pi*v
+    return np.stack((r*np.cos(phi), r*np.sin(phi), z), axis=1)
+
+#reflects each row of v about the matching row of n
+def reflect(v, n):
+    return v - 2*np.einsum("ij,ij->i", v, n)[:, None]*n
@@ -0,0 +1,69 @@
+'''
+Packed scenes in shared memory
+Every array of a PackedScene (geometry, materials, the flattened BVH and texture pixels) is copied
+once into its own multiprocessing.shared_memory block. A SharedScene pickles as just the block names,
+shapes and dtypes, so a worker process receives a few hundred bytes however large the scene is,
+and attaches to the blocks by name: its arrays are views of the same physical pages as the parent's.
+The process that created the blocks unlinks them when the render is done.
+'''
+
+from multiprocessing import shared_memory
+import numpy as np
+from packed import PackedScene
+
+class SharedScene():
+    #copies arrays (name -> numpy array) into new shared memory blocks
+    def __init__(self, arrays):
+        self.spec = {}
+        self.blocks = {}
+        self.owner = True
+        for name, arr in arrays.items():
+            arr = np.ascontiguousarray(arr)
+            #zero sized blocks are not allowed
+            block = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+            np.ndarray(arr.shape, arr.dtype, buffer=block.buf)[...] = arr
+            self.spec[name] = (block.name, arr.dtype.str, arr.shape)
+            self.blocks[name] = block
+        self.views = None
+
+    @property
+    def nbytes(self):
+        return sum(block.size for block in self.blocks.values())
+
+    def __getstate__(self):
+        return {"spec": self.spec}
+
+    #attaches to the blocks of a scene created in another process
+    def __setstate__(self, state):
+        self.spec = state["spec"]
+        self.blocks = {name: shared_memory.SharedMemory(name=block_name)
+            for name, (block_name, dtype, shape) in self.spec.items()}
+        self.owner = False
+        self.views = None
+
+    #read only numpy views of the blocks
+    def arrays(self):
+        if self.views is None:
+            self.views = {}
+            for name, (block_name, dtype, shape) in self.spec.items():
+                view = np.ndarray(shape, np.dtype(dtype), buffer=self.blocks[name].buf)
+                view.flags.writeable = False
+                self.views[name] = view
+        return self.views
+
+    #a PackedScene over the shared arrays, it pickles back to this SharedScene
+    def packed(self):
+        return PackedScene(self.arrays(), self)
+
+    #detaches this process, the views must not be used afterwards
+    def close(self):
+        self.views = None
+        for block in self.blocks.values():
+            block.close()
+
+    #detaches and frees the blocks, only done by the process that created them
+    def unlink(self):
+        self.close()
+        if self.owner:
+            for block in self.blocks.values():
+                block.unlink()
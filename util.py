@@ -1,4 +1,3 @@
-
 import random
 import math
 
@@ -6,135 +5,124 @@ import math
 #A Vec3 class
 #A ray class composed two two Vec3s
 
+#Vec3 stores its three components in slots rather than a list:
+#no per instance dict, no list allocation and direct attribute access to x, y, z
 class Vec3:
-    def __init__(self, x, y, z):
-        self.coor = [x,y,z]
+    __slots__ = ("x", "y", "z")
 
+    def __init__(self, x, y, z):
+        self.x = x
+        self.y = y
+        self.z = z
 
     @classmethod
     def from_array(cls, arr):
         return Vec3(arr[0], arr[1], arr[2])
 
     def unwrap(self):
-        return self.coor
-
-    @property
-    def x(self):
-        return self.coor[0]
-    @property
-    def y(self):
-        return self.coor[1]
-    @property
-    def z(self):
-        return self.coor[2]
+        return [self.x, self.y, self.z]
 
-    @classmethod
-    def dot(cls, n1, n2):
-        vec1 = n1.coor
-        vec2 = n2.coor
-        return vec1[0]*vec2[0] + vec1[1]*vec2[1] + vec1[2]*vec2[2]
+    @staticmethod
+    def dot(n1, n2):
+        return n1.x*n2.x + n1.y*n2.y + n1.z*n2.z
 
-    @classmethod
-    def cross(cls, n1, n2):
-        v1 = n1.coor
-        v2 = n2.coor
-        return Vec3(v1[1]*v2[2] - v1[2]*v2[1],
-                    v1[2]*v2[0] - v1[0]*v2[2],
-                    v1[0]*v2[1] - v1[1]*v2[0])
+    @staticmethod
+    def cross(n1, n2):
+        return Vec3(n1.y*n2.z - n1.z*n2.y,
+                    n1.z*n2.x - n1.x*n2.z,
+                    n1.x*n2.y - n1.y*n2.x)
 
     @classmethod
     def random(cls, lo, hi):
         return Vec3(random.uniform(lo, hi),
             random.uniform(lo, hi),
-            random.uniform(lo, hi))  
+            random.uniform(lo, hi))
+
+    #fused helpers, each builds a single Vec3 instead of one per operator
+
+    #a + b*t
+    @staticmethod
+    def madd(a, b, t):
+        return Vec3(a.x + b.x*t, a.y + b.y*t, a.z + b.z*t)
+
+    #v - 2*dot(v,n)*n, v reflected about the normal n
+    @staticmethod
+    def reflect(v, n):
+        k = 2*(v.x*n.x + v.y*n.y + v.z*n.z)
+        return Vec3(v.x - k*n.x, v.y - k*n.y, v.z - k*n.z)
 
     # def norm(self):
     #     maxv = abs(max(self.coor, key=abs))
     #     return Vec3(self.coor[0]/maxv, self.coor[1]/maxv, self.coor[2]/maxv)
 
     def unit_length(self):
-        length = math.sqrt(self.len_squared())
-        return Vec3(self.coor[0]/length, self.coor[1]/length, self.coor[2]/length)
+        length = math.sqrt(self.x*self.x + self.y*self.y + self.z*self.z)
+        return Vec3(self.x/length, self.y/length, self.z/length)
 
     def sqrt(self):
-        return Vec3(math.sqrt(self.coor[0]), math.sqrt(self.coor[1]), math.sqrt(self.coor[2]))
+        return Vec3(math.sqrt(self.x), math.sqrt(self.y), math.sqrt(self.z))
 
     def len_squared(self):
-        return self.coor[0]*self.coor[0] + self.coor[1]*self.coor[1] + self.coor[2]*self.coor[2]
+        return self.x*self.x + self.y*self.y + self.z*self.z
 
+    def has_zero(self):
+        return self.x == 0 or self.y == 0 or self.z == 0
 
     def __add__(self, other):
         if isinstance(other, Vec3):
-            return Vec3(self.coor[0] + other.coor[0],
-                self.coor[1] + other.coor[1],
-                self.coor[2] + other.coor[2])
-        return Vec3(self.coor[0] + other,
-            self.coor[1] + other,
-            self.coor[2] + other)
+            return Vec3(self.x + other.x, self.y + other.y, self.z + other.z)
+        return Vec3(self.x + other, self.y + other, self.z + other)
 
     def __radd__(self, other):
         return self.__add__(other)
 
     def __mul__(self, other):
         if isinstance(other, Vec3):
-            return Vec3(self.coor[0]*other.coor[0],
-                self.coor[1]*other.coor[1],
-                self.coor[2]*other.coor[2])
-        return Vec3(self.coor[0]*other,
-            self.coor[1]*other,
-            self.coor[2]*other)
+            return Vec3(self.x*other.x, self.y*other.y, self.z*other.z)
+        return Vec3(self.x*other, self.y*other, self.z*other)
 
     def __rmul__(self, other):
         return self.__mul__(other)
 
     def __truediv__(self, other):
-        return Vec3(self.coor[0]/other,
-            self.coor[1]/other,
-            self.coor[2]/other)
+        return Vec3(self.x/other, self.y/other, self.z/other)
 
     def __sub__(self, other):
         if isinstance(other, Vec3):
-            return Vec3(self.coor[0] - other.coor[0],
-                self.coor[1] - other.coor[1],
-                self.coor[2] - other.coor[2])
-        return Vec3(self.coor[0] - other,
-            self.coor[1] - other,
-            self.coor[2] - other)            
+            return Vec3(self.x - other.x, self.y - other.y, self.z - other.z)
+        return Vec3(self.x - other, self.y - other, self.z - other)
+
+    def __neg__(self):
+        return Vec3(-self.x, -self.y, -self.z)
 
     def __getitem__(self, key):
-        return self.coor[key]
+        if key == 0: return self.x
+        if key == 1: return self.y
+        if key == 2: return self.z
+        return self.unwrap()[key]
 
     def __str__(self):
-        return f"({self.coor})"
+        return f"({self.unwrap()})"
 
 class Point3(Vec3):
-    def __init__(self, x, y, z):
-        Vec3.__init__(self, x, y, z)
-    def __init__(self, arr):
-        Vec3.__init__(arr)
+    __slots__ = ()
 
 
 
+#origin and direction are plain slots, a Ray is built for every bounce so construction is kept minimal
+#spread is the angle covered by the pixel the ray came from (0 if unknown), used to filter textures
 class Ray:
-    def __init__(self, origin, direction):
-        assert(isinstance(origin, Vec3))
-        assert(isinstance(direction, Vec3))
-
-        self._origin = origin
-        self._direction = direction
+    __slots__ = ("origin", "direction", "spread")
 
-    @property
-    def origin(self):
-        return self._origin
-
-    @property
-    def direction(self):
-        return self._direction
+    def __init__(self, origin, direction, spread=0.0):
+        self.origin = origin
+        self.direction = direction
+        self.spread = spread
 
     def unit_direction(self):
-        return self._direction.unit_length()
+        return self.direction.unit_length()
 
     def at(self, t):
-        return self._origin + self._direction*t
-
-
+        o = self.origin
+        d = self.direction
+        return Vec3(o.x + d.x*t, o.y + d.y*t, o.z + d.z*t)
@@ -0,0 +1,357 @@
+'''
+Wavefront path tracer
+Instead of following one sample at a time through the recursive RayTracer.ray_color,
+rays are kept in structure of arrays numpy buffers (origins, directions, throughput, pixel index)
+and the whole batch is advanced one bounce at a time:
+    intersect all rays -> shade misses with the sky -> scatter hits -> drop dead rays -> repeat
+Hits are shaded by the material sorted kernels of shading.py
+'''
+
+import numpy as np
+from packed import *
+import samplers
+import shading
+import coherence
+import intersect
+
+LUMINANCE = np.array([0.2126, 0.7152, 0.0722])
+
+#a batch of rays that are still alive, stored as structure of arrays
+#key holds the (px, py, sample index) of every ray as uint64 when the renderer has a sample pattern
+class RayBatch():
+    def __init__(self, origins, directions, throughput, pixel, key=None):
+        self.origins = origins
+        self.directions = directions
+        self.throughput = throughput
+        self.pixel = pixel
+        self.key = key
+
+    def __len__(self):
+        return len(self.pixel)
+
+    #keeps only the rays where mask is true, or the rays at the indices in mask, in that order
+    def compact(self, mask):
+        key = self.key[mask] if self.key is not None else None
+        return RayBatch(self.origins[mask], self.directions[mask], self.throughput[mask], self.pixel[mask], key)
+
+    #2D samples of dimension dim for every ray
+    def sample2d(self, sampler, dim):
+        return sampler.sample2d(self.key[:, 0], self.key[:, 1], self.key[:, 2], dim)
+
+#closest hits of a batch of rays
+#kind is -1 for a miss, 0 for a sphere and 1 for a flat rectangle, idx indexes into that primitive's arrays
+class HitBatch():
+    def __init__(self, t, kind, idx):
+        self.t = t
+        self.kind = kind
+        self.idx = idx
+
+class WavefrontRenderer():
+    t_min = 0.001
+    t_max = 99999
+
+    #rr_min_depth turns on russian roulette after that many bounces, None traces every path to ray_depth
+    #hit_counts is a dict to count hits per object type and material into (see metrics.py), None to skip that
+    #sampler is a samplers.Sampler for camera jitter, Lambertian bounces and russian roulette, None uses the rng of each tile
+    #packet_size walks the scene's BVH with packets of that many rays (see coherence.PacketBVH) in scenes
+    #of at least coherence.PACKET_MIN_PRIMITIVES primitives, None tests every ray against every primitive
+    #in any scene. reorder sorts the rays of every bounce after the first by direction octant and origin
+    #before intersecting them with packets
+    def __init__(self, scene:PackedScene, camera, image_width, image_height, ray_depth, batch_size=1<<17, seed=None, rr_min_depth=None, hit_counts=None, sampler=None, packet_size=None, reorder=False):
+        #every primitive is tested against every ray, which is only practical for spheres and rectangles
+        if scene.num_instances:
+            raise ValueError("The wavefront engine does not render mesh instances, use the scalar engine")
+        self.scene = scene
+        self.sampler = sampler
+        self.rr_min_depth = rr_min_depth
+        self.path_count = 0
+        self.segment_count = 0
+        #every ray is tested against every primitive, unless packets walk the BVH
+        self.prim_tests = 0
+        self.packet_size = packet_size
+        #smaller scenes are tested brute force even with packet_size, where that is faster
+        self.packet_min_primitives = coherence.PACKET_MIN_PRIMITIVES
+        self.reorder = reorder
+        #PacketBVH of the current scene, made on first use (the scene is replaced while sharing it)
+        self.packet_bvh = None
+        self.bounds = None
+        #packet node visits and ray box tests of the packet traversal
+        self.node_visits = 0
+        self.box_tests = 0
+        #hits closer than the ones found before them (the attributes a single phase intersection would
+        #compute), hits whose attributes were computed, and those that also needed texture coordinates
+        self.closer_hits = 0
+        self.attr_fills = 0
+        self.uv_fills = 0
+        self.hit_counts = hit_counts
+        self.camera = camera
+        self.image_width = image_width
+        self.image_height = image_height
+        self.ray_depth = ray_depth
+        self.batch_size = batch_size
+        #every tile draws from its own stream derived from this seed,
+        #so forked workers do not repeat each other's random numbers
+        self.seed = np.random.SeedSequence(seed).entropy
+
+    #renders rows j0..j1 and columns i0..i1 (rows counted from the bottom of the image)
+    #returns the summed color of all samples as a (j1-j0, i1-i0, 3) array
+    #renders of the same tile with a different stream use different random numbers
+    #with a sampler, the samples are numbered from stream
+    def render_tile(self, j0, j1, i0, i1, samples, stream=0):
+        rng = np.random.default_rng([self.seed, j0, i0, samples, stream])
+        jj, ii = tile_pixels(j0, j1, i0, i1)
+        accum = self.render_pixels(jj, ii, samples, rng, first_sample=stream)
+        return accum.reshape((j1-j0, i1-i0, 3))
+
+    #renders samples through each of the pixels (jj[k], ii[k]), returns the summed colors as a (len(jj), 3) array
+    def render_points(self, jj, ii, samples, stream=0):
+        rng = np.random.default_rng([self.seed, int(jj[0]), int(ii[0]), len(jj), samples, stream])
+        return self.render_pixels(np.asarray(jj), np.asarray(ii), samples, rng, first_sample=stream)
+
+    #renders a tile with adaptive sampling, see adaptive.AdaptiveSampler
+    #returns the summed color as a (j1-j0, i1-i0, 3) array and the samples taken per pixel
+    def render_tile_adaptive(self, j0, j1, i0, i1, sampler):
+        rng = np.random.default_rng([self.seed, j0, i0, sampler.max_samples, sampler.min_samples])
+        jj, ii = tile_pixels(j0, j1, i0, i1)
+        npix = len(jj)
+        accum = np.zeros((npix, 3))
+        lum_sq = np.zeros(npix)
+        counts = np.zeros(npix, dtype=np.int64)
+
+        #every pixel that is still active has taken the same number of samples
+        active = np.arange(npix)
+        taken = 0
+        count = min(sampler.min_samples, sampler.max_samples)
+        while len(active) > 0 and count > 0:
+            sq = np.zeros(len(active))
+            accum[active] += self.render_pixels(jj[active], ii[active], count, rng, sq, taken)
+            lum_sq[active] += sq
+            taken += count
+            counts[active] = taken
+
+            lum = accum[active] @ LUMINANCE
+            active = active[~sampler.converged(taken, lum, lum_sq[active])]
+            count = min(sampler.batch, sampler.max_samples - taken)
+
+        return accum.reshape((j1-j0, i1-i0, 3)), counts.reshape((j1-j0, i1-i0))
+
+    #renders samples for each pixel (jj[k], ii[k]) and returns their summed colors as an (n, 3) array
+    #if lum_sq is given, the squared luminance of every sample is added into it
+    #with a sampler, the samples of every pixel are numbered from first_sample
+    def render_pixels(self, jj, ii, samples, rng, lum_sq=None, first_sample=0):
+        npix = len(jj)
+        accum = np.zeros((npix, 3), dtype=np.float64)
+        if npix == 0:
+            return accum
+
+        per_batch = max(1, self.batch_size // npix)
+        done = 0
+        while done < samples:
+            count = min(per_batch, samples - done)
+            pixel = np.tile(np.arange(npix), count)
+            if self.sampler is None:
+                key = None
+                v = (np.tile(jj, count) + rng.random(npix*count)) / (self.image_height-1)
+                u = (np.tile(ii, count) + rng.random(npix*count)) / (self.image_width-1)
+            else:
+                key = np.empty((npix*count, 3), dtype=np.uint64)
+                key[:, 0] = np.tile(ii, count)
+                key[:, 1] = np.tile(jj, count)
+                key[:, 2] = np.repeat(np.arange(count), npix) + (first_sample + done)
+                du, dv = self.sampler.sample2d(key[:, 0], key[:, 1], key[:, 2], samplers.CAMERA_DIM)
+                v = (key[:, 1] + dv) / (self.image_height-1)
+                u = (key[:, 0] + du) / (self.image_width-1)
+            origins, directions = self.camera.get_rays(u, v)
+            rays = RayBatch(origins, directions, np.ones((len(pixel), 3)), pixel, key)
+            self.trace(rays, accum, rng, lum_sq)
+            done += count
+
+        return accum
+
+    #advances a batch of rays bounce by bounce, adding finished paths into accum
+    def trace(self, rays, accum, rng, lum_sq=None):
+        self.path_count += len(rays)
+        for bounce in range(self.ray_depth):
+            if len(rays) == 0:
+                break
+            self.segment_count += len(rays)
+            #camera rays are already coherent in pixel order, and brute force gains nothing from sorting
+            if self.reorder and bounce > 0 and self.use_packets():
+                rays = rays.compact(coherence.ray_order(rays.origins, rays.directions, self.scene_bounds()))
+            hits = self.intersect(rays.origins, rays.directions)
+            if self.hit_counts is not None:
+                self.count_hits(hits)
+
+            miss = hits.kind < 0
+            if miss.any():
+                self.add_sky(rays.compact(miss), accum, lum_sq)
+
+            alive = ~miss
+            rays = rays.compact(alive)
+            hits = HitBatch(hits.t[alive], hits.kind[alive], hits.idx[alive])
+            rays = self.scatter(rays, hits, rng, bounce)
+            if self.rr_min_depth is not None and bounce+1 >= self.rr_min_depth:
+                rays = self.russian_roulette(rays, rng, bounce)
+        #rays still bouncing after ray_depth bounces contribute black
+
+    #terminates paths with probability 1 - max(throughput), survivors are divided by the survival probability
+    def russian_roulette(self, rays, rng, bounce=0):
+        p = np.minimum(rays.throughput.max(axis=1), 1.0)
+        if self.sampler is None:
+            survive = rng.random(len(rays)) < p
+        else:
+            survive = rays.sample2d(self.sampler, samplers.roulette_dim(bounce))[0] < p
+        rays = rays.compact(survive)
+        rays.throughput /= p[survive][:, None]
+        return rays
+
+    #bounds of the current scene for the sort keys of reorder
+    def scene_bounds(self):
+        if self.bounds is None or self.bounds[0] is not self.scene:
+            self.bounds = (self.scene, coherence.scene_bounds(self.scene))
+        return self.bounds[1]
+
+    #whether intersect walks the BVH with packets, only for scenes large enough to gain from it
+    def use_packets(self):
+        scene = self.scene
+        return (bool(self.packet_size) and len(scene.bvh_count) > 0
+            and scene.num_spheres + scene.num_rects >= self.packet_min_primitives)
+
+    #closest hit of every ray, with packets through the BVH or against every primitive in the scene
+    def intersect(self, origins, directions):
+        if self.use_packets():
+            if self.packet_bvh is None or self.packet_bvh.scene is not self.scene:
+                self.packet_bvh = coherence.PacketBVH(self.scene, self.packet_size)
+            packets = self.packet_bvh
+            before = (packets.node_visits, packets.box_tests, packets.prim_tests, packets.closer_hits)
+            t, kind, idx = packets.intersect(origins, directions, self.t_min, self.t_max)
+            self.node_visits += packets.node_visits - before[0]
+            self.box_tests += packets.box_tests - before[1]
+            self.prim_tests += packets.prim_tests - before[2]
+            self.closer_hits += packets.closer_hits - before[3]
+            return HitBatch(t, kind, idx)
+        return self.intersect_all(origins, directions)
+
+    #closest hit of every ray against every primitive in the scene
+    def intersect_all(self, origins, directions):
+        n = len(origins)
+        closest = np.full(n, self.t_max, dtype=np.float64)
+        kind = np.full(n, -1, dtype=np.int8)
+        idx = np.zeros(n, dtype=np.int32)
+        scene = self.scene
+        self.prim_tests += n*(scene.num_spheres + scene.num_rects)
+
+        a = np.einsum("ij,ij->i", directions, directions)
+        for s in range(scene.num_spheres):
+            hit, root = intersect.hit_spheres(origins, directions, a, scene.sphere_center[s], scene.sphere_radius[s],
+                self.t_min, closest)
+            closest = np.where(hit, root, closest)
+            kind[hit] = KIND_SPHERE
+            idx[hit] = s
+            self.closer_hits += int(np.count_nonzero(hit))
+
+        for r in range(scene.num_rects):
+            hit, t = intersect.hit_rects(origins, directions, scene.rect_bounds[r], scene.rect_k[r], self.t_min, closest)
+            closest = np.where(hit, t, closest)
+            kind[hit] = KIND_RECT
+            idx[hit] = r
+            self.closer_hits += int(np.count_nonzero(hit))
+
+        return HitBatch(closest, kind, idx)
+
+    #adds the hits of a batch to hit_counts, by object type and material
+    def count_hits(self, hits):
+        scene = self.scene
+        counts = self.hit_counts
+        for kind, name, materials in ((KIND_SPHERE, "Sphere", scene.sphere_material), (KIND_RECT, "RectFlat", scene.rect_material)):
+            mask = hits.kind == kind
+            n = int(mask.sum())
+            if n == 0:
+                continue
+            counts["hits." + name] = counts.get("hits." + name, 0) + n
+            mtypes = np.bincount(scene.mat_type[materials[hits.idx[mask]]], minlength=len(MAT_NAMES))
+            for mtype, count in enumerate(mtypes.tolist()):
+                if count:
+                    key = "material_hits." + MAT_NAMES[mtype]
+                    counts[key] = counts.get(key, 0) + count
+
+    #adds the sky color of rays that left the scene
+    def add_sky(self, rays, accum, lum_sq=None):
+        color = shading.sky_color(rays.directions)*rays.throughput
+        for ch in range(3):
+            accum[:, ch] += np.bincount(rays.pixel, weights=color[:, ch], minlength=len(accum))
+        #every path ends at most once, so this is the squared luminance of each finished sample
+        if lum_sq is not None:
+            lum_sq += np.bincount(rays.pixel, weights=(color @ LUMINANCE)**2, minlength=len(accum))
+
+    #computes hit points, normals and texture coordinates, then bounces the rays with shading.shade
+    #bounce selects the sampler dimension of the Lambertian directions, and camera rays (bounce 0)
+    #get a texture footprint from the pixel size like the scalar engine's rays
+    def scatter(self, rays, hits, rng, bounce=0):
+        scene = self.scene
+        n = len(rays)
+        d = rays.directions
+        p = rays.origins + d*hits.t[:, None]
+
+        outward = np.zeros((n, 3))
+        u = np.zeros(n)
+        v = np.zeros(n)
+        footprint = np.zeros(n)
+        material = np.zeros(n, dtype=np.int32)
+        spread = self.camera.pixel_spread if bounce == 0 else 0.0
+        length = hits.t*np.linalg.norm(d, axis=1)
+
+        #texture coordinates and footprints only for hits on checkered or textured materials
+        sph = np.flatnonzero(hits.kind == KIND_SPHERE)
+        if len(sph):
+            s = hits.idx[sph]
+            norm_p = (p[sph] - scene.sphere_center[s]) / scene.sphere_radius[s][:, None]
+            outward[sph] = norm_p
+            material[sph] = scene.sphere_material[s]
+            uv = scene.mat_color_kind[material[sph]] != COLOR_SOLID
+            if uv.any():
+                norm_p, s, idx = norm_p[uv], s[uv], sph[uv]
+                theta = np.arccos(np.clip(-norm_p[:, 1], -1.0, 1.0))
+                phi = np.arctan2(-norm_p[:, 2], norm_p[:, 0]) + np.pi
+                u[idx] = phi / (2*np.pi)
+                v[idx] = theta / np.pi
+                footprint[idx] = spread*length[idx] / (np.pi*scene.sphere_radius[s])
+                self.uv_fills += len(idx)
+
+        rect = np.flatnonzero(hits.kind == KIND_RECT)
+        if len(rect):
+            r = hits.idx[rect]
+            outward[rect] = (0, 1, 0)
+            material[rect] = scene.rect_material[r]
+            uv = scene.mat_color_kind[material[rect]] != COLOR_SOLID
+            if uv.any():
+                r, idx = r[uv], rect[uv]
+                bounds = scene.rect_bounds[r]
+                u[idx] = (p[idx, 0] - bounds[:, 0]) / (bounds[:, 1] - bounds[:, 0])
+                v[idx] = (p[idx, 2] - bounds[:, 2]) / (bounds[:, 3] - bounds[:, 2])
+                footprint[idx] = spread*length[idx] / np.minimum(bounds[:, 1] - bounds[:, 0], bounds[:, 3] - bounds[:, 2])
+                self.uv_fills += len(idx)
+        self.attr_fills += n
+
+        #normal always points against the ray
+        front_face = np.einsum("ij,ij->i", d, outward) <= 0
+        normal = np.where(front_face[:, None], outward, -outward)
+        records = shading.HitRecords(p, normal, front_face, u, v, material, footprint)
+
+        if self.sampler is None:
+            samples = lambda idx: rng.random((2, len(idx)))
+        else:
+            key = rays.key
+            dim = samplers.scatter_dim(bounce)
+            samples = lambda idx: self.sampler.sample2d(key[idx, 0], key[idx, 1], key[idx, 2], dim)
+        direction, attenuation = shading.shade(scene, records, d, samples)
+
+        #a bounce with an axis aligned direction is treated as absorbed, as in ray_color
+        alive = ~(direction == 0).any(axis=1)
+        key = rays.key[alive] if rays.key is not None else None
+        return RayBatch(p[alive], direction[alive], (rays.throughput*attenuation)[alive], rays.pixel[alive], key)
+
+#pixel coordinates of every pixel in a tile, row by row
+def tile_pixels(j0, j1, i0, i1):
+    jj, ii = np.divmod(np.arange((j1-j0)*(i1-i0)), i1-i0)
+    return jj + j0, ii + i0